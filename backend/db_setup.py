@@ -0,0 +1,129 @@
+"""Index bootstrap and the ISO-string -> BSON date migration.
+
+Both are idempotent and run at API startup. They can also be run by hand:
+
+    python db_setup.py
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# (collection, keys, options)
+INDEXES = [
+    ("user_sessions", [("session_token", ASCENDING)], {"unique": True}),
+    # Mongo deletes a session once expires_at (a BSON date) is in the past
+    ("user_sessions", [("expires_at", ASCENDING)], {"expireAfterSeconds": 0}),
+    ("users", [("user_id", ASCENDING)], {"unique": True}),
+    ("users", [("email", ASCENDING)], {}),
+    ("images", [("image_id", ASCENDING)], {"unique": True}),
+    # History: filter on user, keyset pagination on (created_at, image_id)
+    ("images", [("user_id", ASCENDING), ("created_at", DESCENDING), ("image_id", DESCENDING)], {}),
+    ("images", [("job_id", ASCENDING)], {"sparse": True}),
+    # Recovery of images whose processing lease ran out
+    ("images", [("status", ASCENDING), ("lease_expires_at", ASCENDING)], {}),
+    ("blobs", [("blob_key", ASCENDING)], {"unique": True}),
+    ("usage", [("user_id", ASCENDING)], {"unique": True}),
+]
+
+# Timestamp fields that older code stored as ISO strings
+DATE_FIELDS = {
+    "users": ["created_at", "last_credit_reset"],
+    "user_sessions": ["created_at", "expires_at"],
+    "images": ["created_at", "processed_at"],
+    "blobs": ["created_at"],
+}
+
+MIGRATION_BATCH_SIZE = 500
+
+
+def parse_date(value):
+    """ISO string or datetime -> timezone-aware UTC datetime (None stays None)"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if isinstance(value, datetime) and value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
+async def ensure_indexes(db) -> None:
+    """Create the indexes the queries rely on. A failing index is logged, not fatal"""
+    for collection, keys, options in INDEXES:
+        try:
+            await db[collection].create_index(keys, **options)
+        except PyMongoError as e:
+            # e.g. duplicate session tokens left over from before the unique index
+            logger.error(f"Could not create index {keys} on {collection}: {str(e)}")
+
+
+async def missing_indexes(db) -> list:
+    """(collection, keys) of INDEXES that don't exist, e.g. because ensure_indexes failed on them"""
+    missing = []
+    for collection, keys, _ in INDEXES:
+        existing = {
+            tuple(map(tuple, index["key"])) for index in (await db[collection].index_information()).values()
+        }
+        if tuple(map(tuple, keys)) not in existing:
+            missing.append((collection, keys))
+    return missing
+
+
+async def migrate_string_dates(db, batch_size: int = MIGRATION_BATCH_SIZE) -> int:
+    """Rewrite ISO string timestamps as BSON dates, batch by batch. Returns documents updated
+
+    Strings that aren't ISO dates are left as they are, and logged.
+    """
+    updated = 0
+    for collection, fields in DATE_FIELDS.items():
+        query = {"$or": [{field: {"$type": "string"}} for field in fields]}
+        projection = {field: 1 for field in fields}
+        skipped = 0
+        last_id = None
+        while True:
+            # In _id order, so documents left with an unparseable string aren't read again
+            page = query if last_id is None else {**query, "_id": {"$gt": last_id}}
+            docs = await db[collection].find(page, projection).sort("_id", ASCENDING).limit(batch_size).to_list(batch_size)
+            if not docs:
+                break
+            last_id = docs[-1]["_id"]
+            updates = []
+            for doc in docs:
+                dates = {}
+                for field in fields:
+                    if isinstance(doc.get(field), str):
+                        try:
+                            dates[field] = parse_date(doc[field])
+                        except ValueError:
+                            skipped += 1
+                if dates:
+                    updates.append(UpdateOne({"_id": doc["_id"]}, {"$set": dates}))
+            if updates:
+                await db[collection].bulk_write(updates, ordered=False)
+                updated += len(updates)
+        if skipped:
+            logger.warning(f"Date migration left {skipped} unparseable values in {collection}")
+        logger.info(f"Date migration done for {collection}")
+    return updated
+
+
+async def _main() -> None:
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'], tz_aware=True)
+    db = client[os.environ['DB_NAME']]
+    await ensure_indexes(db)
+    print(f"{await migrate_string_dates(db)} documents migrated")
+    client.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main())
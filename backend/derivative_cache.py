@@ -0,0 +1,105 @@
+"""Size-bounded on-disk LRU cache of resized image derivatives.
+
+Each API process keeps its own index of the cache directory (rebuilt from the
+files' mtimes on startup), so with several uvicorn workers the byte budget is
+enforced per process and an entry may vanish under another process's eviction;
+callers just render it again.
+"""
+import asyncio
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Awaitable, Callable, Dict
+
+
+class DerivativeCache:
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # file name -> size in bytes, least recently used first
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._bytes = 0
+        self._inflight: Dict[str, asyncio.Future] = {}
+        directory.mkdir(parents=True, exist_ok=True)
+        self._load()
+
+    def _load(self) -> None:
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self._bytes += size
+        self._evict()
+
+    def _evict(self) -> None:
+        # The newest entry always stays, it is about to be served
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            name, size = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            (self.directory / name).unlink(missing_ok=True)
+
+    def _lookup(self, name: str) -> bool:
+        if name not in self._entries:
+            return False
+        path = self.directory / name
+        try:
+            # mtime is the LRU clock across restarts
+            os.utime(path)
+        except FileNotFoundError:
+            self._bytes -= self._entries.pop(name)
+            return False
+        self._entries.move_to_end(name)
+        return True
+
+    async def get_or_create(self, name: str, render: Callable[[Path], Awaitable[None]]) -> Path:
+        """Path of the cached file, rendering it with render(path) on a miss.
+
+        Concurrent misses for the same name share one render.
+        """
+        path = self.directory / name
+        if self._lookup(name):
+            self.hits += 1
+            return path
+
+        inflight = self._inflight.get(name)
+        if inflight is not None:
+            self.hits += 1
+            await asyncio.shield(inflight)
+            return path
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._inflight[name] = future
+        try:
+            await render(path)
+            size = path.stat().st_size
+            if name in self._entries:
+                self._bytes -= self._entries.pop(name)
+            self._entries[name] = size
+            self._bytes += size
+            self._evict()
+            future.set_result(None)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self._inflight[name]
+        return path
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
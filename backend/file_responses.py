@@ -0,0 +1,141 @@
+"""Cacheable file responses: strong ETags, conditional requests and byte ranges.
+
+Starlette's FileResponse (0.37) sets a weak mtime-based ETag but never answers
+If-None-Match or Range, so every history view re-downloads the full image.
+"""
+import mimetypes
+import os
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from typing import AsyncIterator, Optional, Tuple
+
+import aiofiles
+from fastapi import Request, Response
+from fastapi.responses import StreamingResponse
+
+# Files are immutable once written (content-addressed, never overwritten)
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+READ_CHUNK_SIZE = 64 * 1024
+
+# Not in every platform's mime.types
+mimetypes.add_type("image/webp", ".webp")
+mimetypes.add_type("image/avif", ".avif")
+
+
+def media_type_for(path: Path) -> str:
+    """Content type from the file extension (uploads may be PNG/WebP, not only JPEG)"""
+    return mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+
+
+def stat_etag(stat: os.stat_result) -> str:
+    """Strong ETag from mtime + size, for files without a known content hash"""
+    return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    if header.strip() == "*":
+        return True
+    # Weak comparison, as RFC 9110 requires for If-None-Match
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return f'"{etag}"' in tags
+
+
+def _parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """(start, end inclusive) of a single "bytes=" range.
+
+    Returns None for headers we ignore (multiple ranges, other units, garbage),
+    which means the full body is sent; raises ValueError when unsatisfiable.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        else:
+            # Suffix range: the last N bytes
+            start = max(size - int(last), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        raise ValueError("range not satisfiable")
+    if start < 0 or end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+async def _read_file(path: Path, start: int, length: int) -> AsyncIterator[bytes]:
+    async with aiofiles.open(path, "rb") as f:
+        await f.seek(start)
+        while length > 0:
+            chunk = await f.read(min(READ_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def cached_file_response(
+    request: Request,
+    path: Path,
+    etag: Optional[str] = None,
+    cache_control: str = "public, max-age=0, must-revalidate",
+    media_type: Optional[str] = None,
+    extra_headers: Optional[dict] = None,
+) -> Response:
+    """Serve path with validators, answering 304 / 206 / 416 where appropriate.
+
+    etag should identify the bytes (e.g. their SHA-256); mtime + size is used
+    otherwise. extra_headers (e.g. Vary) go on every response, 304s included.
+    """
+    stat = path.stat()
+    etag = etag or stat_etag(stat)
+    headers = {
+        "ETag": f'"{etag}"',
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        "Cache-Control": cache_control,
+        "Accept-Ranges": "bytes",
+        **(extra_headers or {}),
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if _etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+    elif "if-modified-since" in request.headers:
+        try:
+            since = parsedate_to_datetime(request.headers["if-modified-since"]).timestamp()
+        except (TypeError, ValueError):
+            since = None
+        if since is not None and int(stat.st_mtime) <= since:
+            return Response(status_code=304, headers=headers)
+
+    media_type = media_type or media_type_for(path)
+    size = stat.st_size
+    byte_range = None
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    # If-Range: only honour the range when the client's copy is still current
+    if range_header and (if_range is None or if_range.strip() == f'"{etag}"'):
+        try:
+            byte_range = _parse_range(range_header, size)
+        except ValueError:
+            headers["Content-Range"] = f"bytes */{size}"
+            return Response(status_code=416, headers=headers)
+
+    if byte_range is None:
+        start, length, status_code = 0, size, 200
+    else:
+        start, end = byte_range
+        length, status_code = end - start + 1, 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(length)
+    return StreamingResponse(
+        _read_file(path, start, length), status_code=status_code, headers=headers, media_type=media_type
+    )
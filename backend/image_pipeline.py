@@ -0,0 +1,518 @@
+"""CPU-bound image processing (background removal + enhancement).
+
+Everything in here runs inside the processing executor configured in server.py,
+so it must stay synchronous, never touch the database, and only take/return
+picklable values (worker processes import this module, not server.py).
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont, ImageOps, features
+
+DEFAULT_MODEL = "u2net"
+
+# Preprocessing of the models we batch ourselves: (mean, std, native input size),
+# copied from the matching rembg session classes
+MODEL_INPUTS = {
+    "u2net": ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    "u2netp": ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    "silueta": ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    "isnet-general-use": ((0.5, 0.5, 0.5), (1.0, 1.0, 1.0), (1024, 1024)),
+}
+
+# Enhancement applied to every result
+CONTRAST = 1.1
+SHARPNESS = 1.2
+BRIGHTNESS = 1.05
+
+# Rows per strip in the fused stage, keeps its temporaries small and cache-resident
+FUSE_STRIP_ROWS = 32
+
+# Cutout-on-white value for every (mask a, channel value v) pair: v * a^2 + 255 * (1 - a).
+# rembg's cutout is premultiplied by the mask and then composited with the mask as
+# alpha, hence a^2.
+_levels = np.arange(256, dtype=np.float64)
+_coverage = _levels / 255.0
+_BLEND_LUT = _levels[None, :] * (_coverage ** 2)[:, None] + 255.0 * (1.0 - _coverage)[:, None]
+
+# ImageEnhance.Sharpness(f) is f * img + (1 - f) * SMOOTH(img), with SMOOTH =
+# (3x3 box sum + 4 * center) / 13. As center/box weights in 6-bit fixed point
+# (int16 can't overflow: 255 * 73 + 9 * 255 < 32767):
+_SHARPEN_BITS = 6
+_SHARPEN_CENTER = int(round((SHARPNESS + 4 * (1 - SHARPNESS) / 13) * (1 << _SHARPEN_BITS)))
+_SHARPEN_BOX = int(round((1 - SHARPNESS) / 13 * (1 << _SHARPEN_BITS)))
+
+# Watermark of the free tier: a text badge in the bottom-right corner, rendered once
+# per output size bucket (shorter edge rounded down to WATERMARK_BUCKET px)
+WATERMARK_TEXT = "VintedPro"
+WATERMARK_OPACITY = 0.55
+WATERMARK_BUCKET = 128
+WATERMARK_CACHE_SIZE = 32
+
+# PIL encoder name and fixed save options per output format; quality/effort come
+# from the plan (PLAN_LIMITS "encoder"), DEFAULT_ENCODER when there is none
+ENCODERS = {
+    "jpeg": ("JPEG", {"optimize": True, "progressive": True}),
+    "webp": ("WEBP", {}),
+    "avif": ("AVIF", {}),
+    "png": ("PNG", {"optimize": True}),
+}
+DEFAULT_ENCODER = {
+    "jpeg": {"quality": 85},
+    "webp": {"quality": 80, "method": 4},
+    "avif": {"quality": 55, "speed": 8},
+    "png": {},
+}
+# Formats this Pillow build can write (AVIF needs libavif)
+_FORMAT_FEATURES = {"jpeg": "jpg", "webp": "webp", "avif": "avif", "png": "zlib"}
+AVAILABLE_FORMATS = tuple(fmt for fmt in ENCODERS if features.check(_FORMAT_FEATURES[fmt]))
+
+# Longest output edge per PLAN_LIMITS quality tier (None/unknown = keep original size)
+QUALITY_MAX_EDGE = {
+    "720p": 1280,
+    "1080p": 1920,
+    "4K": 3840,
+}
+
+# Long-lived rembg sessions keyed by model name (one registry per worker process)
+_sessions: Dict[str, object] = {}
+_sessions_lock = threading.Lock()
+
+# onnxruntime intra-op threads per session, set by configure(); 0 = one per core
+_intra_op_threads = 0
+# Clock of the per-stage CPU times, set by configure()
+_cpu_clock = time.thread_time
+
+
+def configure(intra_op_threads: int, own_process: bool = False) -> None:
+    """Executor initializer: size onnxruntime's thread pool to this worker's share of the cores.
+
+    own_process: the worker is a process running one job at a time, so stage
+    CPU time is measured for the whole process and includes onnxruntime's
+    threads. Workers sharing a process only measure their own thread.
+
+    Must not fail (a failing initializer breaks the whole process pool), so
+    models are not loaded here but on first use.
+    """
+    global _intra_op_threads, _cpu_clock
+    _intra_op_threads = intra_op_threads
+    _cpu_clock = time.process_time if own_process else time.thread_time
+
+
+def get_session(model_name: str = DEFAULT_MODEL):
+    """Return the process-wide rembg session for a model, creating it on first use"""
+    session = _sessions.get(model_name)
+    if session is not None:
+        return session
+    with _sessions_lock:
+        # Another thread may have built it while we waited for the lock
+        session = _sessions.get(model_name)
+        if session is None:
+            import onnxruntime as ort
+            from rembg.sessions import sessions_class
+            # rembg's new_session() builds its own SessionOptions, so construct the class directly
+            session_class = next((sc for sc in sessions_class if sc.name() == model_name), None)
+            if session_class is None:
+                raise ValueError(f"No rembg session for model '{model_name}'")
+            sess_opts = ort.SessionOptions()
+            sess_opts.intra_op_num_threads = _intra_op_threads
+            sess_opts.inter_op_num_threads = 1
+            session = session_class(model_name, sess_opts)
+            _sessions[model_name] = session
+    return session
+
+
+def warm_up(model_names: Iterable[str]) -> int:
+    """Load the models and run one tiny inference with each, so onnxruntime has
+    allocated its buffers before the first real job. Returns this worker's pid."""
+    dummy = Image.new("RGB", (64, 64), (128, 128, 128))
+    for model_name in model_names:
+        predict_masks([dummy], model_name)
+    return os.getpid()
+
+
+def decode_image(original_path: str, max_edge: Optional[int] = None) -> Image.Image:
+    """Read an upload and apply its EXIF orientation.
+
+    max_edge: the image is shrunk to it later (resize stage), so a JPEG may be
+    decoded at any reduced scale that still covers it.
+    """
+    with Image.open(original_path) as img:
+        if max_edge:
+            # JPEG: let libjpeg decode at 1/2, 1/4 or 1/8 scale instead of the full 48MP
+            img.draft("RGB", (max_edge, max_edge))
+        return ImageOps.exif_transpose(img).convert("RGB")
+
+
+def predict_masks(images: List[Image.Image], model_name: str = DEFAULT_MODEL) -> List[Image.Image]:
+    """Foreground masks for several images from a single batched ONNX run"""
+    session = get_session(model_name)
+    if model_name not in MODEL_INPUTS:
+        # Unknown preprocessing, let rembg handle it one image at a time
+        return [session.predict(img)[0] for img in images]
+
+    mean, std, size = MODEL_INPUTS[model_name]
+    # The model only ever sees its native input size: shrink cheaply first so
+    # normalize() doesn't run a LANCZOS resize over the full output resolution
+    feeds = [
+        session.normalize(img.resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0), mean, std, size)
+        for img in images
+    ]
+    input_name = next(iter(feeds[0]))
+    if isinstance(session.inner_session.get_inputs()[0].shape[0], int):
+        # Model exported with a fixed batch dimension
+        preds = np.concatenate([session.inner_session.run(None, feed)[0] for feed in feeds])
+    else:
+        batch = np.concatenate([feed[input_name] for feed in feeds])
+        preds = session.inner_session.run(None, {input_name: batch})[0]
+
+    masks = []
+    for img, pred in zip(images, preds[:, 0, :, :]):
+        # Same per-image min/max normalisation as rembg's own predict()
+        mi, ma = pred.min(), pred.max()
+        pred = (pred - mi) / max(ma - mi, 1e-6)
+        mask = Image.fromarray((pred * 255).astype("uint8"), mode="L")
+        masks.append(mask.resize(img.size, Image.Resampling.LANCZOS))
+    return masks
+
+
+def composite_and_enhance(img: Image.Image, mask: Image.Image, enhance: bool = True) -> Image.Image:
+    """White-background blend + contrast + brightness through one lookup table, then one sharpen.
+
+    Matches (within a few levels) the former chain of cutout -> alpha_composite
+    on white -> Contrast -> Sharpness -> Brightness, without its full-size
+    intermediate images. Works in strips of FUSE_STRIP_ROWS rows so every
+    temporary stays small and cache-resident. enhance=False only blends.
+    """
+    rgb = np.asarray(img)
+    alpha = np.asarray(mask)
+    height, width = alpha.shape
+
+    gain, offset = 1.0, 0.0
+    if enhance:
+        # Contrast pivots around the mean luminance of the blended image (like ImageEnhance.Contrast).
+        # Blending is per-channel affine, so a (mask, luma) histogram is enough to get it.
+        luma = np.asarray(img.convert("L"))
+        hist = np.zeros(256 * 256, dtype=np.int64)
+        for top in range(0, height, FUSE_STRIP_ROWS * 8):
+            rows = slice(top, top + FUSE_STRIP_ROWS * 8)
+            hist += np.bincount(_lut_index(alpha[rows], luma[rows]).ravel(), minlength=256 * 256)
+        mean = int(float(hist @ _BLEND_LUT.ravel()) / (height * width) + 0.5)
+
+        # Contrast and brightness are both affine, fold them into the blend table
+        gain = CONTRAST * BRIGHTNESS
+        offset = BRIGHTNESS * mean * (1.0 - CONTRAST)
+    lut = np.clip(_BLEND_LUT * gain + offset + 0.5, 0, 255).astype(np.uint8).ravel()
+
+    out = np.empty_like(rgb)
+    for top in range(0, height, FUSE_STRIP_ROWS):
+        rows = min(FUSE_STRIP_ROWS, height - top)
+        # One row of halo on each side for the 3x3 sharpen
+        lo, hi = max(top - 1, 0), min(top + rows + 1, height)
+        strip = lut.take(_lut_index(alpha[lo:hi, :, None], rgb[lo:hi]))
+        out[top:top + rows] = strip[top - lo:top - lo + rows]
+        if not enhance:
+            continue
+
+        # Sharpen the interior pixels: 3x3 box sum in int16, fixed-point weights
+        # (border pixels stay unsharpened, like PIL's kernel filters)
+        strip = strip.astype(np.int16)
+        box = strip[:, :-2] + strip[:, 1:-1]
+        box += strip[:, 2:]
+        box = box[:-2] + box[1:-1] + box[2:]
+        sharp = strip[1:-1, 1:-1] * _SHARPEN_CENTER
+        sharp += box * _SHARPEN_BOX
+        sharp += 1 << (_SHARPEN_BITS - 1)
+        sharp >>= _SHARPEN_BITS
+        np.clip(sharp, 0, 255, out=sharp)
+        out[lo + 1:hi - 1, 1:-1] = sharp
+
+    return Image.fromarray(out)
+
+
+def _lut_index(alpha: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """Flat index into a 256x256 (mask, value) table"""
+    return (alpha.astype(np.uint16) << 8) | values
+
+
+# ==================== STAGES ====================
+#
+# A pipeline is a list of registered stage names; plans pick theirs (PLAN_LIMITS
+# "stages"). Per-image stages take (item, ctx), batched ones (items, ctx) and
+# run once for the whole chunk (e.g. one ONNX run for every mask).
+
+
+@dataclass
+class PipelineItem:
+    """One image travelling through the stages"""
+    original_path: str
+    processed_path: str
+    img: Optional[Image.Image] = None
+    mask: Optional[Image.Image] = None
+    error: Optional[str] = None
+    timings: Dict[str, Dict[str, float]] = field(default_factory=dict)
+
+
+@dataclass
+class PipelineContext:
+    """Per-run settings shared by every stage"""
+    model_name: str
+    max_edge: Optional[int]
+    stages: Tuple[str, ...]
+    encoder: Dict[str, dict] = field(default_factory=lambda: DEFAULT_ENCODER)
+
+
+@dataclass
+class Stage:
+    name: str
+    run: Callable
+    batched: bool = False
+
+
+STAGES: Dict[str, Stage] = {}
+
+# Adjacent stages that have a single-pass implementation, run as that one stage
+FUSED_STAGES = {("composite", "enhance"): "composite+enhance"}
+
+DEFAULT_STAGES = ("decode", "resize", "segment", "composite", "enhance", "encode")
+
+
+def register_stage(name: str, batched: bool = False):
+    """Decorator adding a stage function to the registry under name"""
+    def decorator(run: Callable) -> Callable:
+        STAGES[name] = Stage(name, run, batched)
+        return run
+    return decorator
+
+
+def plan_stages(stage_names: Iterable[str]) -> List[Stage]:
+    """Registry stages of a plan's stage list, with fusable neighbours merged"""
+    names = list(stage_names)
+    unknown = [name for name in names if name not in STAGES]
+    if unknown:
+        raise ValueError(f"Unknown pipeline stages: {unknown}")
+    stages = []
+    i = 0
+    while i < len(names):
+        fused = FUSED_STAGES.get(tuple(names[i:i + 2]))
+        stages.append(STAGES[fused] if fused else STAGES[names[i]])
+        i += 2 if fused else 1
+    return stages
+
+
+@register_stage("decode")
+def _decode(item: PipelineItem, ctx: PipelineContext) -> None:
+    # With a resize stage coming, let JPEG decode at a reduced scale straight away
+    item.img = decode_image(item.original_path, ctx.max_edge if "resize" in ctx.stages else None)
+
+
+@register_stage("resize")
+def _resize(item: PipelineItem, ctx: PipelineContext) -> None:
+    if ctx.max_edge and max(item.img.size) > ctx.max_edge:
+        item.img.thumbnail((ctx.max_edge, ctx.max_edge), Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+
+@register_stage("segment", batched=True)
+def _segment(items: List[PipelineItem], ctx: PipelineContext) -> None:
+    for item, mask in zip(items, predict_masks([item.img for item in items], ctx.model_name)):
+        item.mask = mask
+
+
+@register_stage("composite")
+def _composite(item: PipelineItem, ctx: PipelineContext) -> None:
+    item.img = composite_and_enhance(item.img, item.mask, enhance=False)
+
+
+@register_stage("enhance")
+def _enhance(item: PipelineItem, ctx: PipelineContext) -> None:
+    # Fully opaque mask: the blend table is the identity, only the enhancements apply
+    item.img = composite_and_enhance(item.img, Image.new("L", item.img.size, 255))
+
+
+@register_stage("composite+enhance")
+def _composite_enhance(item: PipelineItem, ctx: PipelineContext) -> None:
+    item.img = composite_and_enhance(item.img, item.mask)
+
+
+# Pre-rendered badges by size bucket: (premultiplied color, 255 - alpha), both uint16 HxWx1/3
+_watermarks: "OrderedDict[int, Tuple[np.ndarray, np.ndarray]]" = OrderedDict()
+_watermarks_lock = threading.Lock()
+
+
+def _render_watermark(bucket: int) -> Tuple[np.ndarray, np.ndarray]:
+    font = ImageFont.load_default(size=max(bucket // 14, 10))
+    left, top, right, bottom = font.getbbox(WATERMARK_TEXT)
+    pad = max(bucket // 64, 3)
+    badge = Image.new("RGBA", (right - left + 2 * pad, bottom - top + 2 * pad), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(badge)
+    draw.rounded_rectangle((0, 0, badge.width - 1, badge.height - 1), radius=pad, fill=(0, 0, 0, 90))
+    draw.text((pad - left, pad - top), WATERMARK_TEXT, font=font, fill=(255, 255, 255, 255))
+
+    rgba = np.asarray(badge, dtype=np.uint16)
+    alpha = (rgba[:, :, 3:] * WATERMARK_OPACITY).astype(np.uint16)
+    return rgba[:, :, :3] * alpha, 255 - alpha
+
+
+def get_watermark(width: int, height: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Badge for an output of this size, from a bounded LRU of pre-rendered buckets"""
+    bucket = max(min(width, height) // WATERMARK_BUCKET, 1) * WATERMARK_BUCKET
+    with _watermarks_lock:
+        watermark = _watermarks.get(bucket)
+        if watermark is not None:
+            _watermarks.move_to_end(bucket)
+            return watermark
+    watermark = _render_watermark(bucket)
+    with _watermarks_lock:
+        _watermarks[bucket] = watermark
+        while len(_watermarks) > WATERMARK_CACHE_SIZE:
+            _watermarks.popitem(last=False)
+    return watermark
+
+
+def apply_watermark(img: Image.Image) -> Image.Image:
+    """Alpha-blend the badge into the bottom-right corner (in place) in one vectorized pass"""
+    premultiplied, inverse_alpha = get_watermark(*img.size)
+    h, w = inverse_alpha.shape[:2]
+    margin = max(min(img.size) // 40, 2)
+    # Badge larger than a tiny image: crop it
+    h, w = min(h, img.height), min(w, img.width)
+    top, left = max(img.height - h - margin, 0), max(img.width - w - margin, 0)
+
+    # Only the badge's rectangle is touched, the rest of the image is never copied
+    box = (left, top, left + w, top + h)
+    region = np.asarray(img.crop(box), dtype=np.uint16)
+    blended = (region * inverse_alpha[:h, :w] + premultiplied[:h, :w] + 127) // 255
+    img.paste(Image.fromarray(blended.astype(np.uint8)), box)
+    return img
+
+
+@register_stage("watermark")
+def _watermark(item: PipelineItem, ctx: PipelineContext) -> None:
+    item.img = apply_watermark(item.img)
+
+
+def save_image(img: Image.Image, path: str, fmt: str, settings: Optional[dict] = None) -> None:
+    """Encode img as fmt with the given quality/effort settings, atomically.
+
+    Outputs are content-addressed and two workers may write the same one, so
+    write aside and rename into place.
+    """
+    encoder, options = ENCODERS[fmt]
+    tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    try:
+        img.save(tmp_path, encoder, **options, **(settings if settings is not None else DEFAULT_ENCODER[fmt]))
+        os.replace(tmp_path, path)
+    finally:
+        Path(tmp_path).unlink(missing_ok=True)
+
+
+@register_stage("encode")
+def _encode(item: PipelineItem, ctx: PipelineContext) -> None:
+    # The stored result is always JPEG, other formats are derived on request
+    save_image(item.img, item.processed_path, "jpeg", ctx.encoder["jpeg"])
+
+
+def _record(item: PipelineItem, name: str, wall: float, cpu: float) -> None:
+    item.timings[name] = {"wall_ms": round(wall * 1000, 2), "cpu_ms": round(cpu * 1000, 2)}
+
+
+def run_stages(items: List[PipelineItem], ctx: PipelineContext) -> None:
+    """Run every stage over the items, recording wall and CPU time per image and stage.
+
+    An image failing a stage skips the rest; a batched stage's time is split
+    evenly across the images it ran for. CPU time is the whole worker process's
+    in a process pool, the worker thread's alone otherwise (see configure()), so
+    in thread pools it leaves out the inference done on onnxruntime's threads.
+    """
+    for stage in plan_stages(ctx.stages):
+        live = [item for item in items if item.error is None]
+        if not live:
+            return
+        if stage.batched:
+            wall, cpu = time.perf_counter(), _cpu_clock()
+            try:
+                stage.run(live, ctx)
+            except Exception as e:
+                for item in live:
+                    item.error = str(e)
+            wall, cpu = time.perf_counter() - wall, _cpu_clock() - cpu
+            for item in live:
+                _record(item, stage.name, wall / len(live), cpu / len(live))
+            continue
+        for item in live:
+            wall, cpu = time.perf_counter(), _cpu_clock()
+            try:
+                stage.run(item, ctx)
+            except Exception as e:
+                item.error = str(e)
+            _record(item, stage.name, time.perf_counter() - wall, _cpu_clock() - cpu)
+    for item in items:
+        # Don't hold decoded pixels once the run is over
+        item.img = item.mask = None
+
+
+def encoder_tag(settings: dict) -> str:
+    """Stable short text form of encoder settings, e.g. method=4,quality=80"""
+    return ",".join(f"{key}={value}" for key, value in sorted(settings.items()))
+
+
+def pipeline_signature(
+    model_name: str,
+    quality: Optional[str],
+    stages: Iterable[str] = DEFAULT_STAGES,
+    encoder: Optional[Dict[str, dict]] = None,
+) -> str:
+    """Everything besides the input bytes that changes the output; part of the dedup key"""
+    jpeg = encoder_tag((encoder or DEFAULT_ENCODER)["jpeg"])
+    signature = f"v1|{model_name}|{quality}|c{CONTRAST}|s{SHARPNESS}|b{BRIGHTNESS}|jpeg[{jpeg}]"
+    stages = tuple(stages)
+    if stages != DEFAULT_STAGES:
+        signature += "|" + ",".join(stages)
+    return signature
+
+
+def process_images(
+    jobs: List[Tuple[str, str]],
+    model_name: str = DEFAULT_MODEL,
+    quality: Optional[str] = None,
+    stages: Iterable[str] = DEFAULT_STAGES,
+    encoder: Optional[Dict[str, dict]] = None,
+) -> List[dict]:
+    """Process (original_path, processed_path) pairs through a plan's stages with one batched inference.
+
+    quality is the plan's output tier (see QUALITY_MAX_EDGE) used by decode/resize;
+    encoder the plan's per-format settings used by encode.
+
+    Returns {"error": message or None, "timings": {stage: {"wall_ms", "cpu_ms"}}}
+    per image, so one corrupt upload doesn't fail the rest of the batch.
+    """
+    ctx = PipelineContext(
+        model_name=model_name,
+        max_edge=QUALITY_MAX_EDGE.get(quality),
+        stages=tuple(stages),
+        encoder=encoder or DEFAULT_ENCODER
+    )
+    items = [PipelineItem(original_path, processed_path) for original_path, processed_path in jobs]
+    run_stages(items, ctx)
+    return [{"error": item.error, "timings": item.timings} for item in items]
+
+
+def render_derivative(
+    source_path: str, target_path: str, width: Optional[int], fmt: str, settings: Optional[dict] = None
+) -> None:
+    """Re-encode an original/processed file as fmt, resized to width if given (never upscaling)"""
+    with Image.open(source_path) as img:
+        if width:
+            img.draft("RGB", (width, width))
+        img = ImageOps.exif_transpose(img)
+        keep_alpha = fmt != "jpeg" and img.mode in ("RGBA", "LA")
+        img = img.convert("RGBA" if keep_alpha else "RGB")
+    if width and img.width > width:
+        img = img.resize((width, max(1, round(img.height * width / img.width))), Image.Resampling.LANCZOS)
+    save_image(img, target_path, fmt, settings)
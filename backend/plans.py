@@ -0,0 +1,28 @@
+"""Subscription plans: credits, limits and the processing pipeline of each.
+
+Kept apart from server.py so tools that can't start the API (no database),
+like benchmarks/bench_pipeline.py, run the same pipeline settings.
+"""
+# Plan limits - justifiés par coûts serveur
+# model = rembg model used for background removal (lighter for free, heavier for pro)
+# max_upload_mb = largest accepted upload, enforced while streaming it to disk
+# stages = processing pipeline, names registered in image_pipeline.STAGES
+# encoder = quality/effort per output format (results are stored as JPEG, WebP/AVIF made on request)
+ENCODER_SETTINGS = {
+    "free": {"jpeg": {"quality": 80}, "webp": {"quality": 75, "method": 4}, "avif": {"quality": 50, "speed": 8}, "png": {}},
+    "starter": {"jpeg": {"quality": 85}, "webp": {"quality": 80, "method": 5}, "avif": {"quality": 55, "speed": 7}, "png": {}},
+    "pro": {"jpeg": {"quality": 90}, "webp": {"quality": 86, "method": 6}, "avif": {"quality": 65, "speed": 6}, "png": {}},
+}
+STANDARD_STAGES = ["decode", "resize", "segment", "composite", "enhance", "encode"]
+WATERMARKED_STAGES = ["decode", "resize", "segment", "composite", "enhance", "watermark", "encode"]
+PLAN_LIMITS = {
+    "free": {"credits": 3, "quality": "720p", "priority": False, "watermark": True, "model": "u2netp", "max_upload_mb": 10, "stages": WATERMARKED_STAGES, "encoder": ENCODER_SETTINGS["free"]},
+    "starter": {"credits": 30, "quality": "1080p", "priority": False, "watermark": False, "model": "u2net", "max_upload_mb": 25, "stages": STANDARD_STAGES, "encoder": ENCODER_SETTINGS["starter"]},
+    "pro": {"credits": -1, "quality": "4K", "priority": True, "watermark": False, "model": "isnet-general-use", "max_upload_mb": 50, "stages": STANDARD_STAGES, "encoder": ENCODER_SETTINGS["pro"]}  # -1 = unlimited
+}
+# What clients see of a plan; models, stages and encoder settings stay internal
+PUBLIC_PLAN_FIELDS = ("credits", "quality", "priority", "watermark", "max_upload_mb")
+
+
+def public_plan_features(plan_info: dict) -> dict:
+    return {field: plan_info[field] for field in PUBLIC_PLAN_FIELDS}
@@ -0,0 +1,229 @@
+"""Opt-in sampling profiler for slow API requests.
+
+A background thread samples, every few milliseconds, the await chain of each
+profiled request's asyncio task: where it is suspended (waiting on Mongo, on a
+processing job...) or, when it is running, the synchronous frames above it.
+Samples are kept as collapsed stacks ("a;b;c 12" lines), the input format of
+flamegraph.pl and speedscope.
+
+ProfilingMiddleware profiles a random share of /api requests and/or every one
+of them while keeping only those slower than a threshold. It is only installed
+when one of the two is configured, so requests pay nothing when it's off.
+Artifacts go to a directory as <request_id>.folded plus <request_id>.json
+(metadata), newest max_files kept. request_id is always generated here and
+returned in the X-Profile-ID response header: a client's X-Request-ID is only
+recorded in the metadata, so a client can't overwrite another request's profile.
+"""
+import asyncio
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+
+# Shape of profile ids, and of the client X-Request-ID values kept in their metadata
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_qualname} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+class _Session:
+    """Samples of one request's task"""
+
+    def __init__(self, task: asyncio.Task, root_frame, loop_thread_id: int):
+        self.task = task
+        self.root_frame = root_frame
+        self.loop_thread_id = loop_thread_id
+        self.stacks: Counter = Counter()
+        self.samples = 0
+
+    def sample(self, thread_frames: Dict[int, object]) -> None:
+        # Coroutine frames from the task's root down to the innermost await
+        frames, awaited = [], self.task.get_coro()
+        while awaited is not None:
+            frame = getattr(awaited, "cr_frame", None) or getattr(awaited, "gi_frame", None)
+            if frame is None:
+                break
+            frames.append(frame)
+            # None while running: the chain then ends at the outermost coroutine
+            awaited = getattr(awaited, "cr_await", None) or getattr(awaited, "gi_yieldfrom", None)
+        if not frames:
+            return  # done or not started yet
+
+        # Running right now: add the plain function calls above the innermost coroutine
+        running, frame = [], thread_frames.get(self.loop_thread_id)
+        while frame is not None and frame is not frames[-1]:
+            running.append(frame)
+            frame = frame.f_back
+        leaf = []
+        if frame is not None:
+            frames.extend(reversed(running))
+        elif awaited is not None:
+            # asyncio.Future.__await__ returns a FutureIter
+            leaf = [f"<await {type(awaited).__name__.replace('FutureIter', 'Future')}>"]
+        if self.root_frame in frames:
+            # Only what runs below the middleware
+            frames = frames[frames.index(self.root_frame) + 1:]
+        labels = [_frame_label(frame) for frame in frames] + leaf
+        self.stacks[";".join(labels)] += 1
+        self.samples += 1
+
+
+class Sampler:
+    """One thread sampling every active session at a fixed interval; idle when there is none"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._sessions: set = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, task: asyncio.Task, root_frame) -> _Session:
+        session = _Session(task, root_frame, threading.get_ident())
+        with self._lock:
+            self._sessions.add(session)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+                self._thread.start()
+            self._wake.set()
+        return session
+
+    def stop(self, session: _Session) -> None:
+        with self._lock:
+            self._sessions.discard(session)
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait()
+            with self._lock:
+                sessions = list(self._sessions)
+                if not sessions:
+                    self._wake.clear()
+                    continue
+            thread_frames = sys._current_frames()
+            for session in sessions:
+                try:
+                    session.sample(thread_frames)
+                except Exception:
+                    pass  # a frame went away mid-walk, skip this sample
+            del thread_frames
+            time.sleep(self.interval)
+
+
+class ProfileStore:
+    def __init__(self, directory: Path, max_files: int):
+        self.directory = Path(directory)
+        self.max_files = max_files
+
+    def save(self, request_id: str, stacks: Counter, metadata: dict) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        folded = "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+        (self.directory / f"{request_id}.folded").write_text(folded)
+        # Metadata last: list() only shows complete profiles
+        (self.directory / f"{request_id}.json").write_text(json.dumps(metadata))
+        self._prune()
+
+    def _prune(self) -> None:
+        entries = sorted(self.directory.glob("*.json"), key=lambda path: path.stat().st_mtime)
+        for path in entries[:max(0, len(entries) - self.max_files)]:
+            path.unlink(missing_ok=True)
+            path.with_suffix(".folded").unlink(missing_ok=True)
+
+    def list(self, limit: int) -> List[dict]:
+        entries = sorted(self.directory.glob("*.json"), key=lambda path: path.stat().st_mtime, reverse=True)
+        profiles = []
+        for path in entries[:limit]:
+            try:
+                profiles.append(json.loads(path.read_text()))
+            except (OSError, ValueError):
+                continue  # pruned or half-written meanwhile
+        return profiles
+
+    def path(self, request_id: str) -> Optional[Path]:
+        if not REQUEST_ID_PATTERN.match(request_id):
+            return None
+        path = self.directory / f"{request_id}.folded"
+        return path if path.exists() else None
+
+
+class ProfilingMiddleware:
+    """Pure ASGI so it runs in the endpoint's own task; install it inside any BaseHTTPMiddleware"""
+
+    def __init__(
+        self,
+        app,
+        store: ProfileStore,
+        sample_rate: float = 0.0,
+        slow_ms: float = 0.0,
+        interval_ms: float = 5.0,
+        path_prefix: str = "/api/",
+        exclude_prefix: Optional[str] = None,
+    ):
+        self.app = app
+        self.store = store
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.path_prefix = path_prefix
+        self.exclude_prefix = exclude_prefix
+        self.sampler = Sampler(interval_ms / 1000)
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "")
+        if (
+            scope["type"] != "http"
+            or not path.startswith(self.path_prefix)
+            or (self.exclude_prefix and path.startswith(self.exclude_prefix))
+        ):
+            return await self.app(scope, receive, send)
+        sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        if not sampled and not self.slow_ms:
+            return await self.app(scope, receive, send)
+
+        request_id = f"req_{uuid.uuid4().hex[:16]}"
+        client_request_id = dict(scope.get("headers") or []).get(b"x-request-id", b"").decode("latin-1")
+        if not REQUEST_ID_PATTERN.match(client_request_id):
+            client_request_id = None
+        status = 500
+
+        async def send_with_profile_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message = {**message, "headers": [*message.get("headers", []), (b"x-profile-id", request_id.encode())]}
+            await send(message)
+
+        started_at = datetime.now(timezone.utc)
+        start = time.perf_counter()
+        session = self.sampler.start(asyncio.current_task(), sys._getframe())
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            self.sampler.stop(session)
+            duration_ms = (time.perf_counter() - start) * 1000
+            if sampled or duration_ms >= self.slow_ms:
+                route = scope.get("route")
+                metadata = {
+                    "request_id": request_id,
+                    "client_request_id": client_request_id,
+                    "method": scope["method"],
+                    "path": path,
+                    "route": route.path if route is not None else None,
+                    "status": status,
+                    "duration_ms": round(duration_ms, 2),
+                    "samples": session.samples,
+                    "interval_ms": self.sampler.interval * 1000,
+                    "trigger": "sample" if sampled else "slow",
+                    "started_at": started_at.isoformat(),
+                }
+                await asyncio.to_thread(self.store.save, request_id, session.stacks, metadata)
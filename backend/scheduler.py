@@ -0,0 +1,130 @@
+"""Plan-aware scheduling of processing jobs.
+
+Jobs are split into priority classes (plans with "priority": True in
+PLAN_LIMITS go to the "priority" class, everything else to "standard").
+Classes are served in strict order and each has its own size limit, so a
+spike of free traffic neither delays pro work nor fills the queue up in front
+of it. Inside a class, users share the processing slots through weighted
+fair queuing: each job gets a virtual finish tag and the smallest tag runs
+next, so one user uploading in a loop only gets their fair share.
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+PRIORITY_CLASSES = ("priority", "standard")
+
+# Recent waits kept per class for the percentile stats
+WAIT_SAMPLES = 1000
+
+
+def priority_class_for(plan_info: dict) -> str:
+    """Scheduling class of a plan (from PLAN_LIMITS)"""
+    return "priority" if plan_info.get("priority") else "standard"
+
+
+class _ClassQueue:
+    """Weighted fair queue of one priority class"""
+
+    def __init__(self):
+        self.heap: List[Tuple[float, int, float, str, Any]] = []
+        self.virtual_time = 0.0
+        self.last_finish: Dict[str, float] = {}
+        self.queued_per_user: Dict[str, int] = {}
+        self.dispatched = 0
+        self.waits: Deque[float] = deque(maxlen=WAIT_SAMPLES)
+        self.max_wait = 0.0
+
+    def push(self, seq: int, item: Any, user_id: str, weight: float, cost: float) -> None:
+        start = max(self.virtual_time, self.last_finish.get(user_id, 0.0))
+        finish = start + cost / weight
+        self.last_finish[user_id] = finish
+        self.queued_per_user[user_id] = self.queued_per_user.get(user_id, 0) + 1
+        heapq.heappush(self.heap, (finish, seq, time.monotonic(), user_id, item))
+
+    def pop(self) -> Any:
+        finish, _, enqueued, user_id, item = heapq.heappop(self.heap)
+        self.virtual_time = finish
+        remaining = self.queued_per_user[user_id] - 1
+        if remaining:
+            self.queued_per_user[user_id] = remaining
+        else:
+            del self.queued_per_user[user_id]
+            # An idle user with no credit left ahead of virtual time needs no bookkeeping
+            if self.last_finish.get(user_id, 0.0) <= self.virtual_time:
+                self.last_finish.pop(user_id, None)
+
+        wait = time.monotonic() - enqueued
+        self.dispatched += 1
+        self.waits.append(wait)
+        self.max_wait = max(self.max_wait, wait)
+        return item
+
+    def stats(self) -> dict:
+        waits = sorted(self.waits)
+
+        def percentile(p: float) -> float:
+            if not waits:
+                return 0.0
+            return round(waits[min(len(waits) - 1, int(p * len(waits)))], 4)
+
+        return {
+            "queue_depth": len(self.heap),
+            "queued_users": len(self.queued_per_user),
+            "dispatched": self.dispatched,
+            "wait_seconds": {
+                "p50": percentile(0.50),
+                "p95": percentile(0.95),
+                "p99": percentile(0.99),
+                "max": round(self.max_wait, 4),
+            },
+        }
+
+
+class FairScheduler:
+    """Strict priority between classes, weighted fair queuing across users within a class"""
+
+    def __init__(self, maxsize: int = 0):
+        # Per class: free traffic can't use up the room of priority jobs
+        self.maxsize = maxsize
+        self._classes = {name: _ClassQueue() for name in PRIORITY_CLASSES}
+        self._available = asyncio.Semaphore(0)
+        self._seq = itertools.count()
+        self._size = 0
+
+    def qsize(self, priority_class: Optional[str] = None) -> int:
+        """Queued items, of one class or in total"""
+        if priority_class is not None:
+            return len(self._classes[priority_class].heap)
+        return self._size
+
+    def put_nowait(
+        self, item: Any, user_id: str, priority_class: str = "standard", weight: float = 1.0, cost: float = 1.0
+    ) -> None:
+        """Queue an item; raises asyncio.QueueFull when its class holds maxsize items.
+
+        cost is the amount of work in the item (e.g. images in a batch), so a
+        batch of 8 uses up 8 turns of its user's fair share.
+        """
+        queue = self._classes[priority_class]
+        if self.maxsize and len(queue.heap) >= self.maxsize:
+            raise asyncio.QueueFull
+        queue.push(next(self._seq), item, user_id, weight, cost)
+        self._size += 1
+        self._available.release()
+
+    async def get(self) -> Any:
+        """Wait for the next item to dispatch"""
+        await self._available.acquire()
+        for name in PRIORITY_CLASSES:
+            queue = self._classes[name]
+            if queue.heap:
+                self._size -= 1
+                return queue.pop()
+        raise RuntimeError("scheduler semaphore out of sync with its queues")
+
+    def stats(self) -> dict:
+        return {name: queue.stats() for name, queue in self._classes.items()}
@@ -1,27 +1,49 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Request, Response, UploadFile, File, Depends
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, APIRouter, HTTPException, Request, Response, Depends
+from fastapi.responses import JSONResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional
+from typing import Dict, List, Optional, Set, Tuple
 import uuid
 from datetime import datetime, timezone, timedelta
 import httpx
 import base64
-import io
-from PIL import Image
+import hashlib
 import aiofiles
+import asyncio
+import json
+import contextlib
+import hmac
+import time
+import multiprocessing
+from dataclasses import dataclass, field
+from concurrent.futures import BrokenExecutor, Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+import image_pipeline
+import metrics
+from db_setup import ensure_indexes, migrate_string_dates, missing_indexes, parse_date
+from derivative_cache import DerivativeCache
+from file_responses import IMMUTABLE, cached_file_response
+from plans import PLAN_LIMITS, public_plan_features
+from profiling import ProfileStore, ProfilingMiddleware
+from scheduler import FairScheduler, priority_class_for
+from storage import locate, sharded_path, unlink_everywhere
+from ttl_cache import TTLCache
+from upload_stream import BodyTooLarge, MultipartFile, UploadError
+from usage import get_usage, record_usage
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, tz_aware=True, event_listeners=[metrics.MongoCommandListener()])
 db = client[os.environ['DB_NAME']]
 
 # Create the main app
@@ -36,6 +58,19 @@ PROCESSED_DIR = ROOT_DIR / "processed"
 UPLOAD_DIR.mkdir(exist_ok=True)
 PROCESSED_DIR.mkdir(exist_ok=True)
 
+# Resized variants served by /api/images/file, bounded LRU on disk
+DERIVATIVE_DIR = ROOT_DIR / "derivatives"
+DERIVATIVE_CACHE_MB = int(os.environ.get('DERIVATIVE_CACHE_MB', 1024))
+# Requested widths are rounded up to one of these so the cache isn't fragmented,
+# and capped at the largest: wider requests get the 1920px variant
+DERIVATIVE_WIDTHS = (64, 128, 256, 320, 480, 640, 800, 1024, 1280, 1600, 1920)
+derivative_cache = DerivativeCache(DERIVATIVE_DIR, DERIVATIVE_CACHE_MB * 1024 * 1024)
+
+# Uploads are copied to UPLOAD_DIR in chunks of this size, never read whole into memory
+UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', 1024 * 1024))
+# Multipart framing allowed on top of the file itself
+UPLOAD_OVERHEAD_BYTES = 64 * 1024
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -53,13 +88,6 @@ class User(BaseModel):
     created_at: datetime
     last_credit_reset: datetime
 
-# Plan limits - justifiés par coûts serveur
-PLAN_LIMITS = {
-    "free": {"credits": 3, "quality": "720p", "priority": False, "watermark": True},
-    "starter": {"credits": 30, "quality": "1080p", "priority": False, "watermark": False},
-    "pro": {"credits": -1, "quality": "4K", "priority": True, "watermark": False}  # -1 = unlimited
-}
-
 class UserSession(BaseModel):
     model_config = ConfigDict(extra="ignore")
     user_id: str
@@ -74,7 +102,17 @@ class ImageRecord(BaseModel):
     original_filename: str
     original_path: str
     processed_path: Optional[str] = None
+    content_hash: Optional[str] = None  # sha256 of the original upload
+    size_bytes: Optional[int] = None
+    original_blob: Optional[str] = None  # db.blobs keys, None for records stored before dedup
+    processed_blob: Optional[str] = None
     status: str = "pending"  # pending, processing, completed, failed
+    job_id: Optional[str] = None
+    lease_expires_at: Optional[datetime] = None  # while queued/running, renewed by the owning API process
+    reserved_credits: Optional[int] = None  # taken when queued, refunded if the job never finishes
+    error: Optional[str] = None
+    stage_timings: Optional[dict] = None  # {stage: {"wall_ms", "cpu_ms"}} of the last run
+    processed_plan: Optional[str] = None  # plan whose encoder settings apply to this result
     created_at: datetime
     processed_at: Optional[datetime] = None
 
@@ -96,6 +134,19 @@ class UserProfile(BaseModel):
 
 # ==================== AUTH HELPERS ====================
 
+# Resolved sessions (token -> (user_id, expires_at)) and users (user_id -> User), so the
+# common authenticated request costs no DB round trip. Writes to a user/session in this
+# process invalidate their entry, and a lookup still running then isn't cached; writes
+# from other API processes show up after the TTL.
+AUTH_CACHE_SIZE = int(os.environ.get('AUTH_CACHE_SIZE', 10000))
+AUTH_CACHE_TTL_SECONDS = float(os.environ.get('AUTH_CACHE_TTL_SECONDS', 30))
+session_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL_SECONDS)
+user_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL_SECONDS)
+
+def invalidate_user(user_id: str) -> None:
+    """Drop a cached user after writing to its document (plan, credits, profile)"""
+    user_cache.invalidate(user_id)
+
 async def get_current_user(request: Request) -> User:
     """Get current user from session token (cookie or header)"""
     session_token = request.cookies.get("session_token")
@@ -107,39 +158,42 @@ async def get_current_user(request: Request) -> User:
     if not session_token:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    session_doc = await db.user_sessions.find_one({"session_token": session_token}, {"_id": 0})
-    if not session_doc:
-        raise HTTPException(status_code=401, detail="Invalid session")
+    session = session_cache.get(session_token)
+    if session is None:
+        generation = session_cache.generation
+        session_doc = await db.user_sessions.find_one({"session_token": session_token}, {"_id": 0})
+        if not session_doc:
+            raise HTTPException(status_code=401, detail="Invalid session")
+        
+        # Check expiry with timezone awareness (ISO string in documents not migrated yet)
+        session = (session_doc["user_id"], parse_date(session_doc["expires_at"]))
+        session_cache.set(session_token, session, generation)
     
-    # Check expiry with timezone awareness
-    expires_at = session_doc["expires_at"]
-    if isinstance(expires_at, str):
-        expires_at = datetime.fromisoformat(expires_at)
-    if expires_at.tzinfo is None:
-        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    user_id, expires_at = session
     if expires_at < datetime.now(timezone.utc):
+        session_cache.invalidate(session_token)
         raise HTTPException(status_code=401, detail="Session expired")
     
-    user_doc = await db.users.find_one({"user_id": session_doc["user_id"]}, {"_id": 0})
-    if not user_doc:
-        raise HTTPException(status_code=401, detail="User not found")
-    
-    # Convert datetime strings back to datetime objects
-    if isinstance(user_doc.get('created_at'), str):
-        user_doc['created_at'] = datetime.fromisoformat(user_doc['created_at'])
-    if isinstance(user_doc.get('last_credit_reset'), str):
-        user_doc['last_credit_reset'] = datetime.fromisoformat(user_doc['last_credit_reset'])
+    user = user_cache.get(user_id)
+    if user is None:
+        generation = user_cache.generation
+        user_doc = await db.users.find_one({"user_id": user_id}, {"_id": 0})
+        if not user_doc:
+            raise HTTPException(status_code=401, detail="User not found")
+        
+        # Dates are BSON dates, or ISO strings in documents not migrated yet
+        user_doc['created_at'] = parse_date(user_doc.get('created_at'))
+        user_doc['last_credit_reset'] = parse_date(user_doc.get('last_credit_reset'))
+        user = User(**user_doc)
+        user_cache.set(user_id, user, generation)
     
-    return User(**user_doc)
+    # Handlers modify the user they get (e.g. the monthly credit reset), never the cached one
+    return user.model_copy()
 
 async def check_and_reset_monthly_credits(user: User) -> User:
     """Reset credits if a new month has started"""
     now = datetime.now(timezone.utc)
-    last_reset = user.last_credit_reset
-    if isinstance(last_reset, str):
-        last_reset = datetime.fromisoformat(last_reset)
-    if last_reset.tzinfo is None:
-        last_reset = last_reset.replace(tzinfo=timezone.utc)
+    last_reset = parse_date(user.last_credit_reset)
     
     if now.month != last_reset.month or now.year != last_reset.year:
         # Reset credits based on plan
@@ -147,12 +201,121 @@ async def check_and_reset_monthly_credits(user: User) -> User:
         if plan_credits != -1:  # Don't reset unlimited plans
             await db.users.update_one(
                 {"user_id": user.user_id},
-                {"$set": {"credits": plan_credits, "last_credit_reset": now.isoformat()}}
+                {"$set": {"credits": plan_credits, "last_credit_reset": now}}
             )
+            invalidate_user(user.user_id)
             user.credits = plan_credits
             user.last_credit_reset = now
     return user
 
+# ==================== METRICS ====================
+
+# Served by /metrics, per process like the processing queue itself
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # when set, scrapes need "Authorization: Bearer <token>"
+
+def has_bearer_token(request: Request, token: str) -> bool:
+    """Constant-time check of "Authorization: Bearer <token>" (as bytes: headers needn't be ASCII)"""
+    return hmac.compare_digest(request.headers.get("authorization", "").encode(), f"Bearer {token}".encode())
+
+def require_metrics_token(request: Request) -> None:
+    """Guards /metrics and /api/processing/stats when METRICS_TOKEN is set"""
+    if METRICS_TOKEN and not has_bearer_token(request, METRICS_TOKEN):
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+http_request_seconds = metrics.histogram(
+    "http_request_duration_seconds",
+    "API request latency until the response starts, by route template",
+    ("method", "route", "status"),
+)
+stage_seconds = metrics.histogram(
+    "processing_stage_duration_seconds",
+    "Wall time of one pipeline stage for one image",
+    ("stage", "plan"),
+)
+stage_cpu_seconds = metrics.counter(
+    "processing_stage_cpu_seconds_total",
+    "CPU time spent in each pipeline stage (worker thread only with PROCESSING_EXECUTOR=thread)",
+    ("stage", "plan"),
+)
+processed_images = metrics.counter(
+    "processing_images_total",
+    "Images run through the pipeline, by outcome",
+    ("plan", "outcome"),
+)
+jobs_in_flight = metrics.gauge(
+    "processing_jobs_in_flight",
+    "Processing jobs currently running in the executor",
+)
+metrics.gauge(
+    "processing_queue_depth",
+    "Processing jobs waiting for a worker, by priority class",
+    ("class",),
+    callback=lambda: [((name,), stats["queue_depth"]) for name, stats in processing_queue.stats().items()],
+)
+metrics.gauge(
+    "processing_active_images",
+    "Images queued or running in this process",
+    callback=lambda: [((), len(active_jobs))],
+)
+credit_rejections = metrics.counter(
+    "credit_rejections_total",
+    "Requests refused for lack of credits",
+    ("plan", "endpoint"),
+)
+upload_bytes = metrics.histogram(
+    "upload_size_bytes",
+    "Size of accepted uploads",
+    ("plan",),
+    metrics.SIZE_BUCKETS,
+)
+processed_bytes = metrics.histogram(
+    "processed_size_bytes",
+    "Size of processed results",
+    ("plan",),
+    metrics.SIZE_BUCKETS,
+)
+
+def record_stage_timings(plan: str, results: List[dict]) -> None:
+    for result in results:
+        processed_images.inc(plan, "failed" if result["error"] else "completed")
+        for stage, timing in result["timings"].items():
+            stage_seconds.observe(timing["wall_ms"] / 1000, stage, plan)
+            stage_cpu_seconds.inc(stage, plan, amount=timing["cpu_ms"] / 1000)
+
+# ==================== CREDITS ====================
+
+# Credits are reserved (taken) before any work starts and refunded for images that
+# end up not being processed, so concurrent requests of one user can never spend
+# more than they have and need no per-user lock. Unlimited plans skip all of it.
+
+async def reserve_credits(user: User, count: int) -> bool:
+    """Atomically take count credits if the user still has them; False when they don't"""
+    plan_info = PLAN_LIMITS.get(user.subscription, PLAN_LIMITS["free"])
+    if plan_info["credits"] == -1 or count <= 0:
+        return True
+    user_doc = await db.users.find_one_and_update(
+        {"user_id": user.user_id, "credits": {"$gte": count}},
+        {"$inc": {"credits": -count}},
+        projection={"credits": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    invalidate_user(user.user_id)
+    if user_doc is None:
+        return False
+    user.credits = user_doc["credits"]
+    return True
+
+async def refund_credits(user_id: str, count: int) -> None:
+    """Give back reserved credits of images that were not processed"""
+    if count <= 0:
+        return
+    await db.users.update_one({"user_id": user_id}, {"$inc": {"credits": count}})
+    invalidate_user(user_id)
+
+def credits_per_image(user: User) -> int:
+    """Credits reserved for each image: 0 on unlimited plans"""
+    return 0 if PLAN_LIMITS.get(user.subscription, PLAN_LIMITS["free"])["credits"] == -1 else 1
+
 # ==================== AUTH ENDPOINTS ====================
 
 @api_router.post("/auth/session")
@@ -187,6 +350,7 @@ async def create_session(request: Request, response: Response):
             {"user_id": user_id},
             {"$set": {"name": user_data["name"], "picture": user_data.get("picture")}}
         )
+        invalidate_user(user_id)
     else:
         # Create new user with 3 free credits (frustrant mais utile)
         new_user = {
@@ -196,8 +360,8 @@ async def create_session(request: Request, response: Response):
             "picture": user_data.get("picture"),
             "credits": 3,
             "subscription": "free",
-            "created_at": now.isoformat(),
-            "last_credit_reset": now.isoformat()
+            "created_at": now,
+            "last_credit_reset": now
         }
         await db.users.insert_one(new_user)
     
@@ -205,13 +369,13 @@ async def create_session(request: Request, response: Response):
     session_token = user_data.get("session_token", f"session_{uuid.uuid4().hex}")
     expires_at = now + timedelta(days=7)
     
-    session_doc = {
-        "user_id": user_id,
-        "session_token": session_token,
-        "expires_at": expires_at.isoformat(),
-        "created_at": now.isoformat()
-    }
-    await db.user_sessions.insert_one(session_doc)
+    # Upsert: session_token is unique, and the same token may be exchanged again
+    await db.user_sessions.update_one(
+        {"session_token": session_token},
+        {"$set": {"user_id": user_id, "expires_at": expires_at}, "$setOnInsert": {"created_at": now}},
+        upsert=True
+    )
+    session_cache.invalidate(session_token)
     
     # Set httpOnly cookie
     response.set_cookie(
@@ -233,13 +397,8 @@ async def get_current_user_info(user: User = Depends(get_current_user)):
     """Get current authenticated user info"""
     user = await check_and_reset_monthly_credits(user)
     
-    # Count images this month
-    now = datetime.now(timezone.utc)
-    start_of_month = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    images_count = await db.images.count_documents({
-        "user_id": user.user_id,
-        "created_at": {"$gte": start_of_month.isoformat()}
-    })
+    # Images this month, from the user's usage counters
+    usage = await get_usage(db, user.user_id, datetime.now(timezone.utc))
     
     # Get plan limits
     plan_info = PLAN_LIMITS.get(user.subscription, PLAN_LIMITS["free"])
@@ -252,7 +411,7 @@ async def get_current_user_info(user: User = Depends(get_current_user)):
         "credits": user.credits if plan_info["credits"] != -1 else -1,
         "max_credits": plan_info["credits"],
         "subscription": user.subscription,
-        "images_this_month": images_count,
+        "images_this_month": usage["images_this_month"],
         "plan_features": {
             "quality": plan_info["quality"],
             "priority": plan_info["priority"],
@@ -266,54 +425,594 @@ async def logout(request: Request, response: Response):
     session_token = request.cookies.get("session_token")
     if session_token:
         await db.user_sessions.delete_one({"session_token": session_token})
+        session_cache.invalidate(session_token)
     
     response.delete_cookie(key="session_token", path="/")
     return {"message": "Logged out successfully"}
 
+# Processing executor - rembg/PIL work never runs on the event loop
+PROCESSING_EXECUTOR = os.environ.get('PROCESSING_EXECUTOR', 'process')  # process or thread
+PROCESSING_WORKERS = int(os.environ.get('PROCESSING_WORKERS', os.cpu_count() or 1))
+PROCESSING_MODELS = sorted({plan["model"] for plan in PLAN_LIMITS.values()})
+# onnxruntime threads per worker: the workers split the cores instead of each starting one thread per core
+ONNX_THREADS_PER_WORKER = int(os.environ.get(
+    'ONNX_THREADS_PER_WORKER', max(1, (os.cpu_count() or 1) // PROCESSING_WORKERS)
+))
+
+def create_processing_executor() -> Executor:
+    """Build the pool that runs the image pipeline (see image_pipeline.py).
+
+    Models are loaded lazily per worker, on its first job of a plan (or by warm_up()).
+    """
+    if PROCESSING_EXECUTOR == "thread":
+        # Threads share one session registry, and concurrent runs share its thread pool
+        image_pipeline.configure(ONNX_THREADS_PER_WORKER)
+        return ThreadPoolExecutor(max_workers=PROCESSING_WORKERS, thread_name_prefix="processing")
+    # spawn: workers must not inherit the Mongo client / onnxruntime threads of the API process
+    return ProcessPoolExecutor(
+        max_workers=PROCESSING_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=image_pipeline.configure,
+        initargs=(ONNX_THREADS_PER_WORKER, True)
+    )
+
+processing_executor = create_processing_executor()
+
+async def run_in_processing_executor(func, *args):
+    """run_in_executor on the processing pool, replacing the pool once it is broken.
+
+    A worker killed mid-job (e.g. OOM) breaks a ProcessPoolExecutor for good: the
+    calls in flight fail, the next ones get a fresh pool.
+    """
+    global processing_executor
+    executor = processing_executor
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+    except BrokenExecutor:
+        if processing_executor is executor:
+            logger.error("Processing pool broken, starting a new one")
+            processing_executor = create_processing_executor()
+            executor.shutdown(wait=False, cancel_futures=True)
+        raise
+
+# ==================== STORAGE ====================
+
+# Originals and results are content-addressed: one file per distinct blob, shared by
+# every image record that points at it. db.blobs keeps a reference count per blob_key
+# ("original:<sha256 of upload>" / "processed:<sha256 of input hash + pipeline>").
+# Files are sharded into subdirectories (see storage.py); records may still hold
+# pre-sharding paths until `python storage.py` has run, so stored paths are read
+# through locate().
+
+# Images no job has claimed: a pending image with a job_id is queued in some API process
+UNCLAIMED = {"$or": [{"status": "failed"}, {"status": "pending", "job_id": None}]}
+
+def processed_blob_key(image_doc: dict, plan_info: dict) -> Optional[str]:
+    """Dedup key of the result this plan would produce, None for records without a content hash"""
+    if not image_doc.get("content_hash"):
+        return None
+    signature = image_pipeline.pipeline_signature(
+        plan_info["model"], plan_info["quality"], plan_info["stages"], plan_info["encoder"]
+    )
+    digest = hashlib.sha256(f"{image_doc['content_hash']}|{signature}".encode()).hexdigest()
+    return f"processed:{digest}"
+
+def processed_blob_path(blob_key: Optional[str], image_id: str) -> Path:
+    if blob_key is None:
+        return sharded_path(PROCESSED_DIR, f"{image_id}_processed.jpg")
+    return sharded_path(PROCESSED_DIR, f"{blob_key.split(':', 1)[1]}.jpg")
+
+# A blob whose file is being removed carries deleting_at (a tombstone) until its doc
+# is deleted. Acquires wait for that, so no file is put in place and then unlinked.
+# A tombstone older than this was left by a process that died mid-release.
+BLOB_TOMBSTONE_SECONDS = 60
+
+async def acquire_blob(blob_key: str, path: Path) -> dict:
+    """Add a reference to a blob, registering it at path if it's new. Returns the blob doc."""
+    while True:
+        now = datetime.now(timezone.utc)
+        try:
+            return await db.blobs.find_one_and_update(
+                {"blob_key": blob_key, "deleting_at": None},
+                {"$inc": {"refcount": 1}, "$setOnInsert": {"path": str(path), "created_at": now}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+                projection={"_id": 0}
+            )
+        except DuplicateKeyError:
+            # Tombstoned: wait for its release to finish
+            await db.blobs.delete_one({
+                "blob_key": blob_key, "deleting_at": {"$lt": now - timedelta(seconds=BLOB_TOMBSTONE_SECONDS)}
+            })
+            await asyncio.sleep(0.01)
+
+async def release_blob(blob_key: str) -> None:
+    """Drop a reference; the file is removed once nobody uses it"""
+    blob = await db.blobs.find_one_and_update(
+        {"blob_key": blob_key, "deleting_at": None},
+        {"$inc": {"refcount": -1}},
+        return_document=ReturnDocument.AFTER
+    )
+    if not blob or blob["refcount"] > 0:
+        return
+    # Only the caller that sets the tombstone unlinks; a concurrent acquire may have revived the blob
+    tombstone = await db.blobs.find_one_and_update(
+        {"blob_key": blob_key, "refcount": {"$lte": 0}, "deleting_at": None},
+        {"$set": {"deleting_at": datetime.now(timezone.utc)}}
+    )
+    if tombstone:
+        unlink_everywhere(tombstone["path"])
+        await db.blobs.delete_one({"_id": tombstone["_id"]})
+
+async def store_original(tmp_path: Path, content_hash: str, ext: str) -> Tuple[str, Path]:
+    """Move a freshly uploaded file into content-addressed storage"""
+    blob_key = f"original:{content_hash}"
+    # Register the reference before the file lands so a concurrent release can't unlink it
+    # (an acquire waits until a release in progress has removed the old file)
+    blob = await acquire_blob(blob_key, sharded_path(UPLOAD_DIR, f"{content_hash}.{ext}"))
+    path = locate(blob["path"])
+    if blob["refcount"] > 1 and path.exists():
+        tmp_path.unlink(missing_ok=True)  # same bytes already stored
+    else:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp_path, path)
+    return blob_key, path
+
+async def reuse_processed_results(image_docs: List[dict], user: User) -> Tuple[List[dict], List[str]]:
+    """Complete images whose result already exists (same input + pipeline) without inference.
+
+    Callers reserve a credit per image beforehand; a reused image keeps its credit.
+
+    Returns (images that still need processing, image_ids completed from existing results).
+    """
+    plan_info = PLAN_LIMITS.get(user.subscription, PLAN_LIMITS["free"])
+    keys = {doc["image_id"]: processed_blob_key(doc, plan_info) for doc in image_docs}
+    wanted = [key for key in keys.values() if key]
+    if not wanted:
+        return image_docs, []
+    existing = {
+        blob["blob_key"]: blob
+        for blob in await db.blobs.find({"blob_key": {"$in": wanted}}, {"_id": 0}).to_list(len(wanted))
+        if locate(blob["path"]).exists()
+    }
+    
+    remaining, reused = [], []
+    now = datetime.now(timezone.utc)
+    for doc in image_docs:
+        blob = existing.get(keys[doc["image_id"]])
+        if blob is None:
+            remaining.append(doc)
+            continue
+        blob = await acquire_blob(blob["blob_key"], Path(blob["path"]))
+        if not locate(blob["path"]).exists():
+            # Released and removed since the lookup above
+            await release_blob(blob["blob_key"])
+            remaining.append(doc)
+            continue
+        result = await db.images.update_one(
+            {"image_id": doc["image_id"], **UNCLAIMED},
+            {"$set": {
+                "processed_path": str(locate(blob["path"])),
+                "processed_blob": blob["blob_key"],
+                "status": "completed",
+                "processed_at": now,
+                "processed_plan": user.subscription,
+                "error": None
+            }}
+        )
+        if result.modified_count:
+            reused.append(doc["image_id"])
+        else:
+            await release_blob(blob["blob_key"])  # a concurrent request got there first
+    return remaining, reused
+
+# ==================== PROCESSING QUEUE ====================
+
+# Jobs waiting for a processing slot, per priority class; when full, new work is rejected with 503
+PROCESSING_QUEUE_SIZE = int(os.environ.get('PROCESSING_QUEUE_SIZE', 1000))
+# Seconds between SSE keep-alive comments
+SSE_HEARTBEAT_SECONDS = float(os.environ.get('SSE_HEARTBEAT_SECONDS', 15))
+
+# Images per executor call; a batch request is split into chunks of this size
+PROCESSING_BATCH_SIZE = int(os.environ.get('PROCESSING_BATCH_SIZE', 8))
+# Max image_ids accepted by /api/images/process-batch
+PROCESSING_BATCH_MAX = int(os.environ.get('PROCESSING_BATCH_MAX', 50))
+
+# Queued/running images hold a lease their API process renews every third of it.
+# Once it runs out (process crashed or redeployed) any process fails the image and
+# refunds its credits, so it can be processed again.
+PROCESSING_LEASE_SECONDS = float(os.environ.get('PROCESSING_LEASE_SECONDS', 60))
+
+@dataclass
+class ProcessingJob:
+    """One chunk of work for the executor. A batch request shares its job_id across chunks."""
+    job_id: str
+    user_id: str
+    subscription: str
+    images: List[dict]  # {"image_id", "original_path", "processed_blob", "credits"}
+    future: asyncio.Future  # resolves to {image_id: error message or None}
+    enqueued_at: datetime = field(default_factory=lambda: datetime.now(timezone.utc))
+
+# Priority classes come from PLAN_LIMITS["priority"], users share a class fairly
+processing_queue = FairScheduler(maxsize=PROCESSING_QUEUE_SIZE)
+# Jobs queued or running in this API process, by image_id
+active_jobs: Dict[str, ProcessingJob] = {}
+# SSE subscribers per user_id (events only reach clients connected to this process)
+job_subscribers: Dict[str, Set[asyncio.Queue]] = {}
+processing_worker_tasks: List[asyncio.Task] = []
+
+def publish_job_event(user_id: str, event: dict) -> None:
+    """Push a job status event to every SSE stream of this user"""
+    for queue in job_subscribers.get(user_id, set()):
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            pass  # slow client, it can still poll /api/images/jobs/{job_id}
+
+def publish_image_status(job: ProcessingJob, image_id: str, status: str, error: Optional[str] = None) -> None:
+    event = {"job_id": job.job_id, "image_id": image_id, "status": status}
+    if status == "completed":
+        event["processed_url"] = f"/api/images/file/{image_id}/processed"
+    if error:
+        event["error"] = error
+    publish_job_event(job.user_id, event)
+
+def release_jobs(jobs: List[ProcessingJob]) -> None:
+    for job in jobs:
+        for img in job.images:
+            if active_jobs.get(img["image_id"]) is job:
+                del active_jobs[img["image_id"]]
+
+def lease_expiry() -> datetime:
+    return datetime.now(timezone.utc) + timedelta(seconds=PROCESSING_LEASE_SECONDS)
+
+async def recover_stale_images() -> int:
+    """Fail images whose lease ran out and refund their reserved credits. Returns how many"""
+    now = datetime.now(timezone.utc)
+    stale = {"$or": [
+        {"status": {"$in": ["pending", "processing"]}, "lease_expires_at": {"$lt": now}},
+        # Claimed before leases existed
+        {"status": "processing", "lease_expires_at": None},
+        {"status": "pending", "lease_expires_at": None, "job_id": {"$ne": None}},
+    ]}
+    docs = await db.images.find(stale, {"_id": 0, "image_id": 1, "user_id": 1, "reserved_credits": 1}).to_list(None)
+    recovered, refunds = 0, {}
+    for doc in docs:
+        # Conditional: the owner may have renewed the lease or finished meanwhile
+        result = await db.images.update_one(
+            {"image_id": doc["image_id"], **stale},
+            {"$set": {"status": "failed", "error": "Processing was interrupted, retry"},
+             "$unset": {"lease_expires_at": "", "reserved_credits": ""}}
+        )
+        if result.modified_count:
+            recovered += 1
+            refunds[doc["user_id"]] = refunds.get(doc["user_id"], 0) + (doc.get("reserved_credits") or 0)
+    for user_id, count in refunds.items():
+        await refund_credits(user_id, count)
+    return recovered
+
+async def maintain_processing_leases() -> None:
+    """Renew the leases of this process's images, and recover those of dead processes"""
+    while True:
+        try:
+            if active_jobs:
+                await db.images.update_many(
+                    {"image_id": {"$in": list(active_jobs)}, "status": {"$in": ["pending", "processing"]}},
+                    {"$set": {"lease_expires_at": lease_expiry()}}
+                )
+            recovered = await recover_stale_images()
+            if recovered:
+                logger.warning(f"Recovered {recovered} images left queued by a stopped process")
+        except Exception as e:
+            logger.error(f"Processing lease maintenance failed: {str(e)}")
+        await asyncio.sleep(PROCESSING_LEASE_SECONDS / 3)
+
+async def enqueue_processing_jobs(
+    image_docs: List[dict], user: User
+) -> Tuple[str, List[ProcessingJob], List[str]]:
+    """Queue images under one job id, in chunks of PROCESSING_BATCH_SIZE.
+
+    Images already queued or running in this process are left alone; the caller
+    finds their job in active_jobs. The caller has reserved their credits and
+    refunds the ones of images that don't end up in a returned job.
+
+    Returns (job_id, queued jobs, image_ids rejected because the queue filled up);
+    raises 503 when the queue had room for none of them.
+    """
+    job_id = f"job_{uuid.uuid4().hex[:12]}"
+    plan_info = PLAN_LIMITS.get(user.subscription, PLAN_LIMITS["free"])
+    loop = asyncio.get_running_loop()
+    
+    candidates = [doc for doc in image_docs if doc["image_id"] not in active_jobs]
+    jobs = []
+    for start in range(0, len(candidates), PROCESSING_BATCH_SIZE):
+        chunk = candidates[start:start + PROCESSING_BATCH_SIZE]
+        job = ProcessingJob(
+            job_id=job_id,
+            user_id=user.user_id,
+            subscription=user.subscription,
+            images=[
+                {
+                    "image_id": doc["image_id"],
+                    "original_path": doc["original_path"],
+                    "processed_blob": processed_blob_key(doc, plan_info),
+                    "credits": credits_per_image(user)
+                }
+                for doc in chunk
+            ],
+            future=loop.create_future()
+        )
+        # Job mode never awaits the future, don't let asyncio log its exception as unretrieved
+        job.future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        jobs.append(job)
+        # Reserved before the first await so a concurrent request can't queue the same image
+        for img in job.images:
+            active_jobs[img["image_id"]] = job
+    if not jobs:
+        return job_id, [], []
+    
+    priority_class = priority_class_for(plan_info)
+    if processing_queue.maxsize and processing_queue.qsize(priority_class) + len(jobs) > processing_queue.maxsize:
+        release_jobs(jobs)
+        raise HTTPException(status_code=503, detail="Processing queue is full, retry in a moment")
+    
+    # Claim the records; another API process may have queued some of them already
+    image_ids = [img["image_id"] for job in jobs for img in job.images]
+    await db.images.update_many(
+        {"image_id": {"$in": image_ids}, **UNCLAIMED},
+        {"$set": {
+            "status": "pending",
+            "job_id": job_id,
+            "error": None,
+            "lease_expires_at": lease_expiry(),
+            "reserved_credits": credits_per_image(user)
+        }}
+    )
+    claimed = {
+        doc["image_id"]
+        for doc in await db.images.find({"job_id": job_id}, {"_id": 0, "image_id": 1}).to_list(len(image_ids))
+    }
+    
+    queued, rejected = [], []
+    for job in jobs:
+        for img in job.images:
+            if img["image_id"] not in claimed:
+                del active_jobs[img["image_id"]]
+        job.images = [img for img in job.images if img["image_id"] in claimed]
+        if not job.images:
+            job.future.set_result({})
+            continue
+        try:
+            processing_queue.put_nowait(
+                job,
+                user_id=user.user_id,
+                priority_class=priority_class,
+                cost=len(job.images)
+            )
+        except asyncio.QueueFull:
+            # Filled up by a concurrent request while we were claiming: unclaim, the caller refunds
+            ids = [img["image_id"] for img in job.images]
+            await db.images.update_many(
+                {"image_id": {"$in": ids}, "job_id": job_id},
+                {"$set": {"job_id": None}, "$unset": {"lease_expires_at": "", "reserved_credits": ""}}
+            )
+            release_jobs([job])
+            job.future.set_result({image_id: "Processing queue is full" for image_id in ids})
+            rejected.extend(ids)
+            continue
+        queued.append(job)
+        for img in job.images:
+            publish_image_status(job, img["image_id"], "pending")
+    if rejected and not queued:
+        raise HTTPException(status_code=503, detail="Processing queue is full, retry in a moment")
+    return job_id, queued, rejected
+
+async def run_processing_job(job: ProcessingJob) -> None:
+    """Run one chunk through the executor and record the outcome with bulk writes"""
+    plan_info = PLAN_LIMITS.get(job.subscription, PLAN_LIMITS["free"])
+    image_ids = [img["image_id"] for img in job.images]
+    processed_paths = [processed_blob_path(img["processed_blob"], img["image_id"]) for img in job.images]
+    # Identical uploads in one chunk share an output, run each distinct one once
+    pairs = [(str(locate(img["original_path"])), str(path)) for img, path in zip(job.images, processed_paths)]
+    unique = list(dict.fromkeys(pairs))
+    # image_ids holding a reference to their result blob
+    referenced: Set[str] = set()
+    jobs_in_flight.inc()
+    try:
+        for directory in {path.parent for path in processed_paths}:
+            directory.mkdir(parents=True, exist_ok=True)
+        # Reference the results before they are written, so a concurrent release of the
+        # same blob can't unlink the new file
+        for img, processed_path in zip(job.images, processed_paths):
+            if img["processed_blob"]:
+                await acquire_blob(img["processed_blob"], processed_path)
+                referenced.add(img["image_id"])
+        await db.images.update_many(
+            {"image_id": {"$in": image_ids}},
+            {"$set": {"status": "processing", "lease_expires_at": lease_expiry()}}
+        )
+        for image_id in image_ids:
+            publish_image_status(job, image_id, "processing")
+        
+        # One batched run of the plan's stages in the pool
+        unique_results = await run_in_processing_executor(
+            image_pipeline.process_images,
+            unique,
+            plan_info["model"],
+            plan_info["quality"],
+            plan_info["stages"],
+            plan_info["encoder"]
+        )
+        results_by_pair = dict(zip(unique, unique_results))
+        results = [results_by_pair[pair] for pair in pairs]
+    except Exception as e:
+        results = [{"error": str(e), "timings": {}}] * len(image_ids)
+    finally:
+        jobs_in_flight.dec()
+    errors = [result["error"] for result in results]
+    record_stage_timings(job.subscription, results)
+    
+    try:
+        now = datetime.now(timezone.utc)
+        updates, completions = [], []
+        for img, processed_path, result in zip(job.images, processed_paths, results):
+            if result["error"]:
+                logger.error(f"Error processing image {img['image_id']}: {result['error']}")
+                updates.append(UpdateOne({"image_id": img["image_id"]}, {"$set": {
+                    "status": "failed",
+                    "error": result["error"],
+                    "stage_timings": result["timings"]
+                }}))
+                continue
+            with contextlib.suppress(OSError):
+                processed_bytes.observe(processed_path.stat().st_size, job.subscription)
+            completion = {"$set": {
+                "processed_path": str(processed_path),
+                "processed_blob": img["processed_blob"],
+                "status": "completed",
+                "processed_at": now,
+                "processed_plan": job.subscription,
+                "stage_timings": result["timings"]
+            }}
+            if img["image_id"] in referenced:
+                # Written on its own: whether it finds the record decides who drops the reference
+                completions.append((img, completion))
+            else:
+                updates.append(UpdateOne({"image_id": img["image_id"]}, completion))
+        if updates:
+            await db.images.bulk_write(updates, ordered=False)
+        written = await asyncio.gather(*(
+            db.images.update_one({"image_id": img["image_id"]}, completion) for img, completion in completions
+        ))
+        for (img, _), result in zip(completions, written):
+            if not result.matched_count:
+                # Deleted while it was processed; later deletes release through the record
+                await release_blob(img["processed_blob"])
+        for img, error in zip(job.images, errors):
+            if error and img["image_id"] in referenced:
+                await release_blob(img["processed_blob"])
+        
+        # Credits were reserved at enqueue time, give back the failed images' ones
+        await refund_credits(
+            job.user_id,
+            sum(img["credits"] for img, error in zip(job.images, errors) if error)
+        )
+        
+        for image_id, error in zip(image_ids, errors):
+            publish_image_status(job, image_id, "failed" if error else "completed", error)
+        job.future.set_result(dict(zip(image_ids, errors)))
+    except Exception as e:
+        logger.error(f"Error recording job {job.job_id}: {str(e)}")
+        job.future.set_exception(e)
+    finally:
+        release_jobs([job])
+
+async def processing_worker() -> None:
+    """Consume the processing queue; one worker per executor slot keeps the pool busy"""
+    while True:
+        job = await processing_queue.get()
+        try:
+            await run_processing_job(job)
+        except Exception as e:
+            logger.error(f"Processing worker error on job {job.job_id}: {str(e)}")
+
 # ==================== IMAGE ENDPOINTS ====================
 
-@api_router.post("/images/upload")
-async def upload_image(file: UploadFile = File(...), user: User = Depends(get_current_user)):
-    """Upload an image for processing"""
+UPLOAD_TYPES = ["image/jpeg", "image/png", "image/webp", "image/heic", "image/heif"]
+
+@api_router.post("/images/upload", openapi_extra={"requestBody": {"required": True, "content": {
+    "multipart/form-data": {"schema": {
+        "type": "object", "required": ["file"], "properties": {"file": {"type": "string", "format": "binary"}}
+    }}
+}}})
+async def upload_image(request: Request, user: User = Depends(get_current_user)):
+    """Upload an image for processing (multipart/form-data, image in the "file" field)
+
+    The body is read only after authentication and streamed to disk as it
+    arrives; it's refused as soon as it passes the plan's size limit, before any
+    of it is read when Content-Length already says so.
+    """
     user = await check_and_reset_monthly_credits(user)
     
     # Check credits based on plan
     plan_info = PLAN_LIMITS.get(user.subscription, PLAN_LIMITS["free"])
     if plan_info["credits"] != -1 and user.credits <= 0:
+        credit_rejections.inc(user.subscription, "upload")
         if user.subscription == "free":
             raise HTTPException(status_code=403, detail="Plus de crédits ce mois. Passe au Starter pour 30 photos/mois à 4.99€.")
         else:
             raise HTTPException(status_code=403, detail="Plus de crédits ce mois. Passe au Pro pour un accès illimité.")
     
-    # Validate file type
-    allowed_types = ["image/jpeg", "image/png", "image/webp", "image/heic", "image/heif"]
-    if file.content_type not in allowed_types:
-        raise HTTPException(status_code=400, detail="Invalid file type. Allowed: JPEG, PNG, WebP, HEIC")
+    max_bytes = plan_info["max_upload_mb"] * 1024 * 1024
+    too_large = HTTPException(
+        status_code=413,
+        detail=f"Fichier trop lourd (max {plan_info['max_upload_mb']} Mo avec ton plan)."
+    )
+    invalid_type = HTTPException(status_code=400, detail="Invalid file type. Allowed: JPEG, PNG, WebP, HEIC")
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > max_bytes + UPLOAD_OVERHEAD_BYTES:
+        raise too_large
+    try:
+        upload = MultipartFile(
+            request.stream(),
+            request.headers.get("content-type", ""),
+            "file",
+            max_body_bytes=max_bytes + UPLOAD_OVERHEAD_BYTES,
+            chunk_size=UPLOAD_CHUNK_SIZE
+        )
+    except UploadError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
-    # Generate unique filename
     image_id = f"img_{uuid.uuid4().hex[:12]}"
-    ext = file.filename.split(".")[-1] if "." in file.filename else "jpg"
-    original_filename = f"{image_id}_original.{ext}"
-    original_path = UPLOAD_DIR / original_filename
+    tmp_path = UPLOAD_DIR / f"{image_id}.upload"
     
-    # Save file
-    async with aiofiles.open(original_path, "wb") as f:
-        content = await file.read()
-        await f.write(content)
+    # Stream to disk chunk by chunk, enforcing the plan's size limit and hashing on the way
+    hasher = hashlib.sha256()
+    size_bytes = 0
+    try:
+        async with aiofiles.open(tmp_path, "wb") as f:
+            async for chunk in upload:
+                # Validate file type (known before the first chunk)
+                if upload.content_type not in UPLOAD_TYPES:
+                    raise invalid_type
+                size_bytes += len(chunk)
+                if size_bytes > max_bytes:
+                    raise too_large
+                hasher.update(chunk)
+                await f.write(chunk)
+        if upload.content_type not in UPLOAD_TYPES:
+            raise invalid_type  # empty file
+    except BaseException as e:
+        tmp_path.unlink(missing_ok=True)
+        if isinstance(e, BodyTooLarge):
+            raise too_large
+        if isinstance(e, UploadError):
+            raise HTTPException(status_code=400, detail=str(e))
+        raise
+    ext = upload.filename.split(".")[-1] if "." in upload.filename else "jpg"
+    
+    # Re-uploads of the same bytes share one stored original
+    content_hash = hasher.hexdigest()
+    original_blob, original_path = await store_original(tmp_path, content_hash, ext)
     
     # Create image record
     now = datetime.now(timezone.utc)
     image_record = {
         "image_id": image_id,
         "user_id": user.user_id,
-        "original_filename": file.filename,
+        "original_filename": upload.filename,
         "original_path": str(original_path),
         "processed_path": None,
+        "original_blob": original_blob,
+        "content_hash": content_hash,
+        "size_bytes": size_bytes,
         "status": "pending",
-        "created_at": now.isoformat(),
+        "created_at": now,
         "processed_at": None
     }
     await db.images.insert_one(image_record)
+    await record_usage(db, user.user_id, now, 1)
+    upload_bytes.observe(size_bytes, user.subscription)
     
     return {
         "image_id": image_id,
@@ -323,14 +1022,16 @@ async def upload_image(file: UploadFile = File(...), user: User = Depends(get_cu
     }
 
 @api_router.post("/images/process/{image_id}")
-async def process_image(image_id: str, user: User = Depends(get_current_user)):
-    """Process an uploaded image (remove background + enhance)"""
-    user = await check_and_reset_monthly_credits(user)
+async def process_image(image_id: str, mode: str = "sync", user: User = Depends(get_current_user)):
+    """Process an uploaded image (remove background + enhance)
+
+    mode=sync waits for the result. mode=job returns 202 with a job id right away;
+    follow it with GET /api/images/jobs/{job_id} or the /api/images/events stream.
+    """
+    if mode not in ("sync", "job"):
+        raise HTTPException(status_code=400, detail="Invalid mode. Use 'sync' or 'job'")
     
-    # Check credits based on plan
-    plan_info = PLAN_LIMITS.get(user.subscription, PLAN_LIMITS["free"])
-    if plan_info["credits"] != -1 and user.credits <= 0:
-        raise HTTPException(status_code=403, detail="Plus de crédits. Upgrade ton plan pour continuer.")
+    user = await check_and_reset_monthly_credits(user)
     
     # Get image record
     image_doc = await db.images.find_one({"image_id": image_id, "user_id": user.user_id}, {"_id": 0})
@@ -346,116 +1047,396 @@ async def process_image(image_id: str, user: User = Depends(get_current_user)):
             "message": "Image already processed"
         }
     
-    # Update status to processing
-    await db.images.update_one({"image_id": image_id}, {"$set": {"status": "processing"}})
+    job = active_jobs.get(image_id)
+    if job is None and image_doc["status"] != "processing":
+        # Take the credit before any work starts (check based on plan)
+        credit = credits_per_image(user)
+        if not await reserve_credits(user, credit):
+            credit_rejections.inc(user.subscription, "process")
+            raise HTTPException(status_code=403, detail="Plus de crédits. Upgrade ton plan pour continuer.")
+        try:
+            # Same bytes already processed with this plan's pipeline: reuse the result
+            remaining, _ = await reuse_processed_results([image_doc], user)
+            if not remaining:
+                return {
+                    "image_id": image_id,
+                    "status": "completed",
+                    "original_url": f"/api/images/file/{image_id}/original",
+                    "processed_url": f"/api/images/file/{image_id}/processed",
+                    "message": "Image processed successfully"
+                }
+            _, jobs, _ = await enqueue_processing_jobs([image_doc], user)
+        except BaseException:
+            await refund_credits(user.user_id, credit)
+            raise
+        job = jobs[0] if jobs else None
+        if job is None:
+            await refund_credits(user.user_id, credit)
+    if job is None:
+        # Queued or running elsewhere (another API process)
+        image_doc = await db.images.find_one({"image_id": image_id}, {"_id": 0, "job_id": 1, "status": 1})
+        if mode == "sync":
+            raise HTTPException(status_code=409, detail="Image is already being processed")
     
-    try:
-        # Load original image
-        original_path = Path(image_doc["original_path"])
-        
-        # Remove background using rembg
-        from rembg import remove
-        
-        with open(original_path, "rb") as f:
-            input_data = f.read()
-        
-        # Remove background
-        output_data = remove(input_data)
-        
-        # Create image with white background
-        img_no_bg = Image.open(io.BytesIO(output_data)).convert("RGBA")
-        
-        # Create white background
-        white_bg = Image.new("RGBA", img_no_bg.size, (255, 255, 255, 255))
-        
-        # Composite
-        final_img = Image.alpha_composite(white_bg, img_no_bg).convert("RGB")
-        
-        # Enhance image (brightness, contrast, sharpness)
-        from PIL import ImageEnhance
-        
-        # Slight contrast boost
-        enhancer = ImageEnhance.Contrast(final_img)
-        final_img = enhancer.enhance(1.1)
-        
-        # Slight sharpness boost
-        enhancer = ImageEnhance.Sharpness(final_img)
-        final_img = enhancer.enhance(1.2)
-        
-        # Slight brightness adjustment
-        enhancer = ImageEnhance.Brightness(final_img)
-        final_img = enhancer.enhance(1.05)
-        
-        # Save processed image
-        processed_filename = f"{image_id}_processed.jpg"
-        processed_path = PROCESSED_DIR / processed_filename
-        final_img.save(processed_path, "JPEG", quality=95)
-        
-        # Update record
-        now = datetime.now(timezone.utc)
-        await db.images.update_one(
-            {"image_id": image_id},
-            {"$set": {
-                "processed_path": str(processed_path),
-                "status": "completed",
-                "processed_at": now.isoformat()
-            }}
-        )
-        
-        # Deduct credit for non-unlimited plans
-        plan_info = PLAN_LIMITS.get(user.subscription, PLAN_LIMITS["free"])
-        if plan_info["credits"] != -1:
-            await db.users.update_one(
-                {"user_id": user.user_id},
-                {"$inc": {"credits": -1}}
-            )
-        
-        return {
+    job_id = job.job_id if job else image_doc.get("job_id")
+    if not job_id:
+        raise HTTPException(status_code=409, detail="Image is already being processed")
+    if mode == "job":
+        return JSONResponse(status_code=202, content={
             "image_id": image_id,
-            "status": "completed",
+            "job_id": job_id,
+            "status": "pending",
+            "status_url": f"/api/images/jobs/{job_id}",
             "original_url": f"/api/images/file/{image_id}/original",
-            "processed_url": f"/api/images/file/{image_id}/processed",
-            "message": "Image processed successfully"
-        }
-        
-    except Exception as e:
-        logger.error(f"Error processing image {image_id}: {str(e)}")
-        await db.images.update_one({"image_id": image_id}, {"$set": {"status": "failed"}})
-        raise HTTPException(status_code=500, detail=f"Processing failed: {str(e)}")
+            "message": "Image queued for processing"
+        })
+    
+    # shield: a client disconnect must not cancel the job for everyone else
+    errors = await asyncio.shield(job.future)
+    if errors.get(image_id):
+        raise HTTPException(status_code=500, detail=f"Processing failed: {errors[image_id]}")
+    
+    return {
+        "image_id": image_id,
+        "status": "completed",
+        "original_url": f"/api/images/file/{image_id}/original",
+        "processed_url": f"/api/images/file/{image_id}/processed",
+        "message": "Image processed successfully"
+    }
+
+class BatchProcessRequest(BaseModel):
+    image_ids: List[str]
+
+@api_router.post("/images/process-batch")
+async def process_image_batch(body: BatchProcessRequest, mode: str = "sync", user: User = Depends(get_current_user)):
+    """Process several uploaded images with batched inference and bulk DB writes
+
+    Same modes as /api/images/process/{image_id}; the whole batch shares one job id.
+    """
+    if mode not in ("sync", "job"):
+        raise HTTPException(status_code=400, detail="Invalid mode. Use 'sync' or 'job'")
+    image_ids = list(dict.fromkeys(body.image_ids))
+    if not image_ids or len(image_ids) > PROCESSING_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"Send between 1 and {PROCESSING_BATCH_MAX} image_ids")
+    
+    user = await check_and_reset_monthly_credits(user)
+    
+    image_docs = await db.images.find(
+        {"image_id": {"$in": image_ids}, "user_id": user.user_id},
+        {"_id": 0}
+    ).to_list(len(image_ids))
+    docs_by_id = {doc["image_id"]: doc for doc in image_docs}
+    to_process = [
+        docs_by_id[image_id] for image_id in image_ids
+        if image_id in docs_by_id
+        and docs_by_id[image_id]["status"] in ("pending", "failed")
+        and image_id not in active_jobs
+    ]
+    
+    # Take the credits based on plan (one per image that still needs processing), all or nothing
+    reserved = credits_per_image(user) * len(to_process)
+    if not await reserve_credits(user, reserved):
+        credit_rejections.inc(user.subscription, "process-batch")
+        raise HTTPException(
+            status_code=403,
+            detail=f"Pas assez de crédits ({user.credits}) pour {len(to_process)} photos. Upgrade ton plan pour continuer."
+        )
+    
+    try:
+        to_process, reused = await reuse_processed_results(to_process, user)
+        job_id, jobs, rejected = await enqueue_processing_jobs(to_process, user)
+    except BaseException:
+        await refund_credits(user.user_id, reserved)
+        raise
+    # Images claimed elsewhere in the meantime
+    await refund_credits(
+        user.user_id,
+        reserved - credits_per_image(user) * len(reused) - sum(img["credits"] for job in jobs for img in job.images)
+    )
+    
+    if mode == "job":
+        return JSONResponse(status_code=202, content={
+            "job_id": job_id,
+            "status": "pending",
+            "status_url": f"/api/images/jobs/{job_id}",
+            "queued": sum(len(job.images) for job in jobs),
+            "reused": len(reused),
+            "rejected": len(rejected),
+            "message": "Images queued for processing"
+        })
+    
+    # Also wait for images another request of this process had already queued
+    waiting = {id(job): job for job in jobs}
+    for image_id in image_ids:
+        if image_id in active_jobs:
+            waiting[id(active_jobs[image_id])] = active_jobs[image_id]
+    errors = {image_id: None for image_id in reused}
+    errors.update({image_id: "Processing queue is full" for image_id in rejected})
+    for chunk_errors in await asyncio.shield(asyncio.gather(*[job.future for job in waiting.values()])):
+        errors.update(chunk_errors)
+    
+    results = []
+    for image_id in image_ids:
+        doc = docs_by_id.get(image_id)
+        if doc is None:
+            results.append({"image_id": image_id, "status": "not_found"})
+        elif image_id in errors:
+            result = {"image_id": image_id, "status": "failed" if errors[image_id] else "completed"}
+            if errors[image_id]:
+                result["error"] = errors[image_id]
+            else:
+                result["processed_url"] = f"/api/images/file/{image_id}/processed"
+            results.append(result)
+        elif doc["status"] == "completed":
+            results.append({
+                "image_id": image_id,
+                "status": "completed",
+                "processed_url": f"/api/images/file/{image_id}/processed"
+            })
+        else:
+            # Claimed by another API process
+            results.append({"image_id": image_id, "status": "processing"})
+    
+    return {
+        "job_id": job_id,
+        "processed": sum(1 for error in errors.values() if not error),
+        "failed": sum(1 for error in errors.values() if error),
+        "images": results
+    }
+
+@api_router.get("/images/jobs/{job_id}")
+async def get_job_status(job_id: str, user: User = Depends(get_current_user)):
+    """Lightweight status poll for a processing job (single image or batch)"""
+    image_docs = await db.images.find(
+        {"job_id": job_id, "user_id": user.user_id},
+        {"_id": 0, "image_id": 1, "job_id": 1, "status": 1, "error": 1, "processed_at": 1}
+    ).to_list(PROCESSING_BATCH_MAX)
+    if not image_docs:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    for image_doc in image_docs:
+        image_doc["original_url"] = f"/api/images/file/{image_doc['image_id']}/original"
+        if image_doc["status"] == "completed":
+            image_doc["processed_url"] = f"/api/images/file/{image_doc['image_id']}/processed"
+    if len(image_docs) == 1:
+        return image_docs[0]
+    
+    statuses = {image_doc["status"] for image_doc in image_docs}
+    for status in ("processing", "pending", "failed"):
+        if status in statuses:
+            break
+    else:
+        status = "completed"
+    return {"job_id": job_id, "status": status, "images": image_docs}
+
+@api_router.get("/images/events")
+async def stream_job_events(request: Request, user: User = Depends(get_current_user)):
+    """Server-Sent Events stream of the user's job status changes"""
+    queue: asyncio.Queue = asyncio.Queue(maxsize=100)
+    job_subscribers.setdefault(user.user_id, set()).add(queue)
+    
+    async def event_stream():
+        try:
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=SSE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: job\ndata: {json.dumps(event)}\n\n"
+        finally:
+            subscribers = job_subscribers.get(user.user_id, set())
+            subscribers.discard(queue)
+            if not subscribers:
+                job_subscribers.pop(user.user_id, None)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Preferred first when the client accepts it
+NEGOTIATED_FORMATS = [fmt for fmt in ("avif", "webp") if fmt in image_pipeline.AVAILABLE_FORMATS]
+
+def negotiate_image_format(accept: str) -> str:
+    """Best output format the Accept header explicitly allows, JPEG otherwise"""
+    accepted = set()
+    for part in accept.lower().split(","):
+        media_type, *params = [item.strip() for item in part.split(";")]
+        if not any(param.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000") for param in params):
+            accepted.add(media_type)
+    return next((fmt for fmt in NEGOTIATED_FORMATS if f"image/{fmt}" in accepted), "jpeg")
+
+def derivative_width(w: int) -> int:
+    """Variant width for a requested w: the next DERIVATIVE_WIDTHS, at most the largest"""
+    if w <= 0:
+        raise HTTPException(status_code=400, detail="Invalid width")
+    return next((size for size in DERIVATIVE_WIDTHS if size >= w), DERIVATIVE_WIDTHS[-1])
 
 @api_router.get("/images/file/{image_id}/{type}")
-async def get_image_file(image_id: str, type: str):
-    """Get image file (original or processed)"""
+async def get_image_file(
+    image_id: str, type: str, request: Request, w: Optional[int] = None, format: Optional[str] = None
+):
+    """Get image file (original or processed)
+
+    w and/or format return a resized/re-encoded derivative, rendered once and then
+    served from the on-disk cache. w is rounded up to the nearest DERIVATIVE_WIDTHS,
+    and capped at the largest of them.
+    Without format, processed images and resized variants are sent as AVIF or
+    WebP when the Accept header allows it (full-size originals stay byte-exact).
+
+    Responses carry a strong ETag (content hash when known) and honour
+    If-None-Match and Range. An image never gets a second result, so processed
+    files are cached as immutable.
+    """
     image_doc = await db.images.find_one({"image_id": image_id}, {"_id": 0})
     if not image_doc:
         raise HTTPException(status_code=404, detail="Image not found")
     
     if type == "original":
-        file_path = Path(image_doc["original_path"])
+        file_path = locate(image_doc["original_path"])
+        etag = image_doc.get("content_hash")
+        cache_control = "public, max-age=86400"
     elif type == "processed":
         if not image_doc.get("processed_path"):
             raise HTTPException(status_code=404, detail="Processed image not available")
-        file_path = Path(image_doc["processed_path"])
+        file_path = locate(image_doc["processed_path"])
+        # "processed:<sha256 of input + pipeline>"
+        etag = (image_doc.get("processed_blob") or "").partition(":")[2] or None
+        cache_control = IMMUTABLE
     else:
         raise HTTPException(status_code=400, detail="Invalid type. Use 'original' or 'processed'")
     
     if not file_path.exists():
         raise HTTPException(status_code=404, detail="File not found")
     
-    return FileResponse(file_path, media_type="image/jpeg")
+    extra_headers = None
+    if format is not None:
+        fmt = "jpeg" if format == "jpg" else format
+        if fmt not in image_pipeline.AVAILABLE_FORMATS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Invalid format. Use one of: {', '.join(image_pipeline.AVAILABLE_FORMATS)}"
+            )
+    elif type == "processed" or w is not None:
+        fmt = negotiate_image_format(request.headers.get("accept", ""))
+        extra_headers = {"Vary": "Accept"}
+    else:
+        return cached_file_response(request, file_path, etag, cache_control)
+    
+    if w is None and fmt == "jpeg" and type == "processed":
+        # The stored result already is the JPEG
+        return cached_file_response(request, file_path, etag, cache_control, extra_headers=extra_headers)
+    
+    width = None if w is None else derivative_width(w)
+    # Encoded with the settings of the plan that produced the result
+    plan_info = PLAN_LIMITS.get(image_doc.get("processed_plan"), {})
+    settings = plan_info.get("encoder", image_pipeline.DEFAULT_ENCODER)[fmt]
+    
+    async def render(target: Path) -> None:
+        await run_in_processing_executor(
+            image_pipeline.render_derivative,
+            str(file_path),
+            str(target),
+            width,
+            fmt,
+            settings
+        )
+    
+    # Source files are content-addressed (or per image), so their name identifies the bytes
+    variant = f"w{width or 'full'}-{hashlib.sha256(image_pipeline.encoder_tag(settings).encode()).hexdigest()[:8]}"
+    name = f"{type}_{file_path.stem}_{variant}.{fmt}"
+    try:
+        derivative_path = await derivative_cache.get_or_create(name, render)
+    except Exception as e:
+        logger.error(f"Error rendering {name}: {str(e)}")
+        raise HTTPException(status_code=500, detail="Could not render image variant")
+    derivative_etag = f"{etag}-{variant}-{fmt}" if etag else None
+    return cached_file_response(
+        request, derivative_path, derivative_etag, cache_control, extra_headers=extra_headers
+    )
+
+# History page size (default and maximum of ?limit=)
+HISTORY_PAGE_SIZE = 100
+HISTORY_STATUSES = {"pending", "processing", "completed", "failed"}
+# Only what the client shows; server paths and blob keys stay private
+HISTORY_PROJECTION = {
+    "_id": 0,
+    "image_id": 1,
+    "original_filename": 1,
+    "status": 1,
+    "error": 1,
+    "created_at": 1,
+    "processed_at": 1,
+    "processed_path": 1,
+}
+
+def encode_history_cursor(doc: dict) -> str:
+    created_at = doc["created_at"]
+    position = {
+        "c": created_at if isinstance(created_at, str) else created_at.isoformat(),
+        "s": isinstance(created_at, str),  # not migrated to a BSON date yet
+        "i": doc["image_id"],
+    }
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+def history_cursor_filter(cursor: str) -> dict:
+    """Images strictly after the cursor in (created_at desc, image_id desc) order"""
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        created_at = position["c"] if position["s"] else datetime.fromisoformat(position["c"])
+        image_id = position["i"]
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    
+    after = [
+        {"created_at": {"$lt": created_at}},
+        {"created_at": created_at, "image_id": {"$lt": image_id}},
+    ]
+    if not position["s"]:
+        # Mongo sorts strings before dates, so every ISO string date comes after any BSON date
+        after.append({"created_at": {"$type": "string"}})
+    return {"$or": after}
 
 @api_router.get("/images/history")
-async def get_image_history(user: User = Depends(get_current_user)):
-    """Get user's image processing history"""
-    images = await db.images.find(
-        {"user_id": user.user_id},
-        {"_id": 0}
-    ).sort("created_at", -1).to_list(100)
+async def get_image_history(
+    response: Response,
+    limit: int = HISTORY_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    status: Optional[str] = None,
+    user: User = Depends(get_current_user)
+):
+    """Get user's image processing history, newest first
+
+    Keyset pagination on (created_at, image_id): when more images exist, the
+    X-Next-Cursor header holds the cursor of the next page. status filters on
+    one or more comma-separated statuses.
+    """
+    if not 1 <= limit <= HISTORY_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {HISTORY_PAGE_SIZE}")
+    
+    query = {"user_id": user.user_id}
+    if status:
+        statuses = status.split(",")
+        if not set(statuses) <= HISTORY_STATUSES:
+            raise HTTPException(status_code=400, detail="Invalid status filter")
+        query["status"] = {"$in": statuses}
+    if cursor:
+        query.update(history_cursor_filter(cursor))
+    
+    # One extra document tells whether there is a next page
+    images = await db.images.find(query, HISTORY_PROJECTION).sort(
+        [("created_at", -1), ("image_id", -1)]
+    ).limit(limit + 1).to_list(limit + 1)
+    if len(images) > limit:
+        images = images[:limit]
+        response.headers["X-Next-Cursor"] = encode_history_cursor(images[-1])
     
     # Add URLs to each image
     for img in images:
         img["original_url"] = f"/api/images/file/{img['image_id']}/original"
-        if img.get("processed_path"):
+        if img.pop("processed_path", None):
             img["processed_url"] = f"/api/images/file/{img['image_id']}/processed"
     
     return images
@@ -463,24 +1444,23 @@ async def get_image_history(user: User = Depends(get_current_user)):
 @api_router.delete("/images/{image_id}")
 async def delete_image(image_id: str, user: User = Depends(get_current_user)):
     """Delete an image from history"""
-    image_doc = await db.images.find_one({"image_id": image_id, "user_id": user.user_id}, {"_id": 0})
+    # The deleted record tells which blobs it still referenced (a job may complete it meanwhile)
+    image_doc = await db.images.find_one_and_delete(
+        {"image_id": image_id, "user_id": user.user_id}, projection={"_id": 0}
+    )
     if not image_doc:
         raise HTTPException(status_code=404, detail="Image not found")
+    await record_usage(db, user.user_id, image_doc["created_at"], -1)
     
-    # Delete files
-    if image_doc.get("original_path"):
-        try:
-            Path(image_doc["original_path"]).unlink(missing_ok=True)
-        except:
-            pass
-    if image_doc.get("processed_path"):
-        try:
-            Path(image_doc["processed_path"]).unlink(missing_ok=True)
-        except:
-            pass
-    
-    # Delete record
-    await db.images.delete_one({"image_id": image_id})
+    # Delete files (shared blobs only once nobody references them)
+    for blob_field, path_field in (("original_blob", "original_path"), ("processed_blob", "processed_path")):
+        if image_doc.get(blob_field):
+            await release_blob(image_doc[blob_field])
+        elif image_doc.get(path_field):
+            try:
+                unlink_everywhere(image_doc[path_field])
+            except:
+                pass
     
     return {"message": "Image deleted successfully"}
 
@@ -491,16 +1471,8 @@ async def get_user_profile(user: User = Depends(get_current_user)):
     """Get user profile with stats"""
     user = await check_and_reset_monthly_credits(user)
     
-    # Count total images
-    total_images = await db.images.count_documents({"user_id": user.user_id})
-    
-    # Count images this month
-    now = datetime.now(timezone.utc)
-    start_of_month = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    images_this_month = await db.images.count_documents({
-        "user_id": user.user_id,
-        "created_at": {"$gte": start_of_month.isoformat()}
-    })
+    # Total and this month's images, from the user's usage counters
+    usage = await get_usage(db, user.user_id, datetime.now(timezone.utc))
     
     plan_info = PLAN_LIMITS.get(user.subscription, PLAN_LIMITS["free"])
     
@@ -512,9 +1484,9 @@ async def get_user_profile(user: User = Depends(get_current_user)):
         "credits": user.credits if plan_info["credits"] != -1 else -1,
         "max_credits": plan_info["credits"],
         "subscription": user.subscription,
-        "total_images": total_images,
-        "images_this_month": images_this_month,
-        "plan_features": plan_info
+        "total_images": usage["total_images"],
+        "images_this_month": usage["images_this_month"],
+        "plan_features": public_plan_features(plan_info)
     }
 
 class UpgradeRequest(BaseModel):
@@ -540,15 +1512,16 @@ async def upgrade_plan(request: Request, user: User = Depends(get_current_user))
         {"$set": {
             "subscription": plan,
             "credits": plan_info["credits"] if plan_info["credits"] != -1 else 9999,
-            "last_credit_reset": now.isoformat()
+            "last_credit_reset": now
         }}
     )
+    invalidate_user(user.user_id)
     
     return {
         "message": f"Upgraded to {plan} successfully",
         "subscription": plan,
         "credits": plan_info["credits"],
-        "features": plan_info
+        "features": public_plan_features(plan_info)
     }
 
 @api_router.post("/user/downgrade")
@@ -557,8 +1530,9 @@ async def downgrade_to_free(user: User = Depends(get_current_user)):
     now = datetime.now(timezone.utc)
     await db.users.update_one(
         {"user_id": user.user_id},
-        {"$set": {"subscription": "free", "credits": 3, "last_credit_reset": now.isoformat()}}
+        {"$set": {"subscription": "free", "credits": 3, "last_credit_reset": now}}
     )
+    invalidate_user(user.user_id)
     return {"message": "Downgraded to free plan", "subscription": "free", "credits": 3}
 
 # ==================== HEALTH CHECK ====================
@@ -569,19 +1543,220 @@ async def root():
 
 @api_router.get("/health")
 async def health_check():
+    """Liveness only; load balancers should route on /api/ready"""
     return {"status": "healthy", "timestamp": datetime.now(timezone.utc).isoformat()}
 
+# Filled in by warm_up() at startup
+readiness = {"ready": False, "failed": False, "checks": {}}
+metrics.gauge("app_ready", "1 once startup warm-up has finished", callback=lambda: [((), float(readiness["ready"]))])
+
+@api_router.get("/ready")
+async def readiness_check():
+    """503 until Mongo answers and every processing worker has its models loaded and warmed"""
+    return JSONResponse(
+        status_code=200 if readiness["ready"] else 503,
+        content={
+            "status": "ready" if readiness["ready"] else "failed" if readiness["failed"] else "warming_up",
+            "checks": readiness["checks"]
+        }
+    )
+
+@api_router.get("/processing/stats", dependencies=[Depends(require_metrics_token)])
+async def processing_stats():
+    """Queue depth and wait times per scheduling class"""
+    return {
+        "workers": PROCESSING_WORKERS,
+        "executor": PROCESSING_EXECUTOR,
+        "batch_size": PROCESSING_BATCH_SIZE,
+        "queued_jobs": processing_queue.qsize(),
+        "running_jobs": len({id(job) for job in active_jobs.values()}) - processing_queue.qsize(),
+        "active_images": len(active_jobs),
+        "derivative_cache": derivative_cache.stats(),
+        "auth_cache": {"sessions": session_cache.stats(), "users": user_cache.stats()},
+        "classes": processing_queue.stats()
+    }
+
+# ==================== PROFILING ====================
+
+# Off unless one of these is set: share of /api requests to profile (0-1), and/or
+# latency above which a request's profile is kept (every request is then sampled)
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_SLOW_MS = float(os.environ.get('PROFILE_SLOW_MS', 0))
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', 5))
+PROFILE_DIR = ROOT_DIR / "profiles"
+PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', 200))
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')  # required by the endpoints below, which are disabled without it
+profile_store = ProfileStore(PROFILE_DIR, PROFILE_MAX_FILES)
+
+def require_profile_token(request: Request) -> None:
+    if not PROFILE_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not has_bearer_token(request, PROFILE_TOKEN):
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+@api_router.get("/debug/profiles", dependencies=[Depends(require_profile_token)])
+async def list_profiles(limit: int = 50):
+    """Most recent request profiles, newest first"""
+    return await asyncio.to_thread(profile_store.list, max(1, min(limit, PROFILE_MAX_FILES)))
+
+@api_router.get("/debug/profiles/{request_id}", dependencies=[Depends(require_profile_token)])
+async def download_profile(request_id: str, request: Request):
+    """Collapsed stacks of one request, for flamegraph.pl or speedscope"""
+    path = profile_store.path(request_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return cached_file_response(
+        request, path, cache_control="private, no-cache", media_type="text/plain; charset=utf-8",
+        extra_headers={"Content-Disposition": f'attachment; filename="{request_id}.folded"'}
+    )
+
 # Include the router in the main app
 app.include_router(api_router)
 
+if PROFILE_SAMPLE_RATE > 0 or PROFILE_SLOW_MS > 0:
+    # Added before the @app.middleware ones below so it sits inside them, in the endpoint's task
+    app.add_middleware(
+        ProfilingMiddleware,
+        store=profile_store,
+        sample_rate=PROFILE_SAMPLE_RATE,
+        slow_ms=PROFILE_SLOW_MS,
+        interval_ms=PROFILE_INTERVAL_MS,
+        exclude_prefix="/api/debug/profiles"
+    )
+
+@app.get("/metrics", include_in_schema=False, dependencies=[Depends(require_metrics_token)])
+async def metrics_endpoint():
+    """Prometheus text exposition of this process's metrics"""
+    return Response(metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    """Latency per API route, labelled by route template so ids don't multiply the series"""
+    if not request.url.path.startswith("/api/"):
+        return await call_next(request)
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        http_request_seconds.observe(
+            time.perf_counter() - start,
+            request.method,
+            route.path if route is not None else "unmatched",
+            str(status)
+        )
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Profile-ID"],
 )
 
+# Background date migration started at startup
+db_migration_task: Optional[asyncio.Task] = None
+# Seconds between warm-up attempts while Mongo or the models are unavailable
+WARMUP_RETRY_SECONDS = float(os.environ.get('WARMUP_RETRY_SECONDS', 5))
+# Failed attempts after which warm-up stops and the node stays unready (0 = never)
+WARMUP_MAX_ATTEMPTS = int(os.environ.get('WARMUP_MAX_ATTEMPTS', 60))
+warmup_task: Optional[asyncio.Task] = None
+
+async def prepare_database():
+    """Create indexes, then convert leftover ISO string dates in the background"""
+    global db_migration_task
+    await ensure_indexes(db)
+    if db_migration_task is None:
+        db_migration_task = asyncio.create_task(migrate_string_dates(db))
+
+async def warm_processing_executor() -> None:
+    """Load the models and run a dummy inference in every processing worker
+
+    A worker dying here (e.g. OOM loading a model) breaks the pool; it is replaced
+    and the next warm-up attempt runs in the new one.
+    """
+    if PROCESSING_EXECUTOR == "thread":
+        # Threads share one session registry
+        await run_in_processing_executor(image_pipeline.warm_up, PROCESSING_MODELS)
+        return
+    # Worker processes start on demand and a warm one may take several calls while
+    # another is still loading: submit rounds until each has answered at least once
+    warm_pids = set()
+    while len(warm_pids) < PROCESSING_WORKERS:
+        warm_pids.update(await asyncio.gather(*(
+            run_in_processing_executor(image_pipeline.warm_up, PROCESSING_MODELS)
+            for _ in range(PROCESSING_WORKERS)
+        )))
+
+async def warm_up() -> None:
+    """Make this node ready for traffic, retrying until Mongo and the models are available
+
+    Gives up after WARMUP_MAX_ATTEMPTS failures: the node then stays unready (503
+    on /api/ready) with the last error in its checks, for the orchestrator to replace.
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        checks = readiness["checks"] = {}
+        try:
+            start = time.perf_counter()
+            await db.command("ping")
+            checks["mongo"] = {"ok": True, "ms": round((time.perf_counter() - start) * 1000, 1)}
+            
+            await prepare_database()
+            missing = await missing_indexes(db)
+            # Reported but not blocking: queries still work without them, only slower
+            checks["indexes"] = {"ok": not missing, "missing": [f"{collection} {keys}" for collection, keys in missing]}
+            
+            start = time.perf_counter()
+            await warm_processing_executor()
+            checks["models"] = {
+                "ok": True,
+                "names": PROCESSING_MODELS,
+                "ms": round((time.perf_counter() - start) * 1000, 1)
+            }
+        except Exception as e:
+            if WARMUP_MAX_ATTEMPTS and attempt >= WARMUP_MAX_ATTEMPTS:
+                logger.error(f"Warm-up failed {attempt} times, giving up (node stays unready): {str(e)}")
+                checks["error"] = f"Gave up after {attempt} attempts: {str(e)}"
+                readiness["failed"] = True
+                return
+            logger.error(f"Warm-up failed, retrying in {WARMUP_RETRY_SECONDS}s: {str(e)}")
+            checks["error"] = str(e)
+            await asyncio.sleep(WARMUP_RETRY_SECONDS)
+            continue
+        readiness["ready"] = True
+        logger.info(f"Warm-up done: {checks}")
+        return
+
+@app.on_event("startup")
+async def start_warm_up():
+    # In the background so /api/health and /api/ready answer meanwhile
+    global warmup_task
+    warmup_task = asyncio.create_task(warm_up())
+
+@app.on_event("startup")
+async def start_processing_workers():
+    # A typo in a plan's stages should stop startup, not fail every job of that plan
+    for plan_info in PLAN_LIMITS.values():
+        image_pipeline.plan_stages(plan_info["stages"])
+        if plan_info["watermark"] != ("watermark" in plan_info["stages"]):
+            raise RuntimeError("PLAN_LIMITS watermark flag and stages disagree")
+    for _ in range(PROCESSING_WORKERS):
+        processing_worker_tasks.append(asyncio.create_task(processing_worker()))
+    # Also recovers, right away, what a previous run of this node left queued
+    processing_worker_tasks.append(asyncio.create_task(maintain_processing_leases()))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in processing_worker_tasks:
+        task.cancel()
+    for task in (warmup_task, db_migration_task):
+        if task is not None:
+            task.cancel()
     client.close()
+    processing_executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,168 @@
+"""Hash-sharded file layout for UPLOAD_DIR and PROCESSED_DIR, and the migration to it.
+
+Files live two levels down, in directories named after the first hex digits of
+their name (content hashes already are hex; other names, like the legacy
+img_<id>_original.jpg, are hashed first):
+
+    uploads/23/b6/23b639f9...a9.jpg
+
+so no directory grows past a few dozen entries per 65536 files. The database
+keeps each file's full path, so existing flat paths keep working. While
+migrate_to_sharded() runs, a stored path may already have been moved:
+locate() finds a file at either place. It can be run, and re-run, alongside the
+API:
+
+    python storage.py
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import re
+from pathlib import Path
+from typing import List, Optional
+
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# Directory levels, two hex digits each
+SHARD_DEPTH = 2
+MIGRATION_BATCH_SIZE = 500
+
+_HEX = re.compile(r"^[0-9a-f]{%d,}$" % (2 * SHARD_DEPTH))
+
+
+def shard_dirs(name: str) -> List[str]:
+    """Directory names a file called name is sharded into"""
+    stem = name.split(".", 1)[0]
+    key = stem if _HEX.match(stem) else hashlib.sha256(stem.encode()).hexdigest()
+    return [key[2 * level:2 * level + 2] for level in range(SHARD_DEPTH)]
+
+
+def sharded_path(directory: Path, name: str) -> Path:
+    """Where a file called name lives under directory (parent directories are not created)"""
+    return Path(directory).joinpath(*shard_dirs(name), name)
+
+
+def is_sharded(path: Path) -> bool:
+    path = Path(path)
+    return [parent.name for parent in reversed(path.parents[:SHARD_DEPTH])] == shard_dirs(path.name)
+
+
+def flat_path(path: Path) -> Path:
+    """The pre-sharding location of path"""
+    path = Path(path)
+    return path.parents[SHARD_DEPTH] / path.name if is_sharded(path) else path
+
+
+def locate(path) -> Path:
+    """path if it exists, else the same file's other location (migrated or not yet)"""
+    path = Path(path)
+    if path.exists():
+        return path
+    other = flat_path(path) if is_sharded(path) else sharded_path(path.parent, path.name)
+    return other if other.exists() else path
+
+
+def unlink_everywhere(path) -> None:
+    """Remove a file at its flat and sharded location both, whichever exist"""
+    flat = flat_path(path)
+    for candidate in (flat, sharded_path(flat.parent, flat.name)):
+        candidate.unlink(missing_ok=True)
+
+
+def _link_into_shard(path: Path) -> Optional[Path]:
+    """Hard-link a flat file into its shard, keeping the original. None if it's gone"""
+    target = sharded_path(path.parent, path.name)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(path, target)
+    except FileExistsError:
+        pass  # an earlier or concurrent run, or a worker, got it there first
+    except FileNotFoundError:
+        return target if target.exists() else None
+    return target
+
+
+async def _migrate_blobs(db, batch_size: int) -> int:
+    """Point db.blobs at sharded files. Shared files are linked, the record updated, then the flat name removed"""
+    moved, last_id = 0, None
+    while True:
+        query = {} if last_id is None else {"_id": {"$gt": last_id}}
+        blobs = await db.blobs.find(query, {"_id": 1, "blob_key": 1, "path": 1}).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not blobs:
+            return moved
+        last_id = blobs[-1]["_id"]
+        for blob in blobs:
+            path = Path(blob["path"])
+            if is_sharded(path):
+                continue
+            target = _link_into_shard(path)
+            if target is None:
+                continue  # file already missing, nothing to move
+            result = await db.blobs.update_one({"_id": blob["_id"], "path": blob["path"]}, {"$set": {"path": str(target)}})
+            if not result.matched_count and not await db.blobs.find_one({"_id": blob["_id"]}):
+                # Released meanwhile: release_blob unlinked the flat name only
+                target.unlink(missing_ok=True)
+            path.unlink(missing_ok=True)
+            moved += 1
+
+
+async def _migrate_images(db, batch_size: int) -> int:
+    """Rewrite original_path/processed_path; files not backed by a blob (legacy records) are moved here"""
+    updated, last_id = 0, None
+    fields = {"original_blob": "original_path", "processed_blob": "processed_path"}
+    while True:
+        query = {} if last_id is None else {"_id": {"$gt": last_id}}
+        projection = {"_id": 1, **{field: 1 for field in fields}, **{field: 1 for field in fields.values()}}
+        docs = await db.images.find(query, projection).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not docs:
+            return updated
+        last_id = docs[-1]["_id"]
+        for doc in docs:
+            for blob_field, path_field in fields.items():
+                if not doc.get(path_field) or is_sharded(Path(doc[path_field])):
+                    continue
+                path = Path(doc[path_field])
+                # Blob files were moved by _migrate_blobs; a legacy file belongs to this record alone
+                target = sharded_path(path.parent, path.name) if doc.get(blob_field) else _link_into_shard(path)
+                if target is None or not target.exists():
+                    continue
+                result = await db.images.update_one(
+                    {"_id": doc["_id"], path_field: doc[path_field]}, {"$set": {path_field: str(target)}}
+                )
+                if not doc.get(blob_field):
+                    if result.matched_count:
+                        path.unlink(missing_ok=True)
+                    elif not await db.images.find_one({"_id": doc["_id"]}):
+                        target.unlink(missing_ok=True)  # deleted meanwhile, only the flat file was removed
+                updated += result.modified_count
+
+
+async def migrate_to_sharded(db, batch_size: int = MIGRATION_BATCH_SIZE) -> dict:
+    """Move flat files into their shards and update the stored paths. Idempotent, safe alongside the API"""
+    try:
+        blobs = await _migrate_blobs(db, batch_size)
+        images = await _migrate_images(db, batch_size)
+    except PyMongoError as e:
+        logger.error(f"Storage migration interrupted, re-run it to resume: {str(e)}")
+        raise
+    logger.info(f"Storage migration done: {blobs} blob files moved, {images} image paths rewritten")
+    return {"blobs": blobs, "images": images}
+
+
+async def _main() -> None:
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'], tz_aware=True)
+    db = client[os.environ['DB_NAME']]
+    print(await migrate_to_sharded(db))
+    client.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main())
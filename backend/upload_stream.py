@@ -0,0 +1,114 @@
+"""Streaming of one file out of a multipart/form-data request body.
+
+UploadFile parameters make Starlette receive and spool the whole body before
+the endpoint runs, so a size limit could only be checked afterwards.
+MultipartFile parses the body as it arrives instead: the endpoint gets the
+file's bytes chunk by chunk and the read stops as soon as a limit is passed.
+"""
+from typing import AsyncIterator, List, Optional
+
+from python_multipart import MultipartParser
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import parse_options_header
+
+
+class UploadError(Exception):
+    """Not a multipart body, malformed, or without the expected file"""
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+class MultipartFile:
+    """Async iterator over the bytes of the first file sent in field_name.
+
+    filename and content_type are set once the file's headers have been read,
+    before the first chunk is yielded. Chunks are at least chunk_size bytes,
+    except the last one.
+    """
+
+    def __init__(
+        self,
+        stream: AsyncIterator[bytes],
+        content_type: str,
+        field_name: str,
+        max_body_bytes: int,
+        chunk_size: int = 1024 * 1024,
+    ):
+        media_type, options = parse_options_header(content_type)
+        if media_type != b"multipart/form-data" or not options.get(b"boundary"):
+            raise UploadError("Expected a multipart/form-data body")
+        self.stream = stream
+        self.field_name = field_name
+        self.max_body_bytes = max_body_bytes
+        self.chunk_size = chunk_size
+        self.filename: Optional[str] = None
+        self.content_type: Optional[str] = None
+
+        self._headers: List[tuple] = []
+        self._header_name = b""
+        self._header_value = b""
+        self._in_file = False
+        self._done = False
+        self._pending: List[bytes] = []
+        self._pending_bytes = 0
+        self._parser = MultipartParser(options[b"boundary"], callbacks={
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+        })
+
+    def _on_part_begin(self) -> None:
+        self._headers = []
+
+    def _on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_name += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def _on_header_end(self) -> None:
+        self._headers.append((self._header_name.lower(), self._header_value))
+        self._header_name = self._header_value = b""
+
+    def _on_headers_finished(self) -> None:
+        headers = dict(self._headers)
+        _, options = parse_options_header(headers.get(b"content-disposition", b""))
+        if self.filename is None and options.get(b"name") == self.field_name.encode() and b"filename" in options:
+            self._in_file = True
+            self.filename = options[b"filename"].decode("utf-8", "replace")
+            self.content_type = headers.get(b"content-type", b"").decode("latin-1").strip()
+
+    def _on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if self._in_file:
+            self._pending.append(data[start:end])
+            self._pending_bytes += end - start
+
+    def _on_part_end(self) -> None:
+        if self._in_file:
+            self._in_file = False
+            self._done = True
+
+    async def __aiter__(self):
+        received = 0
+        async for chunk in self.stream:
+            received += len(chunk)
+            if received > self.max_body_bytes:
+                raise BodyTooLarge
+            try:
+                self._parser.write(chunk)
+            except MultipartParseError as e:
+                raise UploadError(f"Malformed multipart body: {str(e)}")
+            if self._pending and (self._pending_bytes >= self.chunk_size or self._done):
+                data, self._pending, self._pending_bytes = b"".join(self._pending), [], 0
+                yield data
+            if self._done:
+                return  # the rest of the body (other fields) is not needed
+        if self.filename is None:
+            raise UploadError(f"No file in the '{self.field_name}' field")
+        raise UploadError("Incomplete multipart body")
@@ -0,0 +1,134 @@
+"""Per-user image counters, so profile views read one document instead of counting images.
+
+db.usage holds one document per user:
+
+    {"user_id": ..., "total_images": 42, "monthly": {"2026-09": 30, "2026-10": 12},
+     "version": 7, "repaired_at": <date>}
+
+Uploads and deletes $inc it. repair_usage() recomputes it from db.images; it runs
+for users whose document was never repaired (created before the counters existed)
+and can be run by hand for everyone:
+
+    python usage.py
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterable, Optional
+
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+# Recounts of a user whose counters keep changing while they are recomputed
+REPAIR_ATTEMPTS = 5
+
+
+def month_key(when) -> Optional[str]:
+    """"YYYY-MM" (UTC) of a datetime or an ISO string date; None when there is no valid date"""
+    if isinstance(when, str):
+        try:
+            when = datetime.fromisoformat(when)
+        except ValueError:
+            return None
+    if not isinstance(when, datetime):
+        return None
+    if when.tzinfo is not None:
+        when = when.astimezone(timezone.utc)
+    return when.strftime("%Y-%m")
+
+
+async def record_usage(db, user_id: str, created_at, delta: int) -> None:
+    """Count an image in (delta=1) or out of (delta=-1) its owner's totals"""
+    inc = {"total_images": delta, "version": 1}
+    month = month_key(created_at)
+    if month:
+        inc[f"monthly.{month}"] = delta
+    await db.usage.update_one({"user_id": user_id}, {"$inc": inc}, upsert=True)
+
+
+async def _replace_counts(db, user_id: str, usage: dict, versions: dict) -> bool:
+    """Write recomputed counters unless a record_usage() has changed them since versions was read"""
+    now = datetime.now(timezone.utc)
+    if user_id not in versions:
+        try:
+            await db.usage.insert_one({"user_id": user_id, **usage, "repaired_at": now})
+            return True
+        except DuplicateKeyError:
+            return False  # created by a record_usage() meanwhile
+    # None also matches documents from before versions were kept
+    result = await db.usage.update_one(
+        {"user_id": user_id, "version": versions[user_id]},
+        {"$set": {**usage, "repaired_at": now}}
+    )
+    return bool(result.matched_count)
+
+
+async def repair_usage(db, user_ids: Optional[Iterable[str]] = None) -> int:
+    """Recompute counters from db.images (all users when user_ids is None). Returns users updated
+
+    Every record_usage() bumps the document's version. Counters are only replaced
+    if the version read before counting is unchanged, so an upload or delete
+    landing meanwhile isn't lost: its user is counted again.
+    """
+    pending = None if user_ids is None else list(user_ids)
+    repaired = 0
+    for _ in range(REPAIR_ATTEMPTS):
+        match = {} if pending is None else {"user_id": {"$in": pending}}
+        versions = {
+            doc["user_id"]: doc.get("version")
+            async for doc in db.usage.find(match, {"_id": 0, "user_id": 1, "version": 1})
+        }
+        counts = {}
+        async for doc in db.images.find(match, {"_id": 0, "user_id": 1, "created_at": 1}):
+            usage = counts.setdefault(doc["user_id"], {"total_images": 0, "monthly": {}})
+            usage["total_images"] += 1
+            month = month_key(doc.get("created_at"))
+            if month:
+                usage["monthly"][month] = usage["monthly"].get(month, 0) + 1
+        for user_id in pending or []:
+            counts.setdefault(user_id, {"total_images": 0, "monthly": {}})
+
+        changed = []
+        for user_id, usage in counts.items():
+            if await _replace_counts(db, user_id, usage, versions):
+                repaired += 1
+            else:
+                changed.append(user_id)
+        if not changed:
+            break
+        pending = changed
+    else:
+        logger.warning(f"Usage of {len(pending)} users kept changing, not repaired")
+    return repaired
+
+
+async def get_usage(db, user_id: str, now: datetime) -> dict:
+    """{"total_images", "images_this_month"} from the user's counters"""
+    doc = await db.usage.find_one({"user_id": user_id}, {"_id": 0})
+    if not doc or "repaired_at" not in doc:
+        # Counters started after this user's first images: count them once
+        await repair_usage(db, [user_id])
+        doc = await db.usage.find_one({"user_id": user_id}, {"_id": 0}) or {}
+    return {
+        "total_images": doc.get("total_images", 0),
+        "images_this_month": doc.get("monthly", {}).get(month_key(now), 0),
+    }
+
+
+async def _main() -> None:
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'], tz_aware=True)
+    db = client[os.environ['DB_NAME']]
+    print(f"usage recomputed for {await repair_usage(db)} users")
+    client.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main())
@@ -0,0 +1,324 @@
+"""Offline benchmark of the image pipeline (image_pipeline.process_images).
+
+Runs each plan's stages on synthetic product photos at 720p/1080p/4K/48MP in
+JPEG/PNG/WebP and reports, per case: p50/p95/p99 latency, images/s per core
+(images per CPU second), peak RSS and the median time of every stage. Each case
+runs in a fresh process so peak RSS belongs to that case alone.
+
+No network and no GPU needed. Segmentation uses the real ONNX model when it is
+already in U2NET_HOME (~/.u2net), otherwise a stub session that returns a fixed
+mask: every other stage (decode, resize, mask pre/post-processing, blend,
+enhance, encode) still runs for real. The report says which one was used.
+
+    python benchmarks/bench_pipeline.py                      # compare with benchmarks/baseline.json
+    python benchmarks/bench_pipeline.py --save-baseline      # record a new baseline
+    python benchmarks/bench_pipeline.py --plans free pro --sizes 720p 4K --repeat 10
+
+Exits 1 when a case is slower, hungrier or less efficient than the baseline by
+more than --tolerance, 2 when the baseline was recorded with another setup.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+import numpy as np
+from PIL import Image, ImageChops, ImageDraw, ImageFilter
+from rembg.sessions.base import BaseSession
+
+ROOT_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(ROOT_DIR.parent / "backend"))
+
+import image_pipeline  # noqa: E402
+from plans import PLAN_LIMITS as PLANS  # noqa: E402
+
+SIZES = {
+    "720p": (1280, 720),
+    "1080p": (1920, 1080),
+    "4K": (3840, 2160),
+    "48MP": (8000, 6000),
+}
+
+# How the corpus files are written
+SOURCE_FORMATS = {
+    "jpeg": ("JPEG", ".jpg", {"quality": 92}),
+    "png": ("PNG", ".png", {}),
+    "webp": ("WEBP", ".webp", {"quality": 90}),
+}
+
+DEFAULT_BASELINE = ROOT_DIR / "baseline.json"
+DEFAULT_CORPUS_DIR = ROOT_DIR / ".corpus"
+DEFAULT_TOLERANCE = 0.25
+# Latency differences below this are noise, whatever the ratio
+LATENCY_SLACK_MS = 5.0
+
+
+# ==================== CORPUS ====================
+
+def synthetic_photo(width: int, height: int, seed: int) -> Image.Image:
+    """A product shot: a garment-like shape with a soft shadow on a lit backdrop, plus sensor noise"""
+    rng = random.Random(seed)
+    # Shapes are drawn small and upscaled, only the noise is full resolution
+    scale = max(1, min(width, height) // 360)
+    w, h = max(1, width // scale), max(1, height // scale)
+
+    backdrop = Image.linear_gradient("L").resize((w, h)).point(lambda v: 235 - v // 6)
+    img = Image.merge("RGB", (backdrop, backdrop, backdrop.point(lambda v: max(0, v - 8))))
+
+    shadow = Image.new("L", (w, h), 0)
+    ImageDraw.Draw(shadow).ellipse((w * 0.25, h * 0.78, w * 0.75, h * 0.9), fill=90)
+    img.paste((40, 40, 40), mask=shadow.filter(ImageFilter.GaussianBlur(max(2, h // 40))))
+
+    color = tuple(rng.randrange(30, 220) for _ in range(3))
+    stripe = tuple(min(255, c + 35) for c in color)
+    product = Image.new("L", (w, h), 0)
+    draw = ImageDraw.Draw(product)
+    draw.rectangle((w * 0.36, h * 0.2, w * 0.64, h * 0.82), fill=255)  # body
+    draw.polygon([(w * 0.36, h * 0.2), (w * 0.24, h * 0.38), (w * 0.3, h * 0.44), (w * 0.36, h * 0.34)], fill=255)
+    draw.polygon([(w * 0.64, h * 0.2), (w * 0.76, h * 0.38), (w * 0.7, h * 0.44), (w * 0.64, h * 0.34)], fill=255)
+    draw.ellipse((w * 0.45, h * 0.15, w * 0.55, h * 0.25), fill=0)  # collar
+    fabric = Image.new("RGB", (w, h), color)
+    fabric_draw = ImageDraw.Draw(fabric)
+    for y in range(0, h, max(2, h // 40)):
+        fabric_draw.line((0, y, w, y), fill=stripe, width=max(1, h // 160))
+    img.paste(fabric, mask=product)
+
+    img = img.resize((width, height), Image.Resampling.BICUBIC)
+    noise = Image.effect_noise((width, height), 6).convert("RGB")
+    return ImageChops.add(img, noise, scale=1.0, offset=-128)
+
+
+def corpus_file(corpus_dir: Path, size: str, fmt: str) -> Path:
+    """Path of one corpus image, written on first use and reused afterwards"""
+    pil_format, ext, options = SOURCE_FORMATS[fmt]
+    path = corpus_dir / f"{size}{ext}"
+    if not path.exists():
+        corpus_dir.mkdir(parents=True, exist_ok=True)
+        width, height = SIZES[size]
+        tmp = path.with_suffix(".tmp")
+        synthetic_photo(width, height, seed=width * height).save(tmp, pil_format, **options)
+        os.replace(tmp, path)
+    return path
+
+
+# ==================== SEGMENTATION ====================
+
+def model_path(model_name: str) -> Path:
+    home = os.environ.get("U2NET_HOME", os.path.join(os.path.expanduser("~"), ".u2net"))
+    return Path(home) / f"{model_name}.onnx"
+
+
+class StubSession(BaseSession):
+    """A rembg session without a model: rembg's own preprocessing, a canned prediction (an ellipse)"""
+
+    def __init__(self, model_name: str):
+        # BaseSession.__init__ would load the ONNX file
+        self.model_name = model_name
+        self.inner_session = self
+        self._masks: Dict[tuple, np.ndarray] = {}
+
+    # The onnxruntime.InferenceSession surface predict_masks uses
+    def get_inputs(self):
+        return [SimpleNamespace(name="input.image", shape=["batch", 3, None, None])]
+
+    def run(self, output_names, feed):
+        batch = next(iter(feed.values()))
+        height, width = batch.shape[2:]
+        mask = self._masks.get((height, width))
+        if mask is None:
+            y, x = np.ogrid[:height, :width]
+            inside = ((x - width / 2) / (width * 0.3)) ** 2 + ((y - height / 2) / (height * 0.4)) ** 2
+            mask = self._masks[(height, width)] = np.clip(1.5 - inside, 0, 1).astype(np.float32)
+        return [np.broadcast_to(mask, (batch.shape[0], 1, height, width))]
+
+
+# Recorded with results from the stub, so nobody reads them as inference numbers
+STUB_NOTE = "stub segmenter: canned masks, segmentation inference not measured"
+
+
+def pick_segmenter(requested: str, model_names: List[str]) -> str:
+    missing = [name for name in model_names if not model_path(name).exists()]
+    if requested == "model" and missing:
+        raise SystemExit(f"Models not found in {model_path('x').parent}: {', '.join(missing)} (no download offline)")
+    if requested == "auto":
+        return "stub" if missing else "model"
+    return requested
+
+
+# ==================== RUN ====================
+
+def percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p * (len(ordered) - 1))))]
+
+
+def peak_rss_mb() -> float:
+    """High-water RSS of this process"""
+    try:
+        # VmHWM restarts at exec; ru_maxrss keeps the parent's peak at fork time
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    # ru_maxrss is in KiB on Linux, bytes on macOS
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 ** 2 if sys.platform == "darwin" else 1024), 1)
+
+
+def run_case(source: str, plan: str, segmenter: str, repeat: int, warmup: int) -> dict:
+    """One (plan, source image) case; runs in its own process"""
+    settings = PLANS[plan]
+    if segmenter == "stub":
+        image_pipeline._sessions[settings["model"]] = StubSession(settings["model"])
+
+    latencies, stage_ms = [], {}
+    cpu_seconds = 0.0
+    with tempfile.TemporaryDirectory() as out_dir:
+        target = os.path.join(out_dir, "out.jpg")
+        for i in range(warmup + repeat):
+            start, start_cpu = time.perf_counter(), time.process_time()
+            result = image_pipeline.process_images(
+                [(source, target)], settings["model"], settings["quality"], settings["stages"], settings["encoder"]
+            )[0]
+            wall, cpu = time.perf_counter() - start, time.process_time() - start_cpu
+            if result["error"]:
+                raise RuntimeError(f"{plan} {source}: {result['error']}")
+            if i < warmup:
+                continue  # model load, first-touch allocations
+            latencies.append(wall * 1000)
+            cpu_seconds += cpu
+            for stage, timing in result["timings"].items():
+                stage_ms.setdefault(stage, []).append(timing["wall_ms"])
+        output_bytes = os.path.getsize(target)
+
+    return {
+        "p50_ms": round(percentile(latencies, 0.50), 2),
+        "p95_ms": round(percentile(latencies, 0.95), 2),
+        "p99_ms": round(percentile(latencies, 0.99), 2),
+        "images_per_core_s": round(repeat / cpu_seconds, 3) if cpu_seconds else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+        "output_kb": round(output_bytes / 1024, 1),
+        "stages_ms": {stage: round(percentile(values, 0.50), 2) for stage, values in stage_ms.items()},
+    }
+
+
+def run_suite(plans, sizes, formats, segmenter, repeat, warmup, corpus_dir: Path) -> dict:
+    cases = {}
+    # spawn: a fresh interpreter per case, so ru_maxrss doesn't carry over from the previous one
+    context = multiprocessing.get_context("spawn")
+    for plan in plans:
+        for size in sizes:
+            for fmt in formats:
+                source = corpus_file(corpus_dir, size, fmt)
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                    case = pool.submit(run_case, str(source), plan, segmenter, repeat, warmup).result()
+                name = f"{plan}/{size}/{fmt}"
+                cases[name] = case
+                print(format_case(name, case), flush=True)
+    return {
+        "config": {
+            "segmenter": segmenter,
+            **({"note": STUB_NOTE} if segmenter == "stub" else {}),
+            "repeat": repeat,
+            "warmup": warmup,
+        },
+        "machine": {
+            "platform": platform.platform(),
+            "processor": platform.processor() or platform.machine(),
+            "cpus": os.cpu_count(),
+            "python": platform.python_version(),
+        },
+        "cases": cases,
+    }
+
+
+def format_case(name: str, case: dict) -> str:
+    stages = " ".join(f"{stage}={ms:g}" for stage, ms in case["stages_ms"].items())
+    return (
+        f"{name:<22} p50 {case['p50_ms']:>8.1f}ms  p95 {case['p95_ms']:>8.1f}ms  p99 {case['p99_ms']:>8.1f}ms  "
+        f"{case['images_per_core_s']:>7.2f} img/s/core  rss {case['peak_rss_mb']:>6.0f}MB  | {stages}"
+    )
+
+
+# ==================== BASELINE ====================
+
+def compare(report: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Regressions of report against baseline, one message each (empty = none)"""
+    regressions = []
+    for name, case in report["cases"].items():
+        base = baseline["cases"].get(name)
+        if base is None:
+            continue
+        for key in ("p50_ms", "p95_ms"):
+            if case[key] > base[key] * (1 + tolerance) and case[key] - base[key] > LATENCY_SLACK_MS:
+                regressions.append(f"{name}: {key} {base[key]} -> {case[key]}")
+        if case["images_per_core_s"] < base["images_per_core_s"] * (1 - tolerance):
+            regressions.append(f"{name}: images_per_core_s {base['images_per_core_s']} -> {case['images_per_core_s']}")
+        if case["peak_rss_mb"] > base["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(f"{name}: peak_rss_mb {base['peak_rss_mb']} -> {case['peak_rss_mb']}")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--plans", nargs="+", choices=sorted(PLANS), default=["starter"])
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=list(SIZES))
+    parser.add_argument("--formats", nargs="+", choices=list(SOURCE_FORMATS), default=list(SOURCE_FORMATS))
+    parser.add_argument("--segmenter", choices=["auto", "model", "stub"], default="auto")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per case")
+    parser.add_argument("--warmup", type=int, default=1, help="untimed runs per case")
+    parser.add_argument("--corpus-dir", type=Path, default=DEFAULT_CORPUS_DIR)
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="allowed relative slowdown")
+    parser.add_argument("--json", type=Path, help="also write the full report here")
+    args = parser.parse_args(argv)
+
+    segmenter = pick_segmenter(args.segmenter, [PLANS[plan]["model"] for plan in args.plans])
+    print(f"segmenter: {segmenter}" + (f" ({STUB_NOTE})" if segmenter == "stub" else ""))
+    report = run_suite(args.plans, args.sizes, args.formats, segmenter, args.repeat, args.warmup, args.corpus_dir)
+
+    if args.json:
+        args.json.write_text(json.dumps(report, indent=2) + "\n")
+    if args.save_baseline:
+        baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {"cases": {}}
+        if baseline.get("config", report["config"])["segmenter"] != segmenter:
+            baseline["cases"] = {}  # don't mix stub and model numbers
+        baseline.update({"config": report["config"], "machine": report["machine"]})
+        baseline["cases"].update(report["cases"])
+        args.baseline.write_text(json.dumps(baseline, indent=2, sort_keys=True) + "\n")
+        print(f"baseline saved to {args.baseline}")
+        return 0
+    if not args.baseline.exists():
+        print(f"no baseline at {args.baseline}, run with --save-baseline to record one")
+        return 0
+
+    baseline = json.loads(args.baseline.read_text())
+    if baseline["config"]["segmenter"] != segmenter:
+        print(f"baseline was recorded with the {baseline['config']['segmenter']} segmenter, this run used {segmenter}")
+        return 2
+    if baseline.get("machine", {}).get("processor") != report["machine"]["processor"]:
+        print(f"warning: baseline comes from another CPU ({baseline.get('machine', {}).get('processor')})")
+    regressions = compare(report, baseline, args.tolerance)
+    if regressions:
+        print(f"\n{len(regressions)} REGRESSION(S) beyond {args.tolerance:.0%} of {args.baseline}:")
+        for regression in regressions:
+            print(f"  REGRESSION {regression}")
+        return 1
+    print(f"\nno regression beyond {args.tolerance:.0%} of {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
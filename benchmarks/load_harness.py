@@ -0,0 +1,298 @@
+"""In-process load harness for the API.
+
+Drives server.app through httpx's ASGI transport, with mongomock-motor as the
+database and files under a temporary directory, so no deployed environment,
+Mongo server or network is needed. Background removal uses the stub session of
+bench_pipeline by default (--rembg model for the real ONNX models, if they are
+already in ~/.u2net).
+
+Scenarios, each run by --concurrency workers for --ops operations:
+
+    sessions  fresh session tokens hitting /api/auth/me, cold then warm
+    uploads   upload + process (sync) + fetch the result, every upload distinct
+    history   page through a user's history with the X-Next-Cursor header
+    profile   poll /api/user/profile
+
+    python benchmarks/load_harness.py                                  # all scenarios, one after another
+    python benchmarks/load_harness.py --scenarios history profile --mixed --concurrency 64
+
+Reports per route: requests, errors, req/s, p50/p95/p99/max latency. The
+database is an in-memory fake, so compare runs with each other rather than
+with production; what it isolates is the cost of our own auth, query and file
+serving code paths.
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+
+ROOT_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(ROOT_DIR.parent / "backend"))
+
+# server.py reads these at import time
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "load_harness")
+
+import httpx  # noqa: E402
+
+import bench_pipeline  # noqa: E402
+from usage import repair_usage  # noqa: E402
+
+SCENARIOS = ("sessions", "uploads", "history", "profile")
+
+
+class Recorder:
+    """Latency samples and error counts per route label"""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+
+    async def request(self, client: httpx.AsyncClient, label: str, method: str, url: str, **kwargs) -> httpx.Response:
+        start = time.perf_counter()
+        response = await client.request(method, url, **kwargs)
+        self.samples.setdefault(label, []).append((time.perf_counter() - start) * 1000)
+        if response.status_code >= 400:
+            self.errors[label] = self.errors.get(label, 0) + 1
+        return response
+
+    def report(self, wall_seconds: float) -> Dict[str, dict]:
+        return {
+            label: {
+                "requests": len(samples),
+                "errors": self.errors.get(label, 0),
+                "req_per_s": round(len(samples) / wall_seconds, 1),
+                "p50_ms": round(bench_pipeline.percentile(samples, 0.50), 2),
+                "p95_ms": round(bench_pipeline.percentile(samples, 0.95), 2),
+                "p99_ms": round(bench_pipeline.percentile(samples, 0.99), 2),
+                "max_ms": round(max(samples), 2),
+            }
+            for label, samples in sorted(self.samples.items())
+        }
+
+
+class Harness:
+    def __init__(self, server, client: httpx.AsyncClient, args: argparse.Namespace):
+        self.server = server
+        self.client = client
+        self.args = args
+        self.user_ids = [f"load_user_{i}" for i in range(args.users)]
+        self.upload_seq = itertools.count()
+        self.upload_image = b""
+
+    # ==================== SEED ====================
+
+    async def seed(self) -> None:
+        db = self.server.db
+        now = datetime.now(timezone.utc)
+        await db.users.insert_many([
+            {
+                "user_id": user_id, "email": f"{user_id}@load.test", "name": user_id,
+                "credits": 10 ** 9, "subscription": self.args.plan,
+                "created_at": now, "last_credit_reset": now,
+            }
+            for user_id in self.user_ids
+        ])
+        await db.user_sessions.insert_many([
+            {"user_id": user_id, "session_token": self.token(user_id), "expires_at": now + timedelta(days=1), "created_at": now}
+            for user_id in self.user_ids
+        ])
+        if self.args.history_images:
+            images = [
+                {
+                    "image_id": f"img_{uuid.uuid4().hex[:12]}", "user_id": user_id,
+                    "original_filename": f"photo_{i}.jpg", "original_path": "", "processed_path": "",
+                    "status": "completed", "size_bytes": 500_000,
+                    "created_at": now - timedelta(minutes=i), "processed_at": now - timedelta(minutes=i),
+                }
+                for user_id in self.user_ids
+                for i in range(self.args.history_images)
+            ]
+            await db.images.insert_many(images)
+            await repair_usage(db, self.user_ids)
+
+        width, height = bench_pipeline.SIZES[self.args.image_size]
+        buffer = io.BytesIO()
+        bench_pipeline.synthetic_photo(width, height, seed=1).save(buffer, "JPEG", quality=92)
+        self.upload_image = buffer.getvalue()
+
+    @staticmethod
+    def token(user_id: str) -> str:
+        return f"load_{user_id}"
+
+    def headers(self, op: int, token: Optional[str] = None) -> dict:
+        return {"Authorization": f"Bearer {token or self.token(self.user_ids[op % len(self.user_ids)])}"}
+
+    # ==================== SCENARIOS ====================
+
+    async def sessions(self, op: int, recorder: Recorder) -> None:
+        user_id = self.user_ids[op % len(self.user_ids)]
+        token = f"load_{uuid.uuid4().hex}"
+        now = datetime.now(timezone.utc)
+        await self.server.db.user_sessions.insert_one(
+            {"user_id": user_id, "session_token": token, "expires_at": now + timedelta(days=1), "created_at": now}
+        )
+        await recorder.request(self.client, "GET /api/auth/me (new session)", "GET", "/api/auth/me", headers=self.headers(op, token))
+        await recorder.request(self.client, "GET /api/auth/me", "GET", "/api/auth/me", headers=self.headers(op, token))
+
+    async def uploads(self, op: int, recorder: Recorder) -> None:
+        headers = self.headers(op)
+        data = self.upload_image
+        if not self.args.dedup:
+            # Trailing bytes after the JPEG end marker: same pixels, new content hash
+            data += next(self.upload_seq).to_bytes(8, "big")
+        response = await recorder.request(
+            self.client, "POST /api/images/upload", "POST", "/api/images/upload",
+            files={"file": ("photo.jpg", data, "image/jpeg")}, headers=headers,
+        )
+        if response.status_code != 200:
+            return
+        image_id = response.json()["image_id"]
+        response = await recorder.request(
+            self.client, "POST /api/images/process/{image_id}", "POST", f"/api/images/process/{image_id}", headers=headers,
+        )
+        if response.status_code != 200:
+            return
+        await recorder.request(
+            self.client, "GET /api/images/file/{image_id}/{type}", "GET", f"/api/images/file/{image_id}/processed",
+            headers={**headers, "Accept": "image/webp,*/*"},
+        )
+
+    async def history(self, op: int, recorder: Recorder) -> None:
+        headers = self.headers(op)
+        params = {"limit": self.args.page_size}
+        while True:
+            response = await recorder.request(
+                self.client, "GET /api/images/history", "GET", "/api/images/history", params=params, headers=headers,
+            )
+            cursor = response.headers.get("X-Next-Cursor")
+            if response.status_code != 200 or not cursor:
+                return
+            params = {"limit": self.args.page_size, "cursor": cursor}
+
+    async def profile(self, op: int, recorder: Recorder) -> None:
+        await recorder.request(self.client, "GET /api/user/profile", "GET", "/api/user/profile", headers=self.headers(op))
+
+    # ==================== RUN ====================
+
+    async def run(self, scenario: str, recorder: Recorder) -> None:
+        """--ops operations of one scenario spread over --concurrency workers"""
+        operation: Callable[[int, Recorder], Awaitable[None]] = getattr(self, scenario)
+        ops = iter(range(self.args.ops))
+
+        async def worker():
+            for op in ops:
+                await operation(op, recorder)
+
+        await asyncio.gather(*(worker() for _ in range(self.args.concurrency)))
+
+
+def format_report(title: str, wall_seconds: float, routes: Dict[str, dict]) -> str:
+    lines = [f"\n== {title} ({wall_seconds:.2f}s)"]
+    lines.append(f"{'route':<42} {'reqs':>6} {'errs':>5} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+    for label, stats in routes.items():
+        lines.append(
+            f"{label:<42} {stats['requests']:>6} {stats['errors']:>5} {stats['req_per_s']:>8.1f} "
+            f"{stats['p50_ms']:>8.1f} {stats['p95_ms']:>8.1f} {stats['p99_ms']:>8.1f} {stats['max_ms']:>8.1f}"
+        )
+    return "\n".join(lines)
+
+
+def load_server(work_dir: Path, rembg: str):
+    """Import server.py against mongomock and a scratch directory"""
+    try:
+        from mongomock_motor import AsyncMongoMockClient
+    except ImportError:
+        raise SystemExit("The load harness needs mongomock-motor: pip install -r benchmarks/requirements.txt")
+    if rembg == "stub":
+        # Stub sessions live in this process, so the pipeline has to run in threads
+        os.environ["PROCESSING_EXECUTOR"] = "thread"
+
+    import image_pipeline
+    import server
+    from derivative_cache import DerivativeCache
+
+    server.db = AsyncMongoMockClient(tz_aware=True)[os.environ["DB_NAME"]]
+    server.UPLOAD_DIR = work_dir / "uploads"
+    server.PROCESSED_DIR = work_dir / "processed"
+    server.UPLOAD_DIR.mkdir()
+    server.PROCESSED_DIR.mkdir()
+    server.derivative_cache = DerivativeCache(work_dir / "derivatives", server.DERIVATIVE_CACHE_MB * 1024 * 1024)
+    if rembg == "stub":
+        for model_name in server.PROCESSING_MODELS:
+            image_pipeline._sessions[model_name] = bench_pipeline.StubSession(model_name)
+    else:
+        bench_pipeline.pick_segmenter("model", server.PROCESSING_MODELS)
+    return server
+
+
+async def main_async(args: argparse.Namespace) -> dict:
+    with tempfile.TemporaryDirectory(prefix="load_harness_") as work_dir:
+        server = load_server(Path(work_dir), args.rembg)
+        await server.app.router.startup()
+        try:
+            # Don't measure requests competing with the startup warm-up
+            while not server.readiness["ready"]:
+                await asyncio.sleep(0.05)
+            transport = httpx.ASGITransport(app=server.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://load.test", timeout=None) as client:
+                harness = Harness(server, client, args)
+                await harness.seed()
+                results = {}
+                if args.mixed:
+                    recorder = Recorder()
+                    start = time.perf_counter()
+                    await asyncio.gather(*(harness.run(scenario, recorder) for scenario in args.scenarios))
+                    wall = time.perf_counter() - start
+                    results["mixed"] = {"wall_s": round(wall, 3), "routes": recorder.report(wall)}
+                    print(format_report(f"mixed: {' + '.join(args.scenarios)}", wall, results["mixed"]["routes"]))
+                else:
+                    for scenario in args.scenarios:
+                        recorder = Recorder()
+                        start = time.perf_counter()
+                        await harness.run(scenario, recorder)
+                        wall = time.perf_counter() - start
+                        results[scenario] = {"wall_s": round(wall, 3), "routes": recorder.report(wall)}
+                        print(format_report(scenario, wall, results[scenario]["routes"]))
+        finally:
+            await server.app.router.shutdown()
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--mixed", action="store_true", help="run the scenarios at the same time")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--plan", choices=["free", "starter", "pro"], default="starter")
+    parser.add_argument("--concurrency", type=int, default=16, help="workers per scenario")
+    parser.add_argument("--ops", type=int, default=200, help="operations per scenario")
+    parser.add_argument("--history-images", type=int, default=150, help="images seeded per user")
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--image-size", choices=list(bench_pipeline.SIZES), default="1080p")
+    parser.add_argument("--dedup", action="store_true", help="upload identical bytes (exercises result reuse)")
+    parser.add_argument("--rembg", choices=["stub", "model"], default="stub")
+    parser.add_argument("--json", type=Path, help="also write the report here")
+    args = parser.parse_args(argv)
+
+    # Before server.py's INFO basicConfig: per-request logs would swamp the report
+    logging.basicConfig(level=logging.WARNING)
+    results = asyncio.run(main_async(args))
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2) + "\n")
+    errors = sum(stats["errors"] for result in results.values() for stats in result["routes"].values())
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,54 @@
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+
+# The backend and benchmarks are plain script directories, not packages
+ROOT_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT_DIR / "backend"))
+sys.path.insert(0, str(ROOT_DIR / "benchmarks"))
+
+
+@pytest.fixture
+def server(monkeypatch, tmp_path):
+    """The API module on an in-memory Mongo with its indexes, fresh queue, job and
+    cache state, and file storage under tmp_path"""
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    monkeypatch.setenv("MONGO_URL", os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+    monkeypatch.setenv("DB_NAME", os.environ.get("DB_NAME", "test_database"))
+    import server
+    from scheduler import FairScheduler
+    from ttl_cache import TTLCache
+
+    monkeypatch.setattr(server, "db", mongomock_motor.AsyncMongoMockClient(tz_aware=True)["test"])
+    monkeypatch.setattr(server, "processing_queue", FairScheduler(maxsize=server.PROCESSING_QUEUE_SIZE))
+    monkeypatch.setattr(server, "active_jobs", {})
+    monkeypatch.setattr(server, "session_cache", TTLCache(100, 60))
+    monkeypatch.setattr(server, "user_cache", TTLCache(100, 60))
+    for name in ("UPLOAD_DIR", "PROCESSED_DIR"):
+        directory = tmp_path / name.lower()
+        directory.mkdir()
+        monkeypatch.setattr(server, name, directory)
+    asyncio.run(server.ensure_indexes(server.db))
+    return server
+
+
+async def add_user(server, user_id, subscription="free", credits=3):
+    """Insert a user with a session; returns the headers authenticating as them"""
+    now = datetime.now(timezone.utc)
+    await server.db.users.insert_one({
+        "user_id": user_id, "email": f"{user_id}@example.com", "name": user_id, "credits": credits,
+        "subscription": subscription, "created_at": now, "last_credit_reset": now,
+    })
+    await server.db.user_sessions.insert_one({
+        "user_id": user_id, "session_token": f"token_{user_id}", "expires_at": now + timedelta(days=1), "created_at": now,
+    })
+    return {"Authorization": f"Bearer token_{user_id}"}
+
+
+def api_client(server):
+    import httpx
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://test")
@@ -0,0 +1,56 @@
+import asyncio
+
+from tests.conftest import add_user, api_client
+
+
+def test_logout_drops_the_cached_session(server):
+    async def main():
+        headers = await add_user(server, "u1")
+        cookies = {"session_token": "token_u1"}
+        async with api_client(server) as client:
+            assert (await client.get("/api/auth/me", headers=headers)).status_code == 200
+            assert server.session_cache.get("token_u1") is not None
+            client.cookies.update(cookies)
+            assert (await client.post("/api/auth/logout")).status_code == 200
+            client.cookies.clear()
+            return (await client.get("/api/auth/me", headers=headers)).status_code
+
+    assert asyncio.run(main()) == 401
+
+
+def test_credit_changes_drop_the_cached_user(server):
+    async def main():
+        headers = await add_user(server, "u1", credits=3)
+        async with api_client(server) as client:
+            before = (await client.get("/api/auth/me", headers=headers)).json()["credits"]
+            await server.reserve_credits(server.user_cache.get("u1").model_copy(), 2)
+            after = (await client.get("/api/auth/me", headers=headers)).json()["credits"]
+            await server.refund_credits("u1", 1)
+            refunded = (await client.get("/api/auth/me", headers=headers)).json()["credits"]
+        return before, after, refunded
+
+    assert asyncio.run(main()) == (3, 1, 2)
+
+
+def test_a_lookup_racing_a_write_is_not_cached(server, monkeypatch):
+    async def main():
+        headers = await add_user(server, "u1", credits=3)
+        collection_class = type(server.db.users)
+        find_one = collection_class.find_one
+
+        async def find_then_spend(self, *args, **kwargs):
+            doc = await find_one(self, *args, **kwargs)
+            if self.name == "users":
+                # Credits spent while this request was reading the user
+                await server.db.users.update_one({"user_id": "u1"}, {"$inc": {"credits": -1}})
+                server.invalidate_user("u1")
+            return doc
+
+        async with api_client(server) as client:
+            monkeypatch.setattr(collection_class, "find_one", find_then_spend)
+            await client.get("/api/auth/me", headers=headers)
+            monkeypatch.setattr(collection_class, "find_one", find_one)
+            assert server.user_cache.get("u1") is None
+            return (await client.get("/api/auth/me", headers=headers)).json()["credits"]
+
+    assert asyncio.run(main()) == 2
@@ -0,0 +1,28 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+
+from tests.conftest import api_client
+
+
+def test_exchanging_the_same_session_twice_reuses_it(server, monkeypatch):
+    def emergent(request):
+        assert request.headers["X-Session-ID"] == "sid"
+        return httpx.Response(200, json={"email": "a@example.com", "name": "A", "session_token": "tok_a"})
+
+    real_client = httpx.AsyncClient
+    monkeypatch.setattr(server, "httpx", SimpleNamespace(
+        AsyncClient=lambda: real_client(transport=httpx.MockTransport(emergent))
+    ))
+
+    async def main():
+        async with api_client(server) as client:
+            responses = [await client.post("/api/auth/session", json={"session_id": "sid"}) for _ in range(2)]
+            me = await client.get("/api/auth/me", headers={"Authorization": "Bearer tok_a"})
+        sessions = await server.db.user_sessions.find({"session_token": "tok_a"}).to_list(10)
+        return [response.status_code for response in responses], me.status_code, sessions
+
+    statuses, me_status, sessions = asyncio.run(main())
+    assert statuses == [200, 200] and me_status == 200
+    assert len(sessions) == 1 and sessions[0]["expires_at"] > sessions[0]["created_at"]
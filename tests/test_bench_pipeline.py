@@ -0,0 +1,39 @@
+import bench_pipeline
+
+
+def _case(p50, p95=None, per_core=10.0, rss=300.0):
+    return {"p50_ms": p50, "p95_ms": p95 or p50, "images_per_core_s": per_core, "peak_rss_mb": rss}
+
+
+def test_compare_flags_regressions_beyond_tolerance():
+    baseline = {"cases": {
+        "starter/4K/jpeg": _case(400.0),
+        "starter/720p/jpeg": _case(10.0),
+        "starter/1080p/png": _case(200.0, per_core=5.0, rss=400.0),
+    }}
+    report = {"cases": {
+        "starter/4K/jpeg": _case(560.0),  # +40%
+        "starter/720p/jpeg": _case(14.0),  # +40% but only 4ms: noise
+        "starter/1080p/png": _case(210.0, per_core=3.0, rss=620.0),
+        "pro/4K/jpeg": _case(9999.0),  # not in the baseline
+    }}
+    regressions = bench_pipeline.compare(report, baseline, tolerance=0.25)
+    assert regressions == [
+        "starter/4K/jpeg: p50_ms 400.0 -> 560.0",
+        "starter/4K/jpeg: p95_ms 400.0 -> 560.0",
+        "starter/1080p/png: images_per_core_s 5.0 -> 3.0",
+        "starter/1080p/png: peak_rss_mb 400.0 -> 620.0",
+    ]
+    assert bench_pipeline.compare(report, baseline, tolerance=0.5) == [
+        "starter/1080p/png: peak_rss_mb 400.0 -> 620.0",
+    ]
+
+
+def test_run_case_with_stub_segmenter(tmp_path, monkeypatch):
+    # run_case registers its stub session, keep it out of the other tests
+    monkeypatch.setattr(bench_pipeline.image_pipeline, "_sessions", {})
+    source = tmp_path / "photo.jpg"
+    bench_pipeline.synthetic_photo(320, 240, seed=1).save(source, "JPEG")
+    case = bench_pipeline.run_case(str(source), "free", "stub", repeat=2, warmup=1)
+    assert case["p50_ms"] > 0 and case["images_per_core_s"] > 0
+    assert list(case["stages_ms"]) == ["decode", "resize", "segment", "composite+enhance", "watermark", "encode"]
@@ -0,0 +1,105 @@
+import asyncio
+import io
+from datetime import datetime, timedelta, timezone
+
+from PIL import Image
+
+from tests.conftest import add_user, api_client
+
+
+def jpeg_bytes(color=(200, 30, 30)):
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 48), color).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+async def upload(client, headers, data):
+    response = await client.post("/api/images/upload", headers=headers, files={"file": ("a.jpg", data, "image/jpeg")})
+    assert response.status_code == 200
+    return response.json()["image_id"]
+
+
+async def blob_for(server, image_id, field="original_blob"):
+    image = await server.db.images.find_one({"image_id": image_id})
+    return await server.db.blobs.find_one({"blob_key": image[field]})
+
+
+def test_same_bytes_share_one_blob_until_the_last_delete(server):
+    async def main():
+        alice, bob = await add_user(server, "alice"), await add_user(server, "bob")
+        async with api_client(server) as client:
+            first = await upload(client, alice, jpeg_bytes())
+            second = await upload(client, bob, jpeg_bytes())
+            shared = await blob_for(server, first)
+            assert shared == await blob_for(server, second)
+            assert shared["refcount"] == 2
+            assert await server.db.blobs.count_documents({}) == 1
+            assert len(list(server.UPLOAD_DIR.rglob("*.jpg"))) == 1
+
+            assert (await client.delete(f"/api/images/{first}", headers=alice)).status_code == 200
+            kept = await server.db.blobs.find_one({"blob_key": shared["blob_key"]})
+            assert kept["refcount"] == 1
+            assert server.locate(kept["path"]).exists()
+
+            assert (await client.delete(f"/api/images/{second}", headers=bob)).status_code == 200
+        assert await server.db.blobs.count_documents({}) == 0
+        assert not server.locate(shared["path"]).exists()
+
+    asyncio.run(main())
+
+
+def test_acquire_waits_out_a_tombstone_and_recreates_the_blob(server):
+    path = server.UPLOAD_DIR / "abc.jpg"
+
+    async def main():
+        # A release in progress: the acquire must not revive the doc whose file is going away
+        await server.db.blobs.insert_one({
+            "blob_key": "original:abc", "path": str(path), "refcount": 0, "deleting_at": datetime.now(timezone.utc)
+        })
+
+        async def finish_release():
+            await asyncio.sleep(0.05)
+            await server.db.blobs.delete_one({"blob_key": "original:abc"})
+
+        release = asyncio.create_task(finish_release())
+        blob = await server.acquire_blob("original:abc", path)
+        assert release.done()
+
+        # Left behind by a process that died mid-release
+        await server.db.blobs.update_one({"blob_key": "original:abc"}, {"$set": {
+            "refcount": 0, "deleting_at": datetime.now(timezone.utc) - timedelta(seconds=server.BLOB_TOMBSTONE_SECONDS + 1)
+        }})
+        stale = await asyncio.wait_for(server.acquire_blob("original:abc", path), 1)
+        return blob, stale
+
+    blob, stale = asyncio.run(main())
+    for acquired in (blob, stale):
+        assert acquired["refcount"] == 1 and acquired["path"] == str(path) and acquired.get("deleting_at") is None
+
+
+def test_identical_original_reuses_the_processed_result(server):
+    async def main():
+        alice, bob = await add_user(server, "alice"), await add_user(server, "bob")
+        async with api_client(server) as client:
+            first = await upload(client, alice, jpeg_bytes())
+            second = await upload(client, bob, jpeg_bytes())
+            # first was processed already: its result is in place and referenced
+            image = await server.db.images.find_one({"image_id": first})
+            key = server.processed_blob_key(image, server.PLAN_LIMITS["free"])
+            path = server.processed_blob_path(key, first)
+            path.parent.mkdir(parents=True)
+            path.write_bytes(jpeg_bytes((255, 255, 255)))
+            await server.acquire_blob(key, path)
+            await server.db.images.update_one({"image_id": first}, {"$set": {
+                "status": "completed", "processed_blob": key, "processed_path": str(path)
+            }})
+
+            response = await client.post(f"/api/images/process/{second}", headers=bob)
+        assert response.status_code == 200
+        assert server.processing_queue.qsize() == 0  # no inference
+        reused = await server.db.images.find_one({"image_id": second})
+        assert reused["status"] == "completed" and reused["processed_blob"] == key
+        assert (await blob_for(server, second, "processed_blob"))["refcount"] == 2
+        assert (await server.db.users.find_one({"user_id": "bob"}))["credits"] == 2
+
+    asyncio.run(main())
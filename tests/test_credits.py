@@ -0,0 +1,91 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+from tests.conftest import add_user, api_client
+
+
+async def add_image(server, user_id, image_id):
+    await server.db.images.insert_one({
+        "image_id": image_id, "user_id": user_id, "original_filename": "a.jpg", "original_path": f"/x/{image_id}.jpg",
+        "status": "pending", "job_id": None, "created_at": datetime.now(timezone.utc),
+    })
+
+
+async def credits(server, user_id):
+    return (await server.db.users.find_one({"user_id": user_id}))["credits"]
+
+
+async def get_user(server, user_id):
+    return server.User(**await server.db.users.find_one({"user_id": user_id}, {"_id": 0}))
+
+
+def pipeline_results(error):
+    async def run_in_processing_executor(func, pairs, *args):
+        return [{"error": error, "timings": {}} for _ in pairs]
+    return run_in_processing_executor
+
+
+def test_reserve_takes_credits_only_when_there_are_enough(server):
+    async def main():
+        await add_user(server, "u1", credits=2)
+        await add_user(server, "u2", subscription="pro", credits=0)
+        user = await get_user(server, "u1")
+        outcomes = [await server.reserve_credits(user, 2), await server.reserve_credits(user, 1)]
+        unlimited = await server.reserve_credits(await get_user(server, "u2"), 5)
+        return outcomes, user.credits, await credits(server, "u1"), unlimited, await credits(server, "u2")
+
+    assert asyncio.run(main()) == ([True, False], 0, 0, True, 0)
+
+
+def test_over_quota_batch_is_refused_without_spending(server):
+    async def main():
+        headers = await add_user(server, "u1", credits=2)
+        for i in range(3):
+            await add_image(server, "u1", f"img_{i}")
+        async with api_client(server) as client:
+            response = await client.post(
+                "/api/images/process-batch", headers=headers, json={"image_ids": ["img_0", "img_1", "img_2"]}
+            )
+        return response.status_code, await credits(server, "u1"), server.processing_queue.qsize()
+
+    assert asyncio.run(main()) == (403, 2, 0)
+
+
+@pytest.mark.parametrize("error, expected_credits, expected_status", [
+    ("boom", 3, "failed"),
+    (None, 2, "completed"),
+])
+def test_failed_processing_refunds_the_credit(server, monkeypatch, tmp_path, error, expected_credits, expected_status):
+    monkeypatch.setattr(server, "PROCESSED_DIR", tmp_path)
+    monkeypatch.setattr(server, "run_in_processing_executor", pipeline_results(error))
+
+    async def main():
+        headers = await add_user(server, "u1", credits=3)
+        await add_image(server, "u1", "img_0")
+        async with api_client(server) as client:
+            response = await client.post("/api/images/process/img_0", headers=headers, params={"mode": "job"})
+        assert response.status_code == 202
+        reserved = await credits(server, "u1")
+        await server.run_processing_job(await server.processing_queue.get())
+        image = await server.db.images.find_one({"image_id": "img_0"})
+        return reserved, await credits(server, "u1"), image["status"]
+
+    assert asyncio.run(main()) == (2, expected_credits, expected_status)
+
+
+def test_full_queue_refunds_the_reservation(server, monkeypatch):
+    monkeypatch.setattr(server, "processing_queue", server.FairScheduler(maxsize=1))
+    server.processing_queue.put_nowait(object(), user_id="someone else")
+
+    async def main():
+        headers = await add_user(server, "u1", credits=3)
+        await add_image(server, "u1", "img_0")
+        async with api_client(server) as client:
+            single = await client.post("/api/images/process/img_0", headers=headers, params={"mode": "job"})
+            batch = await client.post("/api/images/process-batch", headers=headers, json={"image_ids": ["img_0"]})
+        image = await server.db.images.find_one({"image_id": "img_0"})
+        return single.status_code, batch.status_code, await credits(server, "u1"), image["job_id"]
+
+    assert asyncio.run(main()) == (503, 503, 3, None)
@@ -0,0 +1,29 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+from db_setup import migrate_string_dates
+
+
+def test_string_dates_become_dates_and_garbage_is_left_alone():
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    db = mongomock_motor.AsyncMongoMockClient(tz_aware=True)["test"]
+
+    async def main():
+        await db.users.insert_many([
+            {"user_id": "u1", "created_at": "2025-01-02T03:04:05+00:00", "last_credit_reset": "2025-02-01T00:00:00"},
+            {"user_id": "u2", "created_at": "last tuesday", "last_credit_reset": "2025-02-01T00:00:00+00:00"},
+            {"user_id": "u3", "created_at": "not a date either", "last_credit_reset": datetime(2025, 3, 1)},
+        ])
+        updated = await migrate_string_dates(db, batch_size=1)
+        again = await migrate_string_dates(db, batch_size=1)
+        return updated, again, {doc["user_id"]: doc for doc in await db.users.find().to_list(10)}
+
+    updated, again, users = asyncio.run(main())
+    assert (updated, again) == (2, 0)
+    assert users["u1"]["created_at"] == datetime(2025, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+    assert users["u1"]["last_credit_reset"] == datetime(2025, 2, 1, tzinfo=timezone.utc)
+    assert users["u2"]["created_at"] == "last tuesday"
+    assert users["u2"]["last_credit_reset"] == datetime(2025, 2, 1, tzinfo=timezone.utc)
+    assert users["u3"]["created_at"] == "not a date either"
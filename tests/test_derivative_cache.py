@@ -0,0 +1,46 @@
+import asyncio
+
+from derivative_cache import DerivativeCache
+
+
+def writer(size, calls):
+    async def render(path):
+        calls.append(path.name)
+        await asyncio.sleep(0)
+        path.write_bytes(b"x" * size)
+    return render
+
+
+def test_evicts_least_recently_used(tmp_path):
+    async def scenario():
+        cache = DerivativeCache(tmp_path, max_bytes=250)
+        calls = []
+        await cache.get_or_create("a", writer(100, calls))
+        await cache.get_or_create("b", writer(100, calls))
+        await cache.get_or_create("a", writer(100, calls))  # a is now the most recent
+        await cache.get_or_create("c", writer(100, calls))
+        return cache, calls
+
+    cache, calls = asyncio.run(scenario())
+    assert calls == ["a", "b", "c"]
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["a", "c"]
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["bytes"] == 200
+
+
+def test_concurrent_misses_render_once(tmp_path):
+    async def scenario():
+        cache = DerivativeCache(tmp_path, max_bytes=1000)
+        calls = []
+        await asyncio.gather(*[cache.get_or_create("a", writer(10, calls)) for _ in range(5)])
+        return calls
+
+    assert asyncio.run(scenario()) == ["a"]
+
+
+def test_index_rebuilt_from_disk(tmp_path):
+    (tmp_path / "old").write_bytes(b"x" * 100)
+    (tmp_path / "leftover.tmp").write_bytes(b"x" * 100)
+    cache = DerivativeCache(tmp_path, max_bytes=1000)
+    assert cache.stats()["entries"] == 1
+    assert cache.stats()["bytes"] == 100
@@ -0,0 +1,49 @@
+import asyncio
+
+from starlette.requests import Request
+
+from file_responses import cached_file_response
+
+
+def make_request(headers):
+    return Request({"type": "http", "headers": [(k.lower().encode(), v.encode()) for k, v in headers.items()]})
+
+
+def body(response):
+    async def collect():
+        return b"".join([chunk async for chunk in response.body_iterator])
+    return asyncio.run(collect())
+
+
+def test_etag_and_conditional_request(tmp_path):
+    path = tmp_path / "a.png"
+    path.write_bytes(b"0123456789")
+
+    response = cached_file_response(make_request({}), path, "abc")
+    assert response.status_code == 200
+    assert response.headers["etag"] == '"abc"'
+    assert response.media_type == "image/png"
+    assert body(response) == b"0123456789"
+
+    response = cached_file_response(make_request({"If-None-Match": '"zzz", W/"abc"'}), path, "abc")
+    assert response.status_code == 304
+
+
+def test_byte_ranges(tmp_path):
+    path = tmp_path / "a.jpg"
+    path.write_bytes(b"0123456789")
+
+    response = cached_file_response(make_request({"Range": "bytes=2-4"}), path)
+    assert response.status_code == 206
+    assert response.headers["content-range"] == "bytes 2-4/10"
+    assert body(response) == b"234"
+
+    response = cached_file_response(make_request({"Range": "bytes=-3"}), path)
+    assert body(response) == b"789"
+
+    response = cached_file_response(make_request({"Range": "bytes=20-"}), path)
+    assert response.status_code == 416
+
+    # Stale If-Range: full body instead of a range of the wrong version
+    response = cached_file_response(make_request({"Range": "bytes=2-4", "If-Range": '"old"'}), path, "new")
+    assert response.status_code == 200
@@ -0,0 +1,87 @@
+import asyncio
+import base64
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+
+from tests.conftest import add_user, api_client
+
+T0 = datetime(2026, 10, 1, 12, tzinfo=timezone.utc)
+
+
+async def add_images(server, user_id, specs):
+    await server.db.images.insert_many([
+        {"image_id": image_id, "user_id": user_id, "original_filename": "a.jpg", "original_path": "/x",
+         "status": status, "created_at": created_at}
+        for image_id, created_at, status in specs
+    ])
+
+
+async def all_pages(client, headers, **params):
+    pages, cursor = [], None
+    while True:
+        response = await client.get("/api/images/history", headers=headers, params={**params, **({"cursor": cursor} if cursor else {})})
+        assert response.status_code == 200
+        pages.append([image["image_id"] for image in response.json()])
+        cursor = response.headers.get("x-next-cursor")
+        if not cursor:
+            return pages
+
+
+def test_cursor_round_trip():
+    import server
+    cursor = server.encode_history_cursor({"created_at": T0, "image_id": "img_b"})
+    query = server.history_cursor_filter(cursor)
+    assert {"created_at": T0, "image_id": {"$lt": "img_b"}} in query["$or"]
+    assert {"created_at": {"$lt": T0}} in query["$or"]
+
+
+@pytest.mark.parametrize("cursor", [
+    "not base64!",
+    base64.urlsafe_b64encode(b"[1, 2]").decode(),
+    base64.urlsafe_b64encode(b'{"c": "2026-10-01", "s": false}').decode(),
+    base64.urlsafe_b64encode(b'{"c": "yesterday", "s": false, "i": "img_a"}').decode(),
+])
+def test_malformed_cursor_is_rejected(cursor):
+    import server
+    with pytest.raises(HTTPException) as exc:
+        server.history_cursor_filter(cursor)
+    assert exc.value.status_code == 400
+
+
+def test_pages_walk_ties_on_created_at_exactly_once(server):
+    async def main():
+        headers = await add_user(server, "u1")
+        # Five images created in the same instant, around others
+        await add_images(server, "u1", [
+            ("img_0", T0 + timedelta(minutes=1), "completed"),
+            *[(f"img_{i}", T0, "completed") for i in range(1, 6)],
+            ("img_6", T0 - timedelta(minutes=1), "failed"),
+        ])
+        await add_images(server, "u2", [("img_other", T0, "completed")])
+        async with api_client(server) as client:
+            pages = await all_pages(client, headers, limit=2)
+            bad = await client.get("/api/images/history", headers=headers, params={"cursor": "garbage"})
+        return pages, bad
+
+    pages, bad = asyncio.run(main())
+    assert pages == [["img_0", "img_5"], ["img_4", "img_3"], ["img_2", "img_1"], ["img_6"]]
+    assert bad.status_code == 400
+
+
+def test_status_filter_combines_with_the_cursor(server):
+    async def main():
+        headers = await add_user(server, "u1")
+        statuses = ["completed", "failed", "completed", "pending", "completed"]
+        await add_images(server, "u1", [
+            (f"img_{i}", T0 - timedelta(minutes=i % 2), status) for i, status in enumerate(statuses)
+        ])
+        async with api_client(server) as client:
+            completed = await all_pages(client, headers, limit=1, status="completed")
+            unfinished = await all_pages(client, headers, limit=1, status="pending,failed")
+        return completed, unfinished
+
+    completed, unfinished = asyncio.run(main())
+    assert completed == [["img_4"], ["img_2"], ["img_0"]]
+    assert unfinished == [["img_3"], ["img_1"]]
@@ -0,0 +1,91 @@
+import asyncio
+import io
+from datetime import datetime, timezone
+
+import pytest
+from fastapi import HTTPException
+from PIL import Image
+
+from derivative_cache import DerivativeCache
+from tests.conftest import api_client
+
+
+@pytest.fixture
+def files(server, monkeypatch, tmp_path):
+    """server with an uploaded 2400x1600 original, rendering variants inline"""
+    async def run_inline(func, *args):
+        return func(*args)
+
+    monkeypatch.setattr(server, "run_in_processing_executor", run_inline)
+    monkeypatch.setattr(server, "derivative_cache", DerivativeCache(tmp_path / "derivatives", 10 * 1024 * 1024))
+    path = server.UPLOAD_DIR / "big.jpg"
+    Image.new("RGB", (2400, 1600), (20, 120, 220)).save(path)
+    asyncio.run(server.db.images.insert_one({
+        "image_id": "img_big", "user_id": "u1", "original_filename": "big.jpg", "original_path": str(path),
+        "status": "pending", "created_at": datetime.now(timezone.utc),
+    }))
+    return server
+
+
+def get(server, url, **kwargs):
+    async def main():
+        async with api_client(server) as client:
+            return await client.get(url, **kwargs)
+    return asyncio.run(main())
+
+
+def test_widths_round_up_to_a_bucket_and_are_capped():
+    import server
+    assert [server.derivative_width(w) for w in (1, 64, 65, 1000, 1920)] == [64, 64, 128, 1024, 1920]
+    assert server.derivative_width(5000) == server.DERIVATIVE_WIDTHS[-1] == 1920
+    for w in (0, -5):
+        with pytest.raises(HTTPException) as exc:
+            server.derivative_width(w)
+        assert exc.value.status_code == 400
+
+
+def test_wide_requests_get_the_largest_variant(files):
+    response = get(files, "/api/images/file/img_big/original", params={"w": 5000, "format": "jpeg"})
+    assert response.status_code == 200
+    assert Image.open(io.BytesIO(response.content)).size == (1920, 1280)
+
+
+@pytest.mark.parametrize("accept, expected", [
+    ("image/avif,image/webp,image/*,*/*;q=0.8", "avif"),
+    ("image/webp,image/avif", "avif"),  # our preference, not the header's order
+    ("image/webp,*/*", "webp"),
+    ("image/avif;q=0,image/webp", "webp"),
+    ("image/avif; q=0.0, image/webp;q=0", "jpeg"),
+    ("image/avif;q=0.5", "avif"),
+    ("image/*,*/*", "jpeg"),  # wildcards don't opt into newer formats
+    ("", "jpeg"),
+    ("IMAGE/WEBP", "webp"),
+])
+def test_accept_negotiation(monkeypatch, accept, expected):
+    import server
+    monkeypatch.setattr(server, "NEGOTIATED_FORMATS", ["avif", "webp"])
+    assert server.negotiate_image_format(accept) == expected
+
+
+def test_negotiated_responses_vary_on_accept(files, monkeypatch):
+    monkeypatch.setattr(files, "NEGOTIATED_FORMATS", ["webp"])
+    processed = files.PROCESSED_DIR / "done.jpg"
+    Image.new("RGB", (300, 200), (255, 255, 255)).save(processed)
+    asyncio.run(files.db.images.update_one({"image_id": "img_big"}, {"$set": {
+        "status": "completed", "processed_path": str(processed)
+    }}))
+
+    webp = get(files, "/api/images/file/img_big/processed", headers={"Accept": "image/webp"})
+    assert webp.headers["content-type"] == "image/webp" and webp.headers["vary"] == "Accept"
+    assert Image.open(io.BytesIO(webp.content)).format == "WEBP"
+
+    # Not accepted: the stored JPEG as it is
+    stored = get(files, "/api/images/file/img_big/processed", headers={"Accept": "image/*"})
+    assert stored.headers["vary"] == "Accept" and stored.content == processed.read_bytes()
+
+    resized = get(files, "/api/images/file/img_big/original", params={"w": 100}, headers={"Accept": "image/webp"})
+    assert resized.headers["content-type"] == "image/webp" and resized.headers["vary"] == "Accept"
+
+    # Full-size originals are never re-encoded, whatever the client accepts
+    original = get(files, "/api/images/file/img_big/original", headers={"Accept": "image/webp"})
+    assert original.content == (files.UPLOAD_DIR / "big.jpg").read_bytes() and "vary" not in original.headers
@@ -0,0 +1,155 @@
+import os
+
+import numpy as np
+from PIL import Image, ImageEnhance
+
+import image_pipeline
+
+
+def legacy_composite_and_enhance(img, mask):
+    """The original PIL chain the fused stage replaces"""
+    img_no_bg = Image.composite(img, Image.new("RGBA", img.size, 0), mask)
+    white_bg = Image.new("RGBA", img.size, (255, 255, 255, 255))
+    final_img = Image.alpha_composite(white_bg, img_no_bg).convert("RGB")
+    final_img = ImageEnhance.Contrast(final_img).enhance(1.1)
+    final_img = ImageEnhance.Sharpness(final_img).enhance(1.2)
+    return ImageEnhance.Brightness(final_img).enhance(1.05)
+
+
+def make_product_photo(width=640, height=480):
+    """Textured subject on a noisy backdrop with a soft-edged radial mask"""
+    rng = np.random.default_rng(42)
+    noise = (rng.random((height // 8, width // 8, 3)) * 255).astype(np.uint8)
+    img = Image.fromarray(noise).resize((width, height), Image.Resampling.BICUBIC)
+    yy, xx = np.mgrid[0:height, 0:width]
+    radius = np.hypot(xx - width / 2, yy - height / 2)
+    mask = np.clip(255 - (radius - height / 4) * 4, 0, 255).astype(np.uint8)
+    return img, Image.fromarray(mask)
+
+
+def test_fused_stage_matches_legacy_chain():
+    img, mask = make_product_photo()
+    expected = np.asarray(legacy_composite_and_enhance(img, mask), dtype=np.int16)
+    actual = np.asarray(image_pipeline.composite_and_enhance(img, mask), dtype=np.int16)
+
+    diff = np.abs(expected - actual)
+    assert actual.shape == expected.shape
+    assert diff.max() <= 6
+    assert diff.mean() <= 0.5
+
+
+def test_fused_stage_handles_tiny_images():
+    for size in [(1, 1), (2, 5), (7, 1)]:
+        img = Image.new("RGB", size, (10, 200, 30))
+        mask = Image.new("L", size, 128)
+        expected = legacy_composite_and_enhance(img, mask).getpixel((0, 0))
+        actual = image_pipeline.composite_and_enhance(img, mask)
+        assert actual.size == size
+        assert all(abs(a - b) <= 2 for a, b in zip(actual.getpixel((0, 0)), expected))
+
+
+def test_plan_stages_fuse_composite_and_enhance():
+    names = [stage.name for stage in image_pipeline.plan_stages(image_pipeline.DEFAULT_STAGES)]
+    assert names == ["decode", "resize", "segment", "composite+enhance", "encode"]
+    names = [stage.name for stage in image_pipeline.plan_stages(["decode", "composite", "resize", "enhance"])]
+    assert names == ["decode", "composite", "resize", "enhance"]
+
+
+def test_unknown_stage_is_rejected():
+    try:
+        image_pipeline.plan_stages(["decode", "sparkle"])
+    except ValueError as e:
+        assert "sparkle" in str(e)
+    else:
+        raise AssertionError("unknown stage accepted")
+
+
+def test_separate_composite_and_enhance_stages_match_fused():
+    img, mask = make_product_photo()
+    ctx = image_pipeline.PipelineContext(model_name="u2net", max_edge=None, stages=())
+    item = image_pipeline.PipelineItem("", "", img=img, mask=mask)
+    image_pipeline.STAGES["composite"].run(item, ctx)
+    image_pipeline.STAGES["enhance"].run(item, ctx)
+
+    fused = np.asarray(image_pipeline.composite_and_enhance(img, mask), dtype=np.int16)
+    diff = np.abs(np.asarray(item.img, dtype=np.int16) - fused)
+    assert diff.max() <= 6
+    assert diff.mean() <= 0.5
+
+
+def test_failed_stage_records_error_and_timings(tmp_path):
+    broken = tmp_path / "broken.jpg"
+    broken.write_bytes(b"not an image")
+    [result] = image_pipeline.process_images([(str(broken), str(tmp_path / "out.jpg"))])
+    assert result["error"]
+    assert set(result["timings"]) == {"decode"}
+    assert set(result["timings"]["decode"]) == {"wall_ms", "cpu_ms"}
+
+
+def test_watermark_blends_badge_into_corner_only():
+    img = Image.new("RGB", (640, 480), (255, 255, 255))
+    out = np.asarray(image_pipeline.apply_watermark(img.copy()), dtype=np.int16)
+    assert out[:240].min() == 255  # top half untouched
+    corner = out[-60:, -200:]
+    assert corner.min() < 230  # badge drawn bottom-right
+
+    # Same size bucket -> the cached overlay is reused
+    rendered = len(image_pipeline._watermarks)
+    image_pipeline.apply_watermark(Image.new("RGB", (650, 490)))
+    assert len(image_pipeline._watermarks) == rendered
+
+
+def test_watermark_on_tiny_image():
+    out = image_pipeline.apply_watermark(Image.new("RGB", (12, 7), (0, 0, 0)))
+    assert out.size == (12, 7)
+
+
+def test_warm_up_runs_one_inference_per_model(monkeypatch):
+    calls = []
+
+    class FakeSession:
+        def predict(self, img):
+            calls.append(img.size)
+            return [Image.new("L", img.size, 255)]
+
+    monkeypatch.setattr(image_pipeline, "_sessions", {"fake-a": FakeSession(), "fake-b": FakeSession()})
+    assert image_pipeline.warm_up(["fake-a", "fake-b"]) == os.getpid()
+    assert calls == [(64, 64), (64, 64)]
+
+
+def test_quality_tiers_cap_the_long_edge():
+    assert image_pipeline.QUALITY_MAX_EDGE == {"720p": 1280, "1080p": 1920, "4K": 3840}
+    for quality, edge in image_pipeline.QUALITY_MAX_EDGE.items():
+        ctx = image_pipeline.PipelineContext(model_name="u2net", max_edge=edge, stages=("resize",))
+        for size, expected in [((5000, 2500), (edge, edge // 2)), ((1000, 6000), (edge // 6, edge)), ((640, 480), (640, 480))]:
+            item = image_pipeline.PipelineItem("", "", img=Image.new("RGB", size))
+            image_pipeline.STAGES["resize"].run(item, ctx)
+            assert item.img.size == expected, quality
+
+
+def test_jpeg_decodes_at_a_reduced_scale(tmp_path):
+    jpeg, png = tmp_path / "big.jpg", tmp_path / "big.png"
+    Image.new("RGB", (6000, 4000), (90, 120, 150)).save(jpeg, quality=80)
+    Image.new("RGB", (3000, 2000), (90, 120, 150)).save(png)
+    # draft() picks the smallest 1/2, 1/4, 1/8 scale whose sides both still cover the edge
+    assert image_pipeline.decode_image(str(jpeg), 1280).size == (3000, 2000)
+    assert image_pipeline.decode_image(str(jpeg), 500).size == (750, 500)
+    assert image_pipeline.decode_image(str(jpeg)).size == (6000, 4000)
+    assert image_pipeline.decode_image(str(png), 1280).size == (3000, 2000)
+
+
+def test_free_plan_output_fits_its_tier(tmp_path, monkeypatch):
+    from plans import PLAN_LIMITS
+
+    monkeypatch.setattr(image_pipeline, "predict_masks", lambda images, model_name: [
+        Image.new("L", img.size, 255) for img in images
+    ])
+    source, target = tmp_path / "in.jpg", tmp_path / "out.jpg"
+    Image.new("RGB", (8000, 6000), (200, 30, 30)).save(source, quality=80)
+    plan = PLAN_LIMITS["free"]
+    [result] = image_pipeline.process_images(
+        [(str(source), str(target))], plan["model"], plan["quality"], plan["stages"], plan["encoder"]
+    )
+    assert result["error"] is None
+    with Image.open(target) as out:
+        assert out.size == (1280, 960)
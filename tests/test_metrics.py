@@ -0,0 +1,23 @@
+from metrics import Counter, Gauge, Histogram
+
+
+def test_histogram_buckets_are_cumulative():
+    hist = Histogram("req_seconds", "Request latency", ("route",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        hist.observe(value, "/api/x")
+    lines = hist.render()
+    assert 'req_seconds_bucket{route="/api/x",le="0.1"} 2' in lines
+    assert 'req_seconds_bucket{route="/api/x",le="1"} 3' in lines
+    assert 'req_seconds_bucket{route="/api/x",le="+Inf"} 4' in lines
+    assert 'req_seconds_count{route="/api/x"} 4' in lines
+    assert 'req_seconds_sum{route="/api/x"} 3.65' in lines
+
+
+def test_counter_and_gauge_render():
+    counter = Counter("rejections_total", "Rejections", ("plan",))
+    counter.inc("free")
+    counter.inc("free", amount=2)
+    assert counter.render()[-1] == 'rejections_total{plan="free"} 3'
+
+    gauge = Gauge("depth", "Queue depth", ("class",), callback=lambda: [(('a"b',), 4)])
+    assert gauge.render() == ["# HELP depth Queue depth", "# TYPE depth gauge", 'depth{class="a\\"b"} 4']
@@ -0,0 +1,83 @@
+import asyncio
+import os
+import time
+from collections import Counter
+
+from profiling import ProfileStore, Sampler
+
+
+def test_sampler_records_where_the_task_awaits():
+    async def wait_for_db(future):
+        return await future
+
+    async def handler(future):
+        return await wait_for_db(future)
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        task = asyncio.create_task(handler(future))
+        await asyncio.sleep(0)  # let it reach the await
+        sampler = Sampler(interval=0.001)
+        session = sampler.start(task, root_frame=None)
+        await asyncio.sleep(0.05)
+        sampler.stop(session)
+        future.set_result(None)
+        await task
+        return session
+
+    session = asyncio.run(main())
+    assert session.samples > 0
+    (stack, count), = session.stacks.items()
+    assert count == session.samples
+    frames = stack.split(";")
+    assert frames[0].startswith("test_sampler_records_where_the_task_awaits.<locals>.handler (test_profiling.py:")
+    assert frames[1].startswith("test_sampler_records_where_the_task_awaits.<locals>.wait_for_db (")
+    assert frames[2] == "<await Future>"
+
+
+def test_store_keeps_the_newest_profiles(tmp_path):
+    store = ProfileStore(tmp_path, max_files=2)
+    for i in range(3):
+        store.save(f"req_{i}", Counter({"a;b": 2, "a": 1}), {"request_id": f"req_{i}"})
+        os.utime(tmp_path / f"req_{i}.json", (time.time() + i, time.time() + i))
+    assert [profile["request_id"] for profile in store.list(10)] == ["req_2", "req_1"]
+    assert store.path("req_0") is None
+    assert store.path("req_2").read_text() == "a;b 2\na 1\n"
+    assert store.path("../req_2") is None
+
+
+def test_profile_endpoints_need_the_token(server, monkeypatch, tmp_path):
+    from tests.conftest import api_client
+
+    store = ProfileStore(tmp_path, max_files=10)
+    store.save("req_abc", Counter({"handler;db": 3}), {"request_id": "req_abc"})
+    monkeypatch.setattr(server, "profile_store", store)
+
+    async def main():
+        async with api_client(server) as client:
+            async def statuses(headers):
+                return [
+                    (await client.get(url, headers=headers)).status_code
+                    for url in ("/api/debug/profiles", "/api/debug/profiles/req_abc")
+                ]
+
+            monkeypatch.setattr(server, "PROFILE_TOKEN", None)
+            disabled = await statuses({"Authorization": "Bearer anything"})
+            monkeypatch.setattr(server, "PROFILE_TOKEN", "sekret")
+            missing = await statuses({})
+            wrong = await statuses({"Authorization": "Bearer nope"})
+            non_ascii = await statuses({"Authorization": "Bearer sékret".encode("latin-1")})
+            headers = {"Authorization": "Bearer sekret"}
+            listed = await client.get("/api/debug/profiles", headers=headers)
+            downloaded = await client.get("/api/debug/profiles/req_abc", headers=headers)
+            unknown = await client.get("/api/debug/profiles/req_other", headers=headers)
+        return disabled, missing, wrong, non_ascii, listed, downloaded, unknown
+
+    disabled, missing, wrong, non_ascii, listed, downloaded, unknown = asyncio.run(main())
+    assert disabled == [404, 404]
+    assert missing == wrong == non_ascii == [401, 401]
+    assert listed.status_code == 200 and listed.json() == [{"request_id": "req_abc"}]
+    assert downloaded.status_code == 200 and downloaded.text == "handler;db 3\n"
+    assert 'filename="req_abc.folded"' in downloaded.headers["content-disposition"]
+    assert unknown.status_code == 404
@@ -0,0 +1,77 @@
+import asyncio
+from concurrent.futures import Executor, Future
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from tests.conftest import api_client
+
+
+class BrokenPool(Executor):
+    """A process pool whose worker died: every call fails"""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        future.set_exception(BrokenProcessPool("A process in the process pool was terminated abruptly"))
+        return future
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        self.shut_down = True
+
+
+class InlinePool(Executor):
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        future.set_result(fn(*args, **kwargs))
+        return future
+
+
+@pytest.fixture
+def warmup(server, monkeypatch):
+    monkeypatch.setattr(server, "readiness", {"ready": False, "failed": False, "checks": {}})
+    monkeypatch.setattr(server, "db_migration_task", None)
+    monkeypatch.setattr(server, "PROCESSING_EXECUTOR", "thread")
+    monkeypatch.setattr(server, "WARMUP_RETRY_SECONDS", 0.01)
+    monkeypatch.setattr(server, "WARMUP_MAX_ATTEMPTS", 3)
+    return server
+
+
+def readiness_during(server):
+    """/api/ready while warm_up() runs, then once it has returned"""
+    async def main():
+        async with api_client(server) as client:
+            task = asyncio.create_task(server.warm_up())
+            await asyncio.sleep(0)
+            during = await client.get("/api/ready")
+            await asyncio.wait_for(task, 5)
+            return during, await client.get("/api/ready")
+    return asyncio.run(main())
+
+
+def test_ready_once_the_models_are_warm(warmup, monkeypatch):
+    monkeypatch.setattr(warmup, "processing_executor", InlinePool())
+    monkeypatch.setattr(warmup.image_pipeline, "warm_up", lambda models: 1)
+    during, after = readiness_during(warmup)
+    assert during.status_code == 503 and during.json()["status"] == "warming_up"
+    assert after.status_code == 200 and after.json()["status"] == "ready"
+    assert after.json()["checks"]["models"]["ok"]
+
+
+def test_broken_pool_is_rebuilt_and_warm_up_gives_up(warmup, monkeypatch):
+    pools = [BrokenPool()]
+    monkeypatch.setattr(warmup, "processing_executor", pools[0])
+
+    def create_processing_executor():
+        pools.append(BrokenPool())
+        return pools[-1]
+
+    monkeypatch.setattr(warmup, "create_processing_executor", create_processing_executor)
+    during, after = readiness_during(warmup)
+    assert during.status_code == 503 and during.json()["status"] == "warming_up"
+    # One fresh pool per failed attempt, the broken ones shut down, then no more attempts
+    assert len(pools) == warmup.WARMUP_MAX_ATTEMPTS + 1
+    assert all(getattr(pool, "shut_down", False) for pool in pools[:-1])
+    assert warmup.processing_executor is pools[-1]
+    assert after.status_code == 503
+    body = after.json()
+    assert body["status"] == "failed" and body["checks"]["error"].startswith("Gave up after 3 attempts")
@@ -0,0 +1,42 @@
+import asyncio
+
+import pytest
+
+from scheduler import FairScheduler
+
+
+def _drain(scheduler, count):
+    async def main():
+        return [await scheduler.get() for _ in range(count)]
+    return asyncio.run(main())
+
+
+def test_priority_class_goes_first():
+    scheduler = FairScheduler()
+    for i in range(3):
+        scheduler.put_nowait(f"free-{i}", user_id="a")
+    scheduler.put_nowait("pro", user_id="b", priority_class="priority")
+    assert _drain(scheduler, 4) == ["pro", "free-0", "free-1", "free-2"]
+
+
+def test_users_share_a_class_fairly():
+    scheduler = FairScheduler()
+    for i in range(50):
+        scheduler.put_nowait(f"hog-{i}", user_id="hog")
+    scheduler.put_nowait("b-0", user_id="b")
+    scheduler.put_nowait("b-1", user_id="b", cost=2)
+    order = _drain(scheduler, 52)
+    # b's first job is next in line, not behind the hog's 50
+    assert order.index("b-0") <= 1
+    # a job costing 2 waits for the hog's next two turns
+    assert order.index("b-1") - order.index("b-0") <= 4
+
+
+def test_each_class_has_its_own_limit():
+    scheduler = FairScheduler(maxsize=2)
+    scheduler.put_nowait("free-0", user_id="a")
+    scheduler.put_nowait("free-1", user_id="b")
+    with pytest.raises(asyncio.QueueFull):
+        scheduler.put_nowait("free-2", user_id="c")
+    scheduler.put_nowait("pro", user_id="d", priority_class="priority")
+    assert scheduler.qsize("standard") == 2 and scheduler.qsize("priority") == 1 and scheduler.qsize() == 3
@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+
+from storage import flat_path, is_sharded, locate, migrate_to_sharded, shard_dirs, sharded_path, unlink_everywhere
+
+
+def test_sharded_path_uses_hash_prefixes(tmp_path):
+    path = sharded_path(tmp_path, "23b639f9aa.jpg")
+    assert path == tmp_path / "23" / "b6" / "23b639f9aa.jpg"
+    assert is_sharded(path) and not is_sharded(tmp_path / "23b639f9aa.jpg")
+    assert flat_path(path) == tmp_path / "23b639f9aa.jpg"
+    # Names that aren't hex are spread by their hash
+    legacy = shard_dirs("img_abc_original.jpg")
+    assert all(len(part) == 2 for part in legacy)
+    assert legacy == shard_dirs("img_abc_original.png")
+
+
+def test_locate_and_unlink_find_either_location(tmp_path):
+    flat = tmp_path / "ab12cd.jpg"
+    sharded = sharded_path(tmp_path, flat.name)
+    flat.write_bytes(b"x")
+    assert locate(sharded) == flat  # not migrated yet
+    sharded.parent.mkdir(parents=True)
+    flat.rename(sharded)
+    assert locate(flat) == sharded  # migrated after the path was read
+    assert locate(tmp_path / "missing.jpg") == tmp_path / "missing.jpg"
+    unlink_everywhere(flat)
+    assert not sharded.exists()
+
+
+def test_migration_moves_flat_files_and_is_idempotent(tmp_path):
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    db = mongomock_motor.AsyncMongoMockClient()["test"]
+    uploads, processed = tmp_path / "uploads", tmp_path / "processed"
+    uploads.mkdir()
+    processed.mkdir()
+    shared = uploads / "ab12cd34.jpg"
+    legacy_original, legacy_processed = uploads / "img_b_original.jpg", processed / "img_b_processed.jpg"
+    for path in (shared, legacy_original, legacy_processed):
+        path.write_bytes(path.name.encode())
+    gone = uploads / "img_c_original.jpg"  # deleted after the migration listed it
+    gone_blob = uploads / "ee99ff00.jpg"
+
+    async def main():
+        await db.blobs.insert_many([
+            {"blob_key": "original:ab12cd34", "path": str(shared), "refcount": 2},
+            {"blob_key": "original:ee99ff00", "path": str(gone_blob), "refcount": 1},
+        ])
+        await db.images.insert_many([
+            {"image_id": "img_a1", "original_blob": "original:ab12cd34", "original_path": str(shared)},
+            {"image_id": "img_a2", "original_blob": "original:ab12cd34", "original_path": str(shared)},
+            {"image_id": "img_b", "original_path": str(legacy_original), "processed_path": str(legacy_processed)},
+            {"image_id": "img_c", "original_path": str(gone), "processed_path": None},
+            {"image_id": "img_e", "original_blob": "original:ee99ff00", "original_path": str(gone_blob)},
+        ])
+        first = await migrate_to_sharded(db, batch_size=2)
+        second = await migrate_to_sharded(db, batch_size=2)
+        images = {doc["image_id"]: doc for doc in await db.images.find().to_list(10)}
+        blobs = {doc["blob_key"]: doc for doc in await db.blobs.find().to_list(10)}
+        return first, second, images, blobs
+
+    first, second, images, blobs = asyncio.run(main())
+    assert first == {"blobs": 1, "images": 4}
+    assert second == {"blobs": 0, "images": 0}
+
+    sharded = sharded_path(uploads, shared.name)
+    assert blobs["original:ab12cd34"]["path"] == str(sharded)
+    assert images["img_a1"]["original_path"] == images["img_a2"]["original_path"] == str(sharded)
+    assert sharded.read_bytes() == b"ab12cd34.jpg" and not shared.exists()
+
+    assert images["img_b"]["original_path"] == str(sharded_path(uploads, legacy_original.name))
+    assert images["img_b"]["processed_path"] == str(sharded_path(processed, legacy_processed.name))
+    assert not legacy_original.exists() and not legacy_processed.exists()
+    assert locate(images["img_b"]["processed_path"]).read_bytes() == b"img_b_processed.jpg"
+
+    # Missing files: records keep their path, nothing is left behind in a shard
+    assert images["img_c"]["original_path"] == str(gone)
+    assert images["img_e"]["original_path"] == str(gone_blob) == blobs["original:ee99ff00"]["path"]
+    assert not sharded_path(uploads, gone.name).exists() and not sharded_path(uploads, gone_blob.name).exists()
+
+
+def test_migration_cleans_up_after_a_concurrent_delete(tmp_path, monkeypatch):
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    db = mongomock_motor.AsyncMongoMockClient()["test"]
+    flat = tmp_path / "img_d_original.jpg"
+    flat.write_bytes(b"x")
+    collection_class = type(db.images)
+    update_one = collection_class.update_one
+
+    async def deleted_first(self, query, update, **kwargs):
+        # delete_image runs between the link into the shard and the path update
+        await db.images.delete_one({"image_id": "img_d"})
+        flat.unlink()  # the flat name, as the record still pointed there
+        return await update_one(self, query, update, **kwargs)
+
+    async def main():
+        await db.images.insert_one({"image_id": "img_d", "original_path": str(flat)})
+        monkeypatch.setattr(collection_class, "update_one", deleted_first)
+        return await migrate_to_sharded(db)
+
+    assert asyncio.run(main()) == {"blobs": 0, "images": 0}
+    assert not flat.exists() and not sharded_path(tmp_path, flat.name).exists()
@@ -0,0 +1,39 @@
+import time
+
+from ttl_cache import TTLCache
+
+
+def test_lru_eviction_and_counters():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # b is now the least recently used
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["misses"] == 1
+
+
+def test_entries_expire_and_can_be_invalidated(monkeypatch):
+    cache = TTLCache(maxsize=10, ttl=5)
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.invalidate("b")
+    assert cache.get("b") is None
+
+    monkeypatch.setattr(time, "monotonic", lambda: now + 6)
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_values_loaded_across_an_invalidation_are_dropped():
+    cache = TTLCache(maxsize=10, ttl=60)
+    generation = cache.generation
+    cache.invalidate("a")  # e.g. a logout while "a" was being loaded
+    cache.set("a", "stale", generation)
+    assert cache.get("a") is None
+    cache.set("a", "fresh", cache.generation)
+    assert cache.get("a") == "fresh"
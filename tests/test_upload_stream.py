@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+
+from upload_stream import BodyTooLarge, MultipartFile, UploadError
+
+BOUNDARY = "xXxBoundaryxXx"
+CONTENT_TYPE = f"multipart/form-data; boundary={BOUNDARY}"
+
+
+def multipart_body(*parts):
+    body = b""
+    for headers, data in parts:
+        body += f"--{BOUNDARY}\r\n{headers}\r\n\r\n".encode() + data + b"\r\n"
+    return body + f"--{BOUNDARY}--\r\n".encode()
+
+
+def file_part(name, filename, data, content_type="image/jpeg"):
+    return f'Content-Disposition: form-data; name="{name}"; filename="{filename}"\r\nContent-Type: {content_type}', data
+
+
+async def pieces(body, size=7):
+    for start in range(0, len(body), size):
+        yield body[start:start + size]
+
+
+def read(upload):
+    async def main():
+        return [chunk async for chunk in upload]
+    return asyncio.run(main())
+
+
+def test_streams_the_file_field_in_chunks():
+    data = bytes(range(256)) * 40
+    body = multipart_body(('Content-Disposition: form-data; name="note"', b"hi"), file_part("file", "a.jpg", data))
+    upload = MultipartFile(pieces(body), CONTENT_TYPE, "file", max_body_bytes=len(body), chunk_size=4096)
+    chunks = read(upload)
+    assert b"".join(chunks) == data
+    assert len(chunks) == 3 and all(len(chunk) >= 4096 for chunk in chunks[:-1])
+    assert (upload.filename, upload.content_type) == ("a.jpg", "image/jpeg")
+
+
+def test_stops_reading_past_the_limit():
+    body = multipart_body(file_part("file", "a.jpg", b"x" * 10000))
+    with pytest.raises(BodyTooLarge):
+        read(MultipartFile(pieces(body, 1000), CONTENT_TYPE, "file", max_body_bytes=5000))
+
+
+def test_rejects_bodies_without_the_file():
+    with pytest.raises(UploadError):
+        MultipartFile(pieces(b"{}"), "application/json", "file", max_body_bytes=100)
+    body = multipart_body(file_part("other", "a.jpg", b"x"))
+    with pytest.raises(UploadError):
+        read(MultipartFile(pieces(body), CONTENT_TYPE, "file", max_body_bytes=len(body)))
+    truncated = multipart_body(file_part("file", "a.jpg", b"x" * 100))[:-60]
+    with pytest.raises(UploadError):
+        read(MultipartFile(pieces(truncated), CONTENT_TYPE, "file", max_body_bytes=len(truncated)))
@@ -0,0 +1,106 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from usage import get_usage, month_key, record_usage, repair_usage
+
+OCT = datetime(2026, 10, 5, tzinfo=timezone.utc)
+SEP = datetime(2026, 9, 5, tzinfo=timezone.utc)
+
+
+def test_month_key_is_utc_for_dates_and_iso_strings():
+    assert month_key(datetime(2026, 10, 1, tzinfo=timezone.utc)) == "2026-10"
+    assert month_key("2026-09-30T23:00:00-02:00") == "2026-10"
+    assert month_key(datetime(2026, 10, 1, 1, tzinfo=timezone(timedelta(hours=2)))) == "2026-09"
+    # Naive datetimes (non tz-aware client) are UTC already
+    assert month_key(datetime(2026, 12, 31, 23, 59)) == "2026-12"
+
+
+def test_month_key_of_a_missing_or_broken_date_is_none():
+    assert month_key(None) is None
+    assert month_key("last tuesday") is None
+
+
+@pytest.fixture
+def db():
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    db = mongomock_motor.AsyncMongoMockClient(tz_aware=True)["test"]
+    asyncio.run(db.usage.create_index("user_id", unique=True))
+    return db
+
+
+def add_images(db, user_id, dates):
+    asyncio.run(db.images.insert_many([{"user_id": user_id, "created_at": date} for date in dates]))
+
+
+def test_record_usage_counts_uploads_and_deletes(db):
+    async def main():
+        await record_usage(db, "u1", OCT, 1)
+        await record_usage(db, "u1", SEP, 1)
+        await record_usage(db, "u1", OCT, -1)
+        await record_usage(db, "u1", None, 1)  # no date: only the total moves
+        return await db.usage.find_one({"user_id": "u1"}, {"_id": 0})
+
+    doc = asyncio.run(main())
+    assert doc["total_images"] == 2
+    assert doc["monthly"] == {"2026-10": 0, "2026-09": 1}
+
+
+def test_repair_recounts_from_images(db):
+    add_images(db, "u1", [OCT, OCT, SEP, "garbage"])
+    add_images(db, "u2", [SEP])
+    asyncio.run(db.usage.insert_one({"user_id": "u1", "total_images": 99, "monthly": {"2026-10": 50}}))
+
+    assert asyncio.run(repair_usage(db)) == 2
+    docs = {doc["user_id"]: doc for doc in asyncio.run(db.usage.find().to_list(10))}
+    assert docs["u1"]["total_images"] == 4 and docs["u1"]["monthly"] == {"2026-10": 2, "2026-09": 1}
+    assert docs["u2"]["total_images"] == 1 and "repaired_at" in docs["u2"]
+
+
+def test_get_usage_repairs_once_then_reads_the_counters(db):
+    add_images(db, "u1", [OCT, SEP])
+    assert asyncio.run(get_usage(db, "u1", OCT)) == {"total_images": 2, "images_this_month": 1}
+    # Repaired: from now on only record_usage moves the counters
+    add_images(db, "u1", [OCT])
+    assert asyncio.run(get_usage(db, "u1", OCT)) == {"total_images": 2, "images_this_month": 1}
+    asyncio.run(record_usage(db, "u1", OCT, 1))
+    assert asyncio.run(get_usage(db, "u1", OCT)) == {"total_images": 3, "images_this_month": 2}
+    assert asyncio.run(get_usage(db, "nobody", OCT)) == {"total_images": 0, "images_this_month": 0}
+
+
+def test_repair_does_not_lose_a_concurrent_upload(db, monkeypatch):
+    add_images(db, "u1", [OCT])
+    asyncio.run(record_usage(db, "u1", OCT, 1))
+    collection_class = type(db.usage)
+    update_one = collection_class.update_one
+    raced = []
+
+    async def upload_lands_first(self, query, update, **kwargs):
+        if "$set" in update and not raced:
+            # An upload between the recount and its write
+            raced.append(True)
+            await db.images.insert_one({"user_id": "u1", "created_at": OCT})
+            await update_one(self, {"user_id": "u1"}, {"$inc": {"total_images": 1, "version": 1}})
+        return await update_one(self, query, update, **kwargs)
+
+    monkeypatch.setattr(collection_class, "update_one", upload_lands_first)
+    asyncio.run(repair_usage(db, ["u1"]))
+    assert raced
+    assert asyncio.run(db.usage.find_one({"user_id": "u1"}))["total_images"] == 2
+
+
+def test_deleting_an_image_without_a_valid_date_works(server):
+    from tests.conftest import add_user, api_client
+
+    async def main():
+        headers = await add_user(server, "u1")
+        await server.db.images.insert_many([
+            {"image_id": "img_none", "user_id": "u1", "original_path": "/x", "created_at": None},
+            {"image_id": "img_bad", "user_id": "u1", "original_path": "/x", "created_at": "last tuesday"},
+        ])
+        async with api_client(server) as client:
+            return [(await client.delete(f"/api/images/{image_id}", headers=headers)).status_code
+                    for image_id in ("img_none", "img_bad")]
+
+    assert asyncio.run(main()) == [200, 200]